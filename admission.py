@@ -0,0 +1,197 @@
+import threading
+import time
+from collections import defaultdict
+from flask import request, g, jsonify, current_app
+
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+
+class AdmissionController:
+    """
+    Per-route concurrency limits with a bounded wait queue and read priority.
+
+    Each route (method + URL rule) may run at most ``limit`` requests at once.
+    Up to ``queue_size`` more wait for a slot for at most ``timeout`` seconds;
+    anything beyond that is shed immediately. While a read of a priority group
+    is waiting, writes to the same group are not admitted, so an ingest burst
+    queued behind SQLite's write lock cannot hold back GET requests of the
+    same data. A group is the URL rule (GET and POST /weather/history/<id>
+    share one) unless ``priority_groups`` maps rules sharing data to a name.
+
+    Note:
+        Limits count the requests of one process running concurrently, so
+        they only engage with several threads per worker (serve --threads);
+        each gunicorn worker applies them separately.
+    """
+
+    def __init__(self, read_limit, write_limit, queue_size, timeout, route_limits=None,
+                 priority_groups=None):
+        self.read_limit = read_limit
+        self.write_limit = write_limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.route_limits = dict(route_limits or {})
+        self.priority_groups = dict(priority_groups or {})
+        self._cond = threading.Condition()
+        self._active = defaultdict(int)
+        self._waiting = defaultdict(int)
+        self._waiting_reads = defaultdict(int)
+        self._admitted = defaultdict(int)
+        self._shed = defaultdict(int)
+
+    def _limit(self, route, write):
+        if route in self.route_limits:
+            return self.route_limits[route]
+        return self.write_limit if write else self.read_limit
+
+    def _group(self, route):
+        rule = route.split(' ', 1)[-1]
+        return self.priority_groups.get(rule, rule)
+
+    def _can_enter(self, route, write, limit):
+        return self._active[route] < limit and (not write or self._waiting_reads[self._group(route)] == 0)
+
+    def acquire(self, route, write):
+        """
+        Wait for a slot on a route.
+
+        Args:
+            route (str): The route key, e.g. "POST /weather/history/<int:location_id>"
+            write (bool): Whether the request writes to the database
+
+        Returns:
+            bool: True if admitted (``release`` must be called), False if shed
+        """
+        limit = self._limit(route, write)
+        with self._cond:
+            if self._waiting[route] == 0 and self._can_enter(route, write, limit):
+                self._active[route] += 1
+                self._admitted[route] += 1
+                return True
+            if self._waiting[route] >= self.queue_size:
+                self._shed[route] += 1
+                return False
+
+            self._waiting[route] += 1
+            if not write:
+                self._waiting_reads[self._group(route)] += 1
+            deadline = time.monotonic() + self.timeout
+            try:
+                while not self._can_enter(route, write, limit):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._shed[route] += 1
+                        return False
+                    self._cond.wait(remaining)
+                self._active[route] += 1
+                self._admitted[route] += 1
+                return True
+            finally:
+                self._waiting[route] -= 1
+                if not write:
+                    self._waiting_reads[self._group(route)] -= 1
+                    # writes may be blocked on this read having been queued
+                    self._cond.notify_all()
+
+    def release(self, route):
+        with self._cond:
+            self._active[route] -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        """
+        Returns:
+            dict: Active, queued, admitted and shed counts per route, plus the
+            total queue depth
+        """
+        with self._cond:
+            routes = set(self._active) | set(self._waiting) | set(self._shed)
+            return {
+                "queue_depth": sum(self._waiting.values()),
+                "routes": {
+                    route: {
+                        "active": self._active[route],
+                        "queued": self._waiting[route],
+                        "admitted": self._admitted[route],
+                        "shed": self._shed[route],
+                    } for route in sorted(routes)
+                }
+            }
+
+
+def init_app(app):
+    """
+    Install admission control on the app.
+
+    Config:
+        ADMISSION_ENABLED (bool): Turn admission control on or off
+        ADMISSION_READ_LIMIT (int): Concurrent requests per read route
+        ADMISSION_WRITE_LIMIT (int): Concurrent requests per write route
+        ADMISSION_ROUTE_LIMITS (dict): Overrides keyed by "METHOD rule"
+        ADMISSION_PRIORITY_GROUPS (dict): URL rule to group name, for rules
+            whose queued reads should hold back each other's writes
+        ADMISSION_QUEUE_SIZE (int): Requests allowed to wait per route
+        ADMISSION_QUEUE_TIMEOUT (float): Seconds a request may wait for a slot
+        ADMISSION_RETRY_AFTER (int): Retry-After value sent with 503 responses
+        ADMISSION_EXEMPT (set): URL rules that bypass admission control
+
+    Side-effects:
+        - Stores the controller in app.extensions['admission']
+        - Registers before_request / teardown_request hooks
+    """
+    app.config.setdefault('ADMISSION_ENABLED', True)
+    app.config.setdefault('ADMISSION_READ_LIMIT', 32)
+    app.config.setdefault('ADMISSION_WRITE_LIMIT', 4)
+    app.config.setdefault('ADMISSION_ROUTE_LIMITS', {})
+    app.config.setdefault('ADMISSION_PRIORITY_GROUPS', {
+        '/favorites/batch': '/favorites',
+        '/favorites/<int:favorite_id>': '/favorites',
+    })
+    app.config.setdefault('ADMISSION_QUEUE_SIZE', 16)
+    app.config.setdefault('ADMISSION_QUEUE_TIMEOUT', 2.0)
+    app.config.setdefault('ADMISSION_RETRY_AFTER', 1)
+    # The change feed routes are meant to wait (up to LONG_POLL_TIMEOUT or
+    # STREAM_MAX_SECONDS) and are limited by STREAM_MAX_CLIENTS instead
+    # (see change_feed.py)
+    app.config.setdefault('ADMISSION_EXEMPT', {'/health', '/metrics', '/weather/stream', '/weather/updates'})
+
+    app.extensions['admission'] = AdmissionController(
+        app.config['ADMISSION_READ_LIMIT'],
+        app.config['ADMISSION_WRITE_LIMIT'],
+        app.config['ADMISSION_QUEUE_SIZE'],
+        app.config['ADMISSION_QUEUE_TIMEOUT'],
+        app.config['ADMISSION_ROUTE_LIMITS'],
+        app.config['ADMISSION_PRIORITY_GROUPS'],
+    )
+    app.before_request(admit_request)
+    app.teardown_request(release_request)
+
+
+def admit_request():
+    """
+    Admits the current request or sheds it with 503 Service Unavailable.
+
+    Side-effects:
+        - Sets g.admission_route when a slot was taken
+    """
+    config = current_app.config
+    rule = request.url_rule
+    if not config['ADMISSION_ENABLED'] or rule is None or rule.rule in config['ADMISSION_EXEMPT']:
+        return None
+
+    route = f"{request.method} {rule.rule}"
+    if current_app.extensions['admission'].acquire(route, request.method in WRITE_METHODS):
+        g.admission_route = route
+        return None
+
+    current_app.logger.warning("\nShedding request to %s: route is at capacity.", route)
+    response = jsonify({"error": "Server is busy, please retry later"})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(config['ADMISSION_RETRY_AFTER'])
+    return response
+
+
+def release_request(e=None):
+    route = g.pop('admission_route', None)
+    if route is not None:
+        current_app.extensions['admission'].release(route)
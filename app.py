@@ -1,21 +1,60 @@
-from flask import Flask, request, jsonify, g, session
-from database import get_db, close_db, init_db_command, clear_db_command
+from flask import Flask, Response, request, jsonify, g, session
+from database import (get_db, get_weather_db, weather_shard, fan_out, close_db, init_db_command,
+                      clear_db_command, reshard_command)
+from serve import serve_command
+from seed import seed_db_command
+from route_profiler import profile_route_command
 from auth import *
+from conditional import rows_etag, not_modified, conditional_jsonify
+from json_provider import RowJSONProvider, columnar_payload
+from conditions import ConditionEncoder, migrate_conditions_command
+from metrics import record_cache
+import compression
+import admission
+import metrics
+import sql_profiler
+import tracing
+import memory
+import app_logging
+import retention
+import partitions
+import geo
+import change_feed
+import tokens
+import passwords
 import sqlite3
 import logging
 import sys
 from datetime import timedelta
+from urllib.parse import urlencode
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-here'
 app.config['SESSION_TYPE'] = 'filesystem'
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=30)
+# Any config value can be overridden from the environment, e.g. WEATHER_DATABASE=/data/weather.db
+app.config.from_prefixed_env('WEATHER')
+# Largest page of GET /favorites?limit= and batch of POST /favorites/batch
+app.config.setdefault('FAVORITES_MAX_PAGE_SIZE', 1000)
+app.config.setdefault('FAVORITES_BATCH_MAX_SIZE', 5000)
+app.json = RowJSONProvider(app)
+compression.init_app(app)
+metrics.init_app(app)
+sql_profiler.init_app(app)
+tracing.init_app(app)
+memory.init_app(app)
+retention.init_app(app)
+partitions.init_app(app)
+geo.init_app(app)
+change_feed.init_app(app)
+tokens.init_app(app)
+passwords.init_app(app)
+admission.init_app(app)
 
 logging.getLogger('werkzeug').disabled = True
-# Set up basic logging to standard output
 logging.basicConfig(level=logging.INFO)
-app.logger.addHandler(logging.StreamHandler(sys.stdout))
-app.logger.setLevel(logging.INFO)
+# Structured logs written to standard output by a background thread, see app_logging.py
+app_logging.init_app(app)
 
 
 cli = sys.modules['flask.cli']
@@ -24,6 +63,26 @@ cli.show_server_banner = lambda *x: None
 app.teardown_appcontext(close_db)
 app.cli.add_command(init_db_command)
 app.cli.add_command(clear_db_command)
+app.cli.add_command(reshard_command)
+app.cli.add_command(serve_command)
+app.cli.add_command(seed_db_command)
+app.cli.add_command(profile_route_command)
+app.cli.add_command(migrate_conditions_command)
+
+RESPONSE_FORMATS = ('rows', 'columnar')
+# Columns GET /favorites can project with ``fields=``
+FAVORITE_FIELDS = ('id', 'user_id', 'location_name', 'latitude', 'longitude')
+
+def requested_format():
+    """
+    Reads the optional ``format`` query parameter of time-series GET endpoints.
+    
+    Returns:
+        str or None: "rows" (the default) or "columnar", or None if the
+        requested format is not supported
+    """
+    response_format = request.args.get('format', 'rows')
+    return response_format if response_format in RESPONSE_FORMATS else None
 
 @app.before_request
 def load_logged_in_user():
@@ -34,7 +93,7 @@ def load_logged_in_user():
         - Sets g.user_id to the current user's ID from the session
     """
     g.user_id = session.get('user_id')
-    app.logger.info(f"\nSession loaded for user ID: {g.user_id}")
+    app.logger.info("\nSession loaded for user ID: %s", g.user_id)
 
 @app.route('/register', methods=['POST'])
 def register():
@@ -58,7 +117,7 @@ def register():
     
     Side-effects:
         - Creates new user record in database
-        - Hashes password with salt
+        - Hashes password with salt on the password hashing pool
     """
     app.logger.info("\nReceived registration request")
     if not request.is_json:
@@ -70,7 +129,10 @@ def register():
         return jsonify({"error": "Username and password are required"}), 400
 
     salt = generate_salt()
-    password_hash = hash_password(data['password'], salt)
+    try:
+        password_hash = passwords.offload(hash_password, data['password'], salt)
+    except passwords.HashPoolBusy:
+        return passwords.busy_response()
     
     db = get_db()
     try:
@@ -79,12 +141,12 @@ def register():
             (data['username'], password_hash, salt)
         )
         db.commit()
-        app.logger.info(f"\nUser {data['username']} registered successfully.")
+        app.logger.info("\nUser %s registered successfully.", data['username'])
     except sqlite3.IntegrityError:
         app.logger.info("\nRegistration failed: Username already exists.")
         return jsonify({"error": "Username already exists"}), 409
     except sqlite3.Error as e:
-        app.logger.info(f"\nRegistration failed: {e}")
+        app.logger.info("\nRegistration failed: %s", e)
         return jsonify({"error": str(e)}), 500
 
     return jsonify({"message": "User registered successfully"}), 200
@@ -108,6 +170,9 @@ def login():
     Side-effects:
         - Creates new session for authenticated user
         - Sets user_id in session
+        - Verifies on the password hashing pool (503 when it is full) and
+          rehashes a password stored with an older hasher or parameters
+          (skipped until a later login when the pool is full)
     """
     app.logger.info("\nAttempting to authenticate a user.")
     if not request.is_json:
@@ -125,16 +190,35 @@ def login():
         (data['username'],)
     ).fetchone()
 
-    if user is None:
-        app.logger.info("\nLogin attempt failed due to invalid credentials.")
-        return jsonify({"error": "Invalid username or password"}), 401
-
-    if not verify_password(user['password_hash'], user['salt'], data['password']):
+    try:
+        if user is None:
+            # Pay for a verification anyway, so unknown usernames are not faster
+            passwords.offload(passwords.verify_unknown_user, data['password'])
+            verified = False
+        else:
+            verified = passwords.offload(verify_password, user['password_hash'], user['salt'], data['password'])
+    except passwords.HashPoolBusy:
+        return passwords.busy_response()
+    except ValueError as e:
+        app.logger.error("\nStored password hash of user %s is unusable: %s", user['id'], e)
+        verified = False
+    if not verified:
         app.logger.info("\nLogin attempt failed due to invalid credentials.")
         return jsonify({"error": "Invalid username or password"}), 401
 
     session['user_id'] = user['id']
-    app.logger.info(f"\nUser logged in: {data['username']}")
+    app.logger.info("\nUser logged in: %s", data['username'])
+    if passwords.needs_rehash(user['password_hash']):
+        # Best effort: the login has succeeded, a busy pool only postpones the upgrade
+        salt = generate_salt()
+        try:
+            password_hash = passwords.offload(hash_password, data['password'], salt)
+            db.execute('UPDATE users SET password_hash = ?, salt = ? WHERE id = ?', (password_hash, salt, user['id']))
+            db.commit()
+            app.logger.info("\nUpgraded password hash of user %s.", user['id'])
+        except (passwords.HashPoolBusy, sqlite3.Error) as e:
+            app.logger.warning("\nPassword hash of user %s not upgraded, retried at the next login: %s",
+                               user['id'], e.__class__.__name__)
     return jsonify({"message": "Login successful"}), 200
 
 @app.route('/logout', methods=['POST'])
@@ -154,26 +238,142 @@ def logout():
     app.logger.info("\nUser logged out successfully")
     return jsonify({"message": "Logged out successfully"}), 200
 
+@app.route('/tokens', methods=['POST'])
+@login_required
+def create_api_token():
+    """
+    Creates a long-lived API token for the authenticated user.
+    
+    Expected JSON payload:
+        {
+            "name": str,
+            "expires_in_days": number (optional, default: until revoked)
+        }
+    
+    Returns:
+        tuple: (JSON response, HTTP status code)
+            - Success: (token id, name, created_at, expires_at and the token, 201)
+            - Error: ({"error": error_message}, error_code)
+    
+    Note:
+        Only a session login can create tokens, so a leaked token cannot be
+        used to mint others that outlive its revocation. The token itself is
+        returned once and never stored.
+    """
+    app.logger.info("\nReceived API token creation request")
+    if g.get('api_token_id'):
+        return jsonify({"error": "API tokens cannot create other tokens"}), 403
+    if not request.is_json:
+        return jsonify({"error": "Content-Type must be application/json"}), 400
+
+    data = request.get_json()
+    name = data.get('name')
+    expires_in_days = data.get('expires_in_days')
+    if not isinstance(name, str) or not name.strip():
+        return jsonify({"error": "Token name is required"}), 400
+    if expires_in_days is not None and (isinstance(expires_in_days, bool)
+                                        or not isinstance(expires_in_days, (int, float))
+                                        or expires_in_days <= 0):
+        return jsonify({"error": "expires_in_days must be a positive number"}), 400
+
+    try:
+        created = tokens.create_token(get_db(), g.user_id, name.strip(), expires_in_days)
+    except sqlite3.Error as e:
+        app.logger.info("\nAPI token creation failed: %s", e)
+        return jsonify({"error": str(e)}), 500
+    app.logger.info("\nAPI token %s created for user %s", created['id'], g.user_id)
+    return jsonify(created), 201
+
+@app.route('/tokens', methods=['GET'])
+@login_required
+def list_api_tokens():
+    """
+    Lists the authenticated user's API tokens (without the tokens themselves).
+    """
+    rows = get_db().execute(
+        'SELECT id, name, created_at, expires_at, revoked_at FROM api_tokens WHERE user_id = ? ORDER BY id',
+        (g.user_id,)
+    ).fetchall()
+    return jsonify(rows), 200
+
+@app.route('/tokens/<int:token_id>', methods=['DELETE'])
+@login_required
+def revoke_api_token(token_id):
+    """
+    Revokes one of the authenticated user's API tokens.
+    
+    Returns:
+        tuple: (JSON response, HTTP status code)
+            - Success: ({"message": "Token revoked"}, 200)
+            - Error: ({"error": "Token not found"}, 404)
+    
+    Side-effects:
+        - Drops the token from this worker's cache and signals the other
+          workers, which stop accepting it within API_TOKEN_REVOCATION_CHECK
+          seconds
+    """
+    if not tokens.revoke_token(get_db(), g.user_id, token_id):
+        return jsonify({"error": "Token not found"}), 404
+    app.logger.info("\nAPI token %s revoked for user %s", token_id, g.user_id)
+    return jsonify({"message": "Token revoked"}), 200
+
 @app.route('/favorites', methods=['GET'])
 @login_required
 def get_favorites():
     """
-    Retrieves all favorite locations for the authenticated user.
+    Retrieves the favorite locations of the authenticated user.
+
+    Without parameters every location is returned. ``limit`` returns one
+    page in id order (at most FAVORITES_MAX_PAGE_SIZE) and ``after=<id>``
+    the page following that id, read from the user_id index (whose entries
+    end in the id) however deep the page is; a ``Link: <...>; rel="next"`` header points to the
+    next page while there may be one. ``fields=id,location_name`` returns
+    only those columns (id is always included).
     """
-    app.logger.info(f"\nAttempting to retrieve favorite locations for user ID: {g.user_id}")
+    app.logger.info("\nAttempting to retrieve favorite locations for user ID: %s", g.user_id)
+    fields = [field for field in request.args.get('fields', '').split(',') if field]
+    if not set(fields) <= set(FAVORITE_FIELDS):
+        return jsonify({"error": f"fields must be among {', '.join(FAVORITE_FIELDS)}"}), 400
+    columns = ', '.join(['id'] + [field for field in FAVORITE_FIELDS if field in fields and field != 'id']
+                        if fields else ['*'])
+    paginated = 'limit' in request.args or 'after' in request.args
+    try:
+        after = int(request.args.get('after', 0))
+        limit = min(int(request.args.get('limit', app.config['FAVORITES_MAX_PAGE_SIZE'])),
+                    app.config['FAVORITES_MAX_PAGE_SIZE'])
+    except ValueError:
+        return jsonify({"error": "after and limit must be integers"}), 400
+    if limit < 1:
+        return jsonify({"error": "limit must be positive"}), 400
+    where = 'WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?' if paginated else 'WHERE user_id = ?'
+    params = (g.user_id, after, limit) if paginated else (g.user_id,)
     db = get_db()
     try:
-        favorites = db.execute(
-            'SELECT * FROM favorite_locations WHERE user_id = ?',
-            (g.user_id,)
-        ).fetchall()
-        if not favorites:
+        etag = rows_etag(
+            db,
+            f'SELECT id FROM favorite_locations {where}',
+            params,
+            # Different pages and projections of the same rows must not share a validator
+            f"favorites-{g.user_id}" + (f"-{after}-{limit}" if paginated else "") + (f"-{columns}" if fields else "")
+        )
+        cached = not_modified(etag)
+        if cached is not None:
+            app.logger.info("\nFavorite locations not modified.")
+            return cached
+        favorites = db.execute(f'SELECT {columns} FROM favorite_locations {where}', params).fetchall()
+        if not favorites and not paginated:
             app.logger.info("\nNo favorite locations found for user.")
             return jsonify({"message": "No favorite locations found"}), 200
-        app.logger.info(f"\nFound {len(favorites)} favorite locations for user.")
-        return jsonify([dict(row) for row in favorites]), 200
+        app.logger.info("\nFound %s favorite locations for user.", len(favorites))
+        response = conditional_jsonify(favorites, etag)
+        if paginated and len(favorites) == limit:
+            query = {'after': favorites[-1]['id'], 'limit': limit}
+            if fields:
+                query['fields'] = ','.join(fields)
+            response.headers['Link'] = f'</favorites?{urlencode(query)}>; rel="next"'
+        return response, 200
     except sqlite3.Error as e:
-        app.logger.error(f"\nUnable to fetch favorites: {e}")
+        app.logger.error("\nUnable to fetch favorites: %s", e)
         return jsonify({"error": "Unable to fetch favorites"}), 500
 
 @app.route('/favorites', methods=['POST'])
@@ -197,17 +397,78 @@ def add_favorite():
         )
         db.commit()
     except Exception as e:
-        app.logger.error(f"\nFailed to add favorite location: {e}")
+        app.logger.error("\nFailed to add favorite location: %s", e)
         return jsonify({"error": str(e)}), 500
     app.logger.info("\nFavorite location added successfully.")
     return jsonify({"message": "Location added successfully"}), 200
 
+def _favorite_error(item):
+    """
+    Returns:
+        str or None: Why a batch item is not a valid location, None if it is
+    """
+    if not isinstance(item, dict):
+        return "must be an object"
+    name = item.get('location_name')
+    if not isinstance(name, str) or not name.strip():
+        return "location_name must be a non-empty string"
+    for field, bound in (('latitude', 90), ('longitude', 180)):
+        value = item.get(field)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not -bound <= value <= bound:
+            return f"{field} must be a number within [-{bound}, {bound}]"
+    return None
+
+@app.route('/favorites/batch', methods=['POST'])
+@login_required
+def add_favorites_batch():
+    """
+    Adds many favorite locations for the authenticated user in one transaction.
+
+    The body is ``{"locations": [{"location_name", "latitude", "longitude"}, ...]}``
+    with at most FAVORITES_BATCH_MAX_SIZE items. Each item is validated on
+    its own: valid ones are inserted, invalid ones reported, and the results
+    list the new id or the error of every item in request order.
+    """
+    app.logger.info("\nAdding a batch of favorite locations for user.")
+    if not request.is_json:
+        return jsonify({"error": "Content-Type must be application/json"}), 400
+    body = request.get_json(silent=True)
+    items = body.get('locations') if isinstance(body, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "locations must be a non-empty list"}), 400
+    if len(items) > app.config['FAVORITES_BATCH_MAX_SIZE']:
+        return jsonify({"error": f"At most {app.config['FAVORITES_BATCH_MAX_SIZE']} locations per batch"}), 413
+
+    results = []
+    db = get_db()
+    try:
+        for index, item in enumerate(items):
+            error = _favorite_error(item)
+            if error:
+                results.append({"index": index, "status": "invalid", "error": error})
+                continue
+            cursor = db.execute(
+                'INSERT INTO favorite_locations (user_id, location_name, latitude, longitude)'
+                ' VALUES (?, ?, ?, ?)',
+                (g.user_id, item['location_name'].strip(), item['latitude'], item['longitude'])
+            )
+            results.append({"index": index, "status": "created", "id": cursor.lastrowid})
+        db.commit()
+    except sqlite3.Error as e:
+        db.rollback()
+        app.logger.error("\nFailed to add favorite locations: %s", e)
+        return jsonify({"error": str(e)}), 500
+    created = sum(result['status'] == 'created' for result in results)
+    app.logger.info("\nAdded %s of %s favorite locations.", created, len(items))
+    return jsonify({"created": created, "invalid": len(items) - created, "results": results}), 200
+
 @app.route('/favorites/<int:favorite_id>', methods=['DELETE'])
+@login_required
 def delete_favorite(favorite_id):
     """
     Deletes a specific favorite location for the authenticated user.
     """
-    app.logger.info(f"\nAttempting to delete favorite location with ID: {favorite_id} for user ID: {g.user_id}")
+    app.logger.info("\nAttempting to delete favorite location with ID: %s for user ID: %s", favorite_id, g.user_id)
     db = get_db()
     try:
         result = db.execute('DELETE FROM favorite_locations WHERE id = ? AND user_id = ?', (favorite_id, g.user_id))
@@ -218,19 +479,80 @@ def delete_favorite(favorite_id):
         app.logger.info("\nFavorite location deleted successfully.")
         return jsonify({"message": "Location deleted successfully"}), 200
     except sqlite3.Error as e:
-        app.logger.error(f"\nUnable to delete location")
+        app.logger.error("\nUnable to delete location")
         return jsonify({"error": "Unable to delete location"}), 500
 
+@app.route('/locations/nearby', methods=['GET'])
+@login_required
+def nearby_locations():
+    """
+    Finds the stored locations nearest to a point.
+
+    Query parameters ``lat``, ``lon`` and ``radius_km`` are required,
+    ``limit`` defaults to 10. Only the user's own favorites are searched,
+    so other users' location ids and coordinates are never disclosed.
+    """
+    app.logger.info("\nSearching nearby locations for user ID: %s", g.user_id)
+    try:
+        lat = float(request.args['lat'])
+        lon = float(request.args['lon'])
+        radius_km = float(request.args['radius_km'])
+        limit = int(request.args.get('limit', 10))
+    except (KeyError, ValueError):
+        return jsonify({"error": "lat, lon and radius_km are required numbers, limit an integer"}), 400
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return jsonify({"error": "lat must be within [-90, 90] and lon within [-180, 180]"}), 400
+    if not 0 < radius_km <= app.config['NEARBY_MAX_RADIUS_KM'] or not 0 < limit <= app.config['NEARBY_MAX_RESULTS']:
+        return jsonify({"error": f"radius_km must be within (0, {app.config['NEARBY_MAX_RADIUS_KM']}] "
+                                 f"and limit within [1, {app.config['NEARBY_MAX_RESULTS']}]"}), 400
+    try:
+        found = geo.nearby_locations(get_db(), lat, lon, radius_km, limit, user_id=g.user_id)
+    except sqlite3.Error as e:
+        app.logger.error("\nUnable to search nearby locations: %s", e)
+        return jsonify({"error": "Unable to search nearby locations"}), 500
+    app.logger.info("\nFound %s locations within %s km.", len(found), radius_km)
+    return jsonify([{
+        "id": row['id'],
+        "location_name": row['location_name'],
+        "latitude": row['latitude'],
+        "longitude": row['longitude'],
+        "distance_km": round(distance, 3),
+    } for distance, row in found]), 200
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """
     Basic health check endpoint to verify service status.
+    
+    Also reports admission control queue depth and shed counts per route,
+    this worker's change feed subscribers, its cached API tokens and its
+    password hashing pool.
     """
     return jsonify({
         "status": "healthy",
-        "message": "Service is running"
+        "message": "Service is running",
+        "admission": app.extensions['admission'].stats(),
+        "stream": change_feed.get_feed().stats(),
+        "api_tokens": tokens.get_cache().stats(),
+        "password_hashing": app.extensions['password_hashing'].stats()
     }), 200
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Exposes request, database and cache metrics in Prometheus text format.
+    
+    Returns:
+        flask.Response: text/plain exposition, or 404 if metrics are disabled
+    """
+    registry = app.extensions.get('metrics')
+    if registry is None:
+        return jsonify({"error": "Metrics are disabled"}), 404
+    return app.response_class(
+        registry.render(app.extensions.get('admission')),
+        mimetype='text/plain; version=0.0.4'
+    )
+
 @app.route('/update-password', methods=['POST'])
 @login_required
 def update_password():
@@ -253,13 +575,19 @@ def update_password():
         (g.user_id,)
     ).fetchone()
 
-    if not verify_password(user['password_hash'], user['salt'], data['current_password']):
-        app.logger.info("\nPassword update failed: Incorrect current password.")
-        return jsonify({"error": "Current password is incorrect"}), 401
+    try:
+        if not passwords.offload(verify_password, user['password_hash'], user['salt'], data['current_password']):
+            app.logger.info("\nPassword update failed: Incorrect current password.")
+            return jsonify({"error": "Current password is incorrect"}), 401
 
-    # Generate new salt and hash for the new password
-    new_salt = generate_salt()
-    new_password_hash = hash_password(data['new_password'], new_salt)
+        # Generate new salt and hash for the new password
+        new_salt = generate_salt()
+        new_password_hash = passwords.offload(hash_password, data['new_password'], new_salt)
+    except passwords.HashPoolBusy:
+        return passwords.busy_response()
+    except ValueError as e:
+        app.logger.error("\nStored password hash of user %s is unusable: %s", g.user_id, e)
+        return jsonify({"error": "Current password is incorrect"}), 401
 
     try:
         db.execute(
@@ -269,18 +597,153 @@ def update_password():
         db.commit()
         app.logger.info("\nPassword successfully updated for user.")
     except sqlite3.Error as e:
-        app.logger.info(f"\nPassword update failed due to database error: {e}")
+        app.logger.info("\nPassword update failed due to database error: %s", e)
         return jsonify({"error": str(e)}), 500
 
     return jsonify({"message": "Password updated successfully"}), 200
 
+def _visible_sources(rows):
+    """
+    Current weather rows with only the provenance the user may see.
+
+    Each row gets ``reused`` (whether it was copied from a nearby location);
+    ``source_location_id`` and ``source_distance_km`` are kept only when that
+    location is one of the user's own favorites, since another user's
+    location id and distance would reveal where they are.
+    """
+    owned = set()
+    if any(row['source_location_id'] is not None for row in rows):
+        owned = {row['id'] for row in get_db().execute(
+            'SELECT id FROM favorite_locations WHERE user_id = ?', (g.user_id,)
+        )}
+    visible = []
+    for row in rows:
+        row = dict(row)
+        row['reused'] = row['source_location_id'] is not None
+        if row['source_location_id'] not in owned:
+            row['source_location_id'] = row['source_distance_km'] = None
+        visible.append(row)
+    return visible
+
+@app.route('/weather/current', methods=['GET'])
+@login_required
+def current_weather_all():
+    """
+    Get the latest current weather of every favorite location of the user.
+
+    The locations are read with one query per shard holding any of them
+    (see database.fan_out), rather than one request per location.
+    """
+    app.logger.info("\nRetrieving current weather for all favorites of user ID: %s", g.user_id)
+    location_ids = [row['id'] for row in get_db().execute(
+        'SELECT id FROM favorite_locations WHERE user_id = ? ORDER BY id', (g.user_id,)
+    )]
+    try:
+        rows = fan_out(location_ids, '''
+            SELECT * FROM current_weather_rows c
+            WHERE location_id IN ({locations})
+            AND id = (SELECT id FROM current_weather WHERE location_id = c.location_id
+                      ORDER BY timestamp DESC LIMIT 1)
+        ''')
+    except sqlite3.Error as e:
+        app.logger.error("\nUnable to fetch current weather: %s", e)
+        return jsonify({"error": "Unable to fetch current weather"}), 500
+    rows.sort(key=lambda row: row['location_id'])
+    app.logger.info("\nCurrent weather retrieved for %s of %s locations.", len(rows), len(location_ids))
+    return jsonify(_visible_sources(rows)), 200
+
+def _feed_request():
+    """
+    Parse the locations and resume position of a change feed request.
+
+    Returns:
+        tuple: ``(location_ids, since, None)``, or ``(None, None, error response)``
+    """
+    owned = {row['id'] for row in get_db().execute(
+        'SELECT id FROM favorite_locations WHERE user_id = ?', (g.user_id,)
+    )}
+    try:
+        location_ids = ({int(value) for value in request.args['locations'].split(',')}
+                        if request.args.get('locations') else owned)
+        since = request.headers.get('Last-Event-ID') or request.args.get('since')
+        since = int(since) if since else None
+    except ValueError:
+        return None, None, (jsonify({"error": "locations and since must be integers"}), 400)
+    if not location_ids <= owned:
+        return None, None, (jsonify({"error": "Location not found"}), 404)
+    return location_ids, since, None
+
+@app.route('/weather/stream', methods=['GET'])
+@login_required
+def weather_stream():
+    """
+    Push new weather of the user's favorites as Server-Sent Events.
+
+    Every committed POST of current weather, forecast or history for one of
+    the locations (``locations=1,2`` to follow fewer) is sent as an event
+    named after its kind; ``overflow`` means the client fell behind and
+    should refetch. A reconnecting client's Last-Event-ID header resumes the
+    stream, see change_feed.ChangeFeed.
+    """
+    location_ids, since, error = _feed_request()
+    if error:
+        return error
+    app.logger.info("\nStreaming weather of %s locations.", len(location_ids))
+    feed = change_feed.get_feed()
+    try:
+        subscription = feed.subscribe(get_db(), location_ids, since)
+    except change_feed.FeedFull:
+        return change_feed.full_response()
+    response = Response(
+        change_feed.sse_stream(subscription, app.config['STREAM_HEARTBEAT'], app.config['STREAM_MAX_SECONDS']),
+        mimetype='text/event-stream'
+    )
+    response.call_on_close(lambda: feed.unsubscribe(subscription))
+    response.headers['Cache-Control'] = 'no-cache'
+    # Tells nginx not to buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/weather/updates', methods=['GET'])
+@login_required
+def weather_updates():
+    """
+    Long-poll fallback of /weather/stream.
+
+    Waits up to ``timeout`` seconds (at most LONG_POLL_TIMEOUT) for events
+    after ``since`` and returns them with ``last_id``, the ``since`` of the
+    next request. Without ``since`` only events from now on are returned.
+    """
+    location_ids, since, error = _feed_request()
+    if error:
+        return error
+    try:
+        timeout = min(float(request.args.get('timeout', app.config['LONG_POLL_TIMEOUT'])),
+                      app.config['LONG_POLL_TIMEOUT'])
+    except ValueError:
+        return jsonify({"error": "timeout must be a number"}), 400
+    feed = change_feed.get_feed()
+    try:
+        subscription = feed.subscribe(get_db(), location_ids, since)
+    except change_feed.FeedFull:
+        return change_feed.full_response()
+    try:
+        events, dropped = subscription.get(max(timeout, 0))
+    finally:
+        feed.unsubscribe(subscription)
+    return jsonify({
+        "events": [event.to_json() for event in events],
+        "last_id": max([subscription.cursor] + [event.seq for event in events]),
+        "overflow": dropped > 0,
+    }), 200
+
 @app.route('/weather/current/<int:location_id>', methods=['GET', 'POST'])
 @login_required
 def current_weather(location_id):
     """
     Get or store current weather for a location.
     """
-    app.logger.info(f"\nRetrieving or storing current weather for location ID: {location_id}")
+    app.logger.info("\nRetrieving or storing current weather for location ID: %s", location_id)
     db = get_db()
     location = db.execute(
         'SELECT * FROM favorite_locations WHERE id = ? AND user_id = ?',
@@ -290,6 +753,8 @@ def current_weather(location_id):
     if not location:
         app.logger.info("\nError: Location not found.")
         return jsonify({"error": "Location not found"}), 404
+    # With SHARDS set the location's weather rows are in its shard file
+    db = get_weather_db(location_id)
 
     if request.method == 'POST':
         if not request.is_json:
@@ -297,16 +762,17 @@ def current_weather(location_id):
         
         data = request.get_json()
         app.logger.info("\nReceived current weather data.")
-        app.logger.info(data)
+        app_logging.log_payload('current', data)
         current = data.get('current', {})
+        encode_condition = ConditionEncoder(db)
         
         try:
             app.logger.info("\nStoring current weather data.")
-            db.execute('''
+            cursor = db.execute('''
                 INSERT INTO current_weather 
                 (location_id, timestamp, temperature, feels_like, pressure, 
-                humidity, wind_speed, wind_deg, description, icon)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                humidity, wind_speed, wind_deg, condition_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (
                 location_id,
                 current.get('dt'),
@@ -316,23 +782,113 @@ def current_weather(location_id):
                 current.get('humidity'),
                 current.get('wind_speed'),
                 current.get('wind_deg'),
-                current.get('weather', [{}])[0].get('description'),
-                current.get('weather', [{}])[0].get('icon')
+                encode_condition(
+                    current.get('weather', [{}])[0].get('description'),
+                    current.get('weather', [{}])[0].get('icon')
+                )
             ))
             db.commit()
+            weather = current.get('weather', [{}])[0]
+            change_feed.publish(location_id, 'current', {
+                "id": cursor.lastrowid,
+                "location_id": location_id,
+                "timestamp": current.get('dt'),
+                "temperature": current.get('temp'),
+                "feels_like": current.get('feels_like'),
+                "pressure": current.get('pressure'),
+                "humidity": current.get('humidity'),
+                "wind_speed": current.get('wind_speed'),
+                "wind_deg": current.get('wind_deg'),
+                "description": weather.get('description'),
+                "icon": weather.get('icon'),
+            })
             app.logger.info("\nWeather data stored successfully.")
             return jsonify({"message": "Weather data stored successfully"}), 200
         except sqlite3.Error as e:
-            app.logger.error(f"\nError storing weather data: {e}")
+            app.logger.error("\nError storing weather data: %s", e)
             return jsonify({"error": str(e)}), 500
     # GET request - retrieve latest weather data
+    etag = rows_etag(db, '''
+        SELECT id FROM current_weather
+        WHERE location_id = ?
+        ORDER BY timestamp DESC LIMIT 1
+    ''', (location_id,), f"current-{location_id}")
+    cached = not_modified(etag)
+    if cached is not None:
+        app.logger.info("\nWeather data not modified.")
+        return cached
     weather = db.execute('''
-        SELECT * FROM current_weather 
+        SELECT * FROM current_weather_rows 
         WHERE location_id = ? 
         ORDER BY timestamp DESC LIMIT 1
     ''', (location_id,)).fetchone()
     app.logger.info("\nWeather data retrieved successfully.")
-    return jsonify(dict(weather) if weather else {"error": "No weather data found"}), 200
+    if not weather:
+        return jsonify({"error": "No weather data found"}), 200
+    return conditional_jsonify(_visible_sources([weather])[0], etag), 200
+
+@app.route('/weather/current/<int:location_id>/reuse', methods=['POST'])
+@login_required
+def reuse_nearby_weather(location_id):
+    """
+    Store current weather for a location from a fresh nearby observation.
+
+    Looks for a location within REUSE_DISTANCE_KM whose own latest current
+    weather is at most REUSE_MAX_AGE seconds old and stores a copy recording
+    where it came from (source_location_id, source_distance_km, shown only
+    for the user's own locations, see _visible_sources), so the client can
+    skip the upstream call. Returns 404 when there is none.
+    """
+    app.logger.info("\nLooking for fresh nearby weather for location ID: %s", location_id)
+    db = get_db()
+    location = db.execute(
+        'SELECT * FROM favorite_locations WHERE id = ? AND user_id = ?',
+        (location_id, g.user_id)
+    ).fetchone()
+
+    if not location:
+        app.logger.info("\nError: Location not found.")
+        return jsonify({"error": "Location not found"}), 404
+
+    found = None
+    if app.config['REUSE_DISTANCE_KM'] > 0:
+        found = geo.fresh_nearby_observation(db, location, app.config['REUSE_DISTANCE_KM'],
+                                             app.config['REUSE_MAX_AGE'])
+    record_cache('nearby_weather', found is not None)
+    if found is None:
+        app.logger.info("\nNo fresh nearby weather.")
+        return jsonify({"error": "No fresh weather nearby"}), 404
+
+    distance, source = found
+    weather_db = get_weather_db(location_id)
+    try:
+        cursor = weather_db.execute('''
+            INSERT INTO current_weather
+            (location_id, timestamp, temperature, feels_like, pressure, humidity,
+            wind_speed, wind_deg, condition_id, source_location_id, source_distance_km)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            location_id,
+            source['timestamp'],
+            source['temperature'],
+            source['feels_like'],
+            source['pressure'],
+            source['humidity'],
+            source['wind_speed'],
+            source['wind_deg'],
+            ConditionEncoder(weather_db)(source['description'], source['icon']),
+            source['location_id'],
+            round(distance, 3)
+        ))
+        weather_db.commit()
+    except sqlite3.Error as e:
+        app.logger.error("\nError storing reused weather data: %s", e)
+        return jsonify({"error": str(e)}), 500
+    app.logger.info("\nReused weather of location %s, %.3f km away.", source['location_id'], distance)
+    weather = weather_db.execute('SELECT * FROM current_weather_rows WHERE id = ?', (cursor.lastrowid,)).fetchone()
+    weather = _visible_sources([weather])[0]
+    change_feed.publish(location_id, 'current', weather)
+    return jsonify(weather), 200
 
 @app.route('/weather/forecast/<int:location_id>', methods=['GET', 'POST'])
 @login_required
@@ -340,7 +896,7 @@ def weather_forecast(location_id):
     """
     Get or store weather forecast for a location.
     """
-    app.logger.info(f"\nRetrieving or storing weather forecast for location ID: {location_id}")
+    app.logger.info("\nRetrieving or storing weather forecast for location ID: %s", location_id)
     db = get_db()
     location = db.execute(
         'SELECT * FROM favorite_locations WHERE id = ? AND user_id = ?',
@@ -350,6 +906,8 @@ def weather_forecast(location_id):
     if not location:
         app.logger.info("\nError: Location not found.")
         return jsonify({"error": "Location not found"}), 404
+    # With SHARDS set the location's weather rows are in its shard file
+    db = get_weather_db(location_id)
 
     if request.method == 'POST':
         if not request.is_json:
@@ -358,8 +916,9 @@ def weather_forecast(location_id):
         
         data = request.get_json()
         app.logger.info("\nReceived forecast data.")
-        app.logger.info(data)
+        app_logging.log_payload('forecast', data)
         current_time = data.get('current', {}).get('dt')
+        encode_condition = ConditionEncoder(db)
         
         try:
             app.logger.info("\nStoring forecast data.")
@@ -368,8 +927,8 @@ def weather_forecast(location_id):
                     INSERT INTO weather_forecast 
                     (location_id, timestamp, forecast_timestamp, temperature, 
                     feels_like, pressure, humidity, wind_speed, wind_deg, 
-                    description, icon)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    condition_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 ''', (
                     location_id,
                     current_time,
@@ -380,34 +939,60 @@ def weather_forecast(location_id):
                     daily.get('humidity'),
                     daily.get('wind_speed'),
                     daily.get('wind_deg'),
-                    daily.get('weather', [{}])[0].get('description'),
-                    daily.get('weather', [{}])[0].get('icon')
+                    encode_condition(
+                        daily.get('weather', [{}])[0].get('description'),
+                        daily.get('weather', [{}])[0].get('icon')
+                    )
                 ))
             db.commit()
+            change_feed.publish(location_id, 'forecast', {
+                "location_id": location_id,
+                "timestamp": current_time,
+                "rows": len(data.get('daily', [])),
+            })
             app.logger.info("\nForecast data stored successfully.")
             return jsonify({"message": "Forecast data stored successfully"}), 200
         except sqlite3.Error as e:
-            app.logger.info(f"\nError storing forecast data: {e}")
+            app.logger.info("\nError storing forecast data: %s", e)
             return jsonify({"error": str(e)}), 500
     
     # GET request - retrieve latest forecast
     app.logger.info("\nRetrieving forecast data.")
-    forecasts = db.execute('''
-        SELECT * FROM weather_forecast 
+    response_format = requested_format()
+    if response_format is None:
+        return jsonify({"error": "Unsupported format"}), 400
+    etag = rows_etag(db, '''
+        SELECT id FROM weather_forecast
+        WHERE location_id = ?
+        ORDER BY timestamp DESC, forecast_timestamp ASC
+        LIMIT 7
+    ''', (location_id,), f"forecast-{location_id}-{response_format}")
+    cached = not_modified(etag)
+    if cached is not None:
+        app.logger.info("\nForecast data not modified.")
+        return cached
+    cursor = db.execute('''
+        SELECT * FROM weather_forecast_rows 
         WHERE location_id = ? 
         ORDER BY timestamp DESC, forecast_timestamp ASC
         LIMIT 7
-    ''', (location_id,)).fetchall()
+    ''', (location_id,))
     app.logger.info("\nForecast data retrieved successfully.")
-    return jsonify([dict(f) for f in forecasts]), 200
+    if response_format == 'columnar':
+        return conditional_jsonify(columnar_payload(cursor), etag), 200
+    return conditional_jsonify(cursor.fetchall(), etag), 200
 
 @app.route('/weather/history/<int:location_id>', methods=['GET', 'POST'])
 @login_required
 def weather_history(location_id):
     """
     Get or store weather history for a location.
+
+    GET returns the latest 24 hourly rows, or with ``start`` / ``end``
+    timestamps (and an optional ``limit``) a range whose compacted days
+    come from the daily rollups.
     """
-    app.logger.info(f"\nRetrieving or storing weather history for location ID: {location_id}")
+    app.logger.info("\nRetrieving or storing weather history for location ID: %s", location_id)
     db = get_db()
     location = db.execute(
         'SELECT * FROM favorite_locations WHERE id = ? AND user_id = ?',
@@ -417,6 +1002,8 @@ def weather_history(location_id):
     if not location:
         app.logger.info("\nError: Location not found.")
         return jsonify({"error": "Location not found"}), 404
+    # With SHARDS set the location's weather rows are in its shard file
+    db = get_weather_db(location_id)
 
     if request.method == 'POST':
         app.logger.info("\nStoring historical data.")
@@ -426,15 +1013,16 @@ def weather_history(location_id):
         
         data = request.get_json()
         app.logger.info("\nReceived historical data.")
-        app.logger.info(data)
+        app_logging.log_payload('history', data)
+        encode_condition = ConditionEncoder(db)
         
         try:
             for hourly in data.get('hourly', []):
                 db.execute('''
                     INSERT INTO weather_history 
                     (location_id, timestamp, temperature, feels_like, 
-                    pressure, humidity, wind_speed, wind_deg, description, icon)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    pressure, humidity, wind_speed, wind_deg, condition_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
                 ''', (
                     location_id,
                     hourly.get('dt'),
@@ -444,25 +1032,62 @@ def weather_history(location_id):
                     hourly.get('humidity'),
                     hourly.get('wind_speed'),
                     hourly.get('wind_deg'),
-                    hourly.get('weather', [{}])[0].get('description'),
-                    hourly.get('weather', [{}])[0].get('icon')
+                    encode_condition(
+                        hourly.get('weather', [{}])[0].get('description'),
+                        hourly.get('weather', [{}])[0].get('icon')
+                    )
                 ))
             db.commit()
+            timestamps = [hourly.get('dt') for hourly in data.get('hourly', []) if hourly.get('dt') is not None]
+            change_feed.publish(location_id, 'history', {
+                "location_id": location_id,
+                "timestamp": max(timestamps, default=None),
+                "rows": len(data.get('hourly', [])),
+            })
             app.logger.info("\nHistorical data stored successfully.")
             return jsonify({"message": "Historical data stored successfully"}), 200
         except sqlite3.Error as e:
-            app.logger.info(f"\nError storing historical data: {e}")
+            app.logger.info("\nError storing historical data: %s", e)
             return jsonify({"error": str(e)}), 500
     
     app.logger.info("\nRetrieving historical data.")
-    history = db.execute('''
-        SELECT * FROM weather_history 
+    response_format = requested_format()
+    if response_format is None:
+        return jsonify({"error": "Unsupported format"}), 400
+    if 'start' in request.args or 'end' in request.args:
+        # Range reads span compacted days, so they are served (partly) from the
+        # monthly partitions and daily rollups; see retention.history_range
+        try:
+            start = int(request.args.get('start', 0))
+            end = int(request.args.get('end', 2 ** 62))
+            limit = min(int(request.args.get('limit', 1000)), 10000)
+        except ValueError:
+            return jsonify({"error": "start, end and limit must be integers"}), 400
+        cursor = retention.history_range(db, location_id, start, end, limit, partitions.get_archive(shard=weather_shard(location_id)))
+        app.logger.info("\nHistorical data range retrieved successfully.")
+        if response_format == 'columnar':
+            return jsonify(columnar_payload(cursor)), 200
+        return jsonify(cursor.fetchall()), 200
+    etag = rows_etag(db, '''
+        SELECT id FROM weather_history
+        WHERE location_id = ?
+        ORDER BY timestamp DESC
+        LIMIT 24
+    ''', (location_id,), f"history-{location_id}-{response_format}")
+    cached = not_modified(etag)
+    if cached is not None:
+        app.logger.info("\nHistorical data not modified.")
+        return cached
+    cursor = db.execute('''
+        SELECT * FROM weather_history_rows 
         WHERE location_id = ? 
         ORDER BY timestamp DESC
         LIMIT 24
-    ''', (location_id,)).fetchall()
+    ''', (location_id,))
     app.logger.info("\nHistorical data retrieved successfully.")
-    return jsonify([dict(h) for h in history]), 200
+    if response_format == 'columnar':
+        return conditional_jsonify(columnar_payload(cursor), etag), 200
+    return conditional_jsonify(cursor.fetchall(), etag), 200
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', debug=False) 
@@ -0,0 +1,173 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from flask import g, request, current_app, has_request_context
+
+# Apps whose exit / fork hooks are registered
+_hooked_apps = set()
+
+# Attributes every LogRecord has; anything else was passed in ``extra``
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+class JSONFormatter(logging.Formatter):
+    """Format records as one JSON object per line, with the request context captured at log time."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage().strip(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RequestContextFilter(logging.Filter):
+    """Attach method, path, user and trace id of the current request to each record."""
+
+    def filter(self, record):
+        if has_request_context():
+            record.method = request.method
+            record.path = request.path
+            record.user_id = g.get('user_id')
+            trace_id = g.get('trace_id')
+            if trace_id:
+                record.trace_id = trace_id
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue records without formatting them.
+
+    The standard QueueHandler merges ``msg % args`` in the logging thread;
+    this one leaves it to the listener thread, so a request only pays for
+    creating the record and a non-blocking put. Records are dropped (and
+    counted) when the queue is full rather than stalling the request.
+
+    Note:
+        Arguments are formatted later, so don't mutate objects after logging them.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def init_app(app, stream=None):
+    """
+    Route app.logger through a queue to a background writer.
+
+    Config:
+        LOG_LEVEL (str): Minimum level logged
+        LOG_FORMAT (str): "json" for one JSON object per line or "text"
+        LOG_ASYNC (bool): Write from a background thread (True) or inline
+        LOG_QUEUE_SIZE (int): Records buffered before new ones are dropped
+        LOG_PAYLOAD_SAMPLE_RATE (float): Share of weather POST payloads logged
+            in full (0 disables payload logging)
+
+    Args:
+        app (Flask): The app
+        stream (file): Where logs go (defaults to stdout)
+
+    Side-effects:
+        - Replaces app.logger's handlers and stops propagation to the root logger
+        - Starts a QueueListener thread, restarted in forked workers and
+          stopped (flushing the queue) at exit
+        - Stores the handler and listener in app.extensions['logging']
+
+    Note:
+        Calling it again reconfigures logging, which the logging benchmark uses.
+    """
+    app.config.setdefault('LOG_LEVEL', 'INFO')
+    app.config.setdefault('LOG_FORMAT', 'json')
+    app.config.setdefault('LOG_ASYNC', True)
+    app.config.setdefault('LOG_QUEUE_SIZE', 10000)
+    app.config.setdefault('LOG_PAYLOAD_SAMPLE_RATE', 0.0)
+
+    previous = app.extensions.pop('logging', None)
+    if previous and previous['listener']:
+        previous['listener'].stop()
+
+    writer = logging.StreamHandler(stream or sys.stdout)
+    if app.config['LOG_FORMAT'] == 'json':
+        writer.setFormatter(JSONFormatter())
+    else:
+        writer.setFormatter(logging.Formatter('%(message)s'))
+
+    handler = writer
+    listener = None
+    if app.config['LOG_ASYNC']:
+        handler = LazyQueueHandler(queue.Queue(app.config['LOG_QUEUE_SIZE']))
+        listener = logging.handlers.QueueListener(handler.queue, writer)
+        listener.start()
+    handler.addFilter(RequestContextFilter())
+
+    logger = app.logger
+    for existing in list(logger.handlers):
+        logger.removeHandler(existing)
+    logger.addHandler(handler)
+    logger.setLevel(app.config['LOG_LEVEL'])
+    logger.propagate = False
+    app.extensions['logging'] = {'handler': handler, 'listener': listener}
+
+    if id(app) not in _hooked_apps:
+        _hooked_apps.add(id(app))
+        atexit.register(_stop_listener, app)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=lambda: _restart_listener(app))
+
+
+def _stop_listener(app):
+    listener = app.extensions.get('logging', {}).get('listener')
+    if listener and listener._thread:
+        listener.stop()
+
+
+def _restart_listener(app):
+    # Threads do not survive fork(); gunicorn workers forked from a preloaded
+    # master get a fresh queue (the inherited one may have been locked by the
+    # master's writer at fork time, and its records are the master's to write)
+    # and their own writer thread.
+    handler = app.extensions.get('logging', {}).get('handler')
+    listener = app.extensions.get('logging', {}).get('listener')
+    if listener:
+        handler.queue = listener.queue = queue.Queue(handler.queue.maxsize)
+        listener._thread = None
+        listener.start()
+
+
+def log_payload(kind, data):
+    """
+    Log a received weather payload for a sample of requests.
+
+    Args:
+        kind (str): "current", "forecast" or "history"
+        data: The request JSON
+
+    Note:
+        Off by default; payloads can hold hundreds of rows.
+    """
+    rate = current_app.config['LOG_PAYLOAD_SAMPLE_RATE']
+    if rate and (rate >= 1 or random.random() < rate):
+        current_app.logger.info("\nReceived %s payload: %s", kind, data, extra={"payload_sampled": True})
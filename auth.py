@@ -1,7 +1,8 @@
-import hashlib
 import os
 from functools import wraps
 from flask import jsonify, g
+import passwords
+import tokens
 
 def generate_salt():
     """
@@ -17,19 +18,20 @@ def generate_salt():
 
 def hash_password(password, salt):
     """
-    Hash a password with the given salt using SHA-256.
+    Hash a password with the given salt using the configured hasher.
     
     Args:
         password (str): The plain-text password to hash
         salt (str): The salt to use in the hashing process
     
     Returns:
-        str: The hexadecimal representation of the hashed password
+        str: The stored form, naming the hasher and its parameters
     
     Note:
-        The function concatenates the password and salt before hashing
+        Deliberately slow (see passwords.py); routes run it through
+        passwords.offload rather than on the request thread
     """
-    return hashlib.sha256((password + salt).encode()).hexdigest()
+    return passwords.get_hasher().encode(password, salt)
 
 def verify_password(stored_password_hash, stored_salt, provided_password):
     """
@@ -44,10 +46,11 @@ def verify_password(stored_password_hash, stored_salt, provided_password):
         bool: True if the password matches, False otherwise
     
     Note:
-        Verifies by hashing the provided password with the stored salt
-        and comparing with the stored hash
+        Hashes with the hasher and parameters recorded in the stored hash
+        (including the original unsalted-iteration SHA-256) and compares in
+        constant time
     """
-    return stored_password_hash == hash_password(provided_password, stored_salt)
+    return passwords.verify(stored_password_hash, stored_salt, provided_password)
 
 def login_required(f):
     """
@@ -61,6 +64,8 @@ def login_required(f):
     
     Side-effects:
         - Checks g.user_id for current user session
+        - Otherwise verifies an ``Authorization: Bearer`` API token (see
+          tokens.py) and sets g.user_id and g.api_token_id from it
         - Returns 401 error if user is not authenticated
     
     Usage:
@@ -72,6 +77,12 @@ def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if not g.get('user_id'):
-            return jsonify({"error": "Authentication required"}), 401
+            token = tokens.bearer_token()
+            if token is None:
+                return jsonify({"error": "Authentication required"}), 401
+            identity = tokens.authenticate(token)
+            if identity is None:
+                return jsonify({"error": "Invalid or revoked API token"}), 401
+            g.user_id, g.api_token_id = identity
         return f(*args, **kwargs)
     return decorated_function
@@ -0,0 +1,102 @@
+"""
+Cost of polling for new weather against pushing it through the change feed.
+
+Polling: a client revalidating GET /weather/current/1 with If-None-Match
+(the cheapest poll, answered 304) through the test client, which still
+loads the session, checks the location and runs the ETag query.
+
+Pushing: one ChangeFeed.publish of a current-weather event (an insert into
+weather_events) and N subscriber threads blocked in Subscription.get
+receiving it once the feed's poller has read it.
+
+Usage:
+    python benchmarks/bench_change_feed.py [--polls 2000] [--subscribers 1 100 1000]
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_logging
+from app import app
+from change_feed import ChangeFeed
+from database import init_db
+
+EVENT = {"id": 1, "location_id": 1, "timestamp": 1684926000, "temperature": 18.5, "feels_like": 19.0,
+         "pressure": 1012, "humidity": 75, "wind_speed": 3.1, "wind_deg": 270,
+         "description": "light rain", "icon": "10n"}
+
+
+def poll_cost(workdir, polls):
+    app.config['DATABASE'] = os.path.join(workdir, 'weather.db')
+    with app.app_context():
+        init_db()
+    client = app.test_client()
+    client.post('/register', json={'username': 'bench', 'password': 'benchmark'})
+    client.post('/login', json={'username': 'bench', 'password': 'benchmark'})
+    client.post('/favorites', json={'location_name': 'Paris', 'latitude': 48.8575, 'longitude': 2.3514})
+    client.post('/weather/current/1', json={'current': {'dt': 1684926000, 'temp': 18.5}})
+    etag = client.get('/weather/current/1').headers['ETag']
+    start = time.perf_counter()
+    for _ in range(polls):
+        assert client.get('/weather/current/1', headers={'If-None-Match': etag}).status_code == 304
+    return (time.perf_counter() - start) / polls * 1e6
+
+
+def push_cost(workdir, subscribers, rounds=20):
+    path = os.path.join(workdir, 'weather.db')
+    db = sqlite3.connect(path)
+    feed = ChangeFeed(lambda: sqlite3.connect(path), buffer_size=64)
+    subscriptions = [feed.subscribe(db, [1]) for _ in range(subscribers)]
+    received = threading.Barrier(subscribers + 1)
+    stop = False
+
+    def listen(subscription):
+        while not stop:
+            events, _ = subscription.get(1.0)
+            if events:
+                received.wait()
+
+    threads = [threading.Thread(target=listen, args=(subscription,), daemon=True) for subscription in subscriptions]
+    for thread in threads:
+        thread.start()
+    publish = deliver = 0.0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        feed.publish(db, 1, 'current', EVENT)
+        publish += time.perf_counter() - start
+        received.wait()
+        deliver += time.perf_counter() - start
+    stop = True
+    db.close()
+    return publish / rounds * 1e6, deliver / rounds * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--polls', type=int, default=2000)
+    parser.add_argument('--subscribers', type=int, nargs='+', default=[1, 100, 1000])
+    args = parser.parse_args()
+
+    app.config.update(ADMISSION_ENABLED=False, LOG_LEVEL='WARNING', LOG_PAYLOAD_SAMPLE_RATE=0.0)
+    discard = open(os.devnull, 'w')
+    app_logging.init_app(app, discard)
+    workdir = tempfile.mkdtemp(prefix='weather-feedbench-')
+    print(f'poll (304 revalidation): {poll_cost(workdir, args.polls):8.0f} us per poll per client')
+    for subscribers in args.subscribers:
+        publish, deliver = push_cost(workdir, subscribers)
+        print(f'push to {subscribers:>5} subscribers: publish {publish:8.0f} us, all received {deliver:8.0f} us '
+              f'({deliver / subscribers:.1f} us per subscriber)')
+
+    discard.close()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Size and read speed of a sealed history month: plain rows vs column blocks.
+
+Seeds a database, copies one month of its history into a partition file
+laid out as rows (as an open month is) and into one packed into compressed
+column blocks (as a sealed month is), vacuums both, and times the range
+reads the API does against each: a whole month and a 24 hour window for
+every location. Block reads include decoding into the temp table that
+retention.history_range reads from.
+
+Usage:
+    python benchmarks/bench_cold_blocks.py [--users 100] [--repeat 3]
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import partitions
+from column_blocks import column_codec
+from seed import seed_database
+
+MONTH = 1696118400  # 2023-10-01
+RAW_QUERY = '''
+    SELECT * FROM history.weather_history
+    WHERE location_id = ? AND timestamp >= ? AND timestamp < ?
+'''
+
+
+def build(workdir, users):
+    db = sqlite3.connect(os.path.join(workdir, 'weather.db'))
+    with open(os.path.join(ROOT, 'schema.sql')) as f:
+        db.executescript(f.read())
+    seed_database(db, users=users, history_hours=24 * 40, now=partitions.next_month(MONTH) + 3600)
+    rows_path = os.path.join(workdir, 'rows.db')
+    partition = sqlite3.connect(rows_path)
+    partition.executescript(partitions.PARTITION_SCHEMA)
+    partition.close()
+    db.execute('ATTACH DATABASE ? AS history', (rows_path,))
+    db.execute('''
+        INSERT INTO history.weather_history
+        SELECT id, location_id, timestamp, temperature, feels_like, pressure,
+               humidity, wind_speed, wind_deg, condition_id
+        FROM weather_history WHERE timestamp >= ? AND timestamp < ?
+    ''', (MONTH, partitions.next_month(MONTH)))
+    db.commit()
+    db.execute('DETACH DATABASE history')
+    db.close()
+
+    blocks_path = os.path.join(workdir, 'blocks.db')
+    shutil.copy(rows_path, blocks_path)
+    for path in (rows_path, blocks_path):
+        partition = sqlite3.connect(path)
+        if path == blocks_path:
+            partitions.pack_blocks(partition)
+        partition.execute('VACUUM')
+        partition.close()
+    return rows_path, blocks_path
+
+
+def timed(fn, locations, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for location_id in locations:
+            fn(location_id)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='weather-coldbench-')
+    rows_path, blocks_path = build(workdir, args.users)
+
+    rows_db = sqlite3.connect(':memory:')
+    rows_db.execute('ATTACH DATABASE ? AS history', (partitions.read_only_uri(rows_path, immutable=True),))
+    blocks_db = sqlite3.connect(':memory:')
+    blocks_db.execute('ATTACH DATABASE ? AS history', (partitions.read_only_uri(blocks_path, immutable=True),))
+    locations = [row[0] for row in rows_db.execute('SELECT DISTINCT location_id FROM history.weather_history')]
+    count = rows_db.execute('SELECT COUNT(*) FROM history.weather_history').fetchone()[0]
+    codecs = Counter(column_codec(blob) for block in blocks_db.execute(
+        f"SELECT {', '.join(partitions.BLOCK_COLUMNS)} FROM history.weather_history_blocks") for blob in block)
+
+    print(f'{count} rows, {len(locations)} locations; block column codecs: {dict(codecs)}')
+    print(f"{'':<30} {'rows':>10} {'blocks':>10}")
+    print(f"{'file MB':<30} {os.path.getsize(rows_path) / 1e6:>10.2f} {os.path.getsize(blocks_path) / 1e6:>10.2f}")
+    print(f"{'bytes per observation':<30} {os.path.getsize(rows_path) / count:>10.1f} "
+          f"{os.path.getsize(blocks_path) / count:>10.1f}")
+    for label, start, end in (('whole month', MONTH, partitions.next_month(MONTH)),
+                              ('24h window', MONTH + 10 * 86400, MONTH + 11 * 86400)):
+        rows_ms = timed(lambda location_id: rows_db.execute(RAW_QUERY, (location_id, start, end)).fetchall(),
+                        locations, args.repeat)
+
+        def read_blocks(location_id):
+            partitions.load_blocks(blocks_db, ['history'], location_id, start, end)
+            blocks_db.execute('SELECT * FROM temp.cold_history').fetchall()
+
+        blocks_ms = timed(read_blocks, locations, args.repeat)
+        print(f"{label + f' x {len(locations)} ms':<30} {rows_ms:>10.1f} {blocks_ms:>10.1f}")
+
+    rows_db.close()
+    blocks_db.close()
+    shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
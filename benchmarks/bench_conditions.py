@@ -0,0 +1,110 @@
+"""
+Database size and scan speed with and without dictionary-encoded conditions.
+
+Seeds one database with the current schema (condition ids in the observation
+rows, decoded through the ``*_rows`` views) and copies the same rows into a
+database with the old layout (description and icon text in every row). Both
+files are vacuumed, then the history reads the API does are timed on each.
+
+Usage:
+    python benchmarks/bench_conditions.py [--users 300] [--history-hours 720] [--repeat 5]
+"""
+import argparse
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from seed import seed_database
+
+# (label, SQL on the text layout, SQL on the encoded layout, per-location?)
+QUERIES = [
+    ('full history scan', 'SELECT * FROM weather_history', 'SELECT * FROM weather_history_rows', False),
+    ('24h window x 200 locations',
+     'SELECT * FROM weather_history WHERE location_id = ? ORDER BY timestamp DESC LIMIT 24',
+     'SELECT * FROM weather_history_rows WHERE location_id = ? ORDER BY timestamp DESC LIMIT 24', True),
+    ('count by description',
+     'SELECT description, COUNT(*) FROM weather_history GROUP BY description',
+     # Aggregate the ids, decode the handful of groups afterwards
+     'SELECT c.description, n FROM (SELECT condition_id, COUNT(*) AS n FROM weather_history '
+     'GROUP BY condition_id) LEFT JOIN weather_conditions c ON c.id = condition_id', False),
+]
+
+
+def old_schema(schema):
+    """schema.sql as it was before weather_conditions: text columns, no views."""
+    schema = schema.split('-- Observation rows with description and icon decoded')[0]
+    schema = schema.replace('condition_id INTEGER,', 'description TEXT,\n    icon TEXT,')
+    return re.sub(r',\s*FOREIGN KEY \(condition_id\)[^\n]*', '', schema)
+
+
+def build(workdir, users, history_hours):
+    with open(os.path.join(ROOT, 'schema.sql')) as f:
+        schema = f.read()
+    new_path, old_path = os.path.join(workdir, 'encoded.db'), os.path.join(workdir, 'text.db')
+
+    db = sqlite3.connect(new_path)
+    db.executescript(schema)
+    seed_database(db, users=users, history_hours=history_hours, now=1700000000)
+    db.execute('VACUUM')
+    db.close()
+
+    db = sqlite3.connect(old_path)
+    db.executescript(old_schema(schema))
+    db.execute('ATTACH DATABASE ? AS encoded', (new_path,))
+    for table in ('users', 'favorite_locations'):
+        db.execute(f'INSERT INTO main.{table} SELECT * FROM encoded.{table}')
+    for table in ('current_weather', 'weather_forecast', 'weather_history'):
+        db.execute(f'INSERT INTO main.{table} SELECT * FROM encoded.{table}_rows')
+    db.commit()
+    db.execute('DETACH DATABASE encoded')
+    db.execute('VACUUM')
+    db.close()
+    return old_path, new_path
+
+
+def best_time(db, sql, params_list, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for params in params_list:
+            db.execute(sql, params).fetchall()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--history-hours', type=int, default=24 * 30)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='weather-condbench-')
+    old_path, new_path = build(workdir, args.users, args.history_hours)
+    layouts = [('text columns', old_path), ('condition ids', new_path)]
+
+    print(f"{'':<28} " + ' '.join(f'{name:>14}' for name, _ in layouts))
+    print(f"{'database MB':<28} " + ' '.join(f'{os.path.getsize(path) / 1e6:>14.1f}' for _, path in layouts))
+    connections = [sqlite3.connect(path) for _, path in layouts]
+    locations = [(i,) for i in range(1, 201)]
+    for label, text_sql, encoded_sql, per_location in QUERIES:
+        params = locations if per_location else [()]
+        times = [best_time(db, sql, params, args.repeat)
+                 for db, sql in zip(connections, (text_sql, encoded_sql))]
+        print(f"{label + ' ms':<28} " + ' '.join(f'{ms:>14.1f}' for ms in times))
+
+    for db in connections:
+        db.close()
+    for name in os.listdir(workdir):
+        os.unlink(os.path.join(workdir, name))
+    os.rmdir(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Favorites import and listing for a large account.
+
+Imports the same locations one POST /favorites at a time (a commit each)
+and with a single POST /favorites/batch, into on-disk databases, then times
+reading the account's favorites whole, as one keyset page, as a deep page,
+and as a deep page projected to a few fields.
+
+Usage:
+    python benchmarks/bench_favorites.py [--locations 5000] [--page 100] [--repeat 20]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_logging
+from app import app
+from database import init_db
+
+
+def fresh_client(path):
+    app.config['DATABASE'] = path
+    with app.app_context():
+        init_db()
+    client = app.test_client()
+    client.post('/register', json={'username': 'bench', 'password': 'benchmark'})
+    client.post('/login', json={'username': 'bench', 'password': 'benchmark'})
+    return client
+
+
+def timed(func, repeat=1):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--locations', type=int, default=5000)
+    parser.add_argument('--page', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    app.config.update(ADMISSION_ENABLED=False, LOG_LEVEL='WARNING', LOG_PAYLOAD_SAMPLE_RATE=0.0,
+                      FAVORITES_BATCH_MAX_SIZE=max(args.locations, 5000))
+    discard = open(os.devnull, 'w')
+    app_logging.init_app(app, discard)
+    workdir = tempfile.mkdtemp(prefix='weather-favbench-', dir=os.getcwd())
+    locations = [{'location_name': f'Location {i}', 'latitude': (i % 1400) / 10 - 70,
+                  'longitude': (i % 3600) / 10 - 180} for i in range(args.locations)]
+
+    client = fresh_client(os.path.join(workdir, 'single.db'))
+    single_ms, _ = timed(lambda: [client.post('/favorites', json=location) for location in locations])
+    client = fresh_client(os.path.join(workdir, 'batch.db'))
+    batch_ms, response = timed(lambda: client.post('/favorites/batch', json={'locations': locations}))
+    assert response.get_json()['created'] == args.locations
+    print(f'import {args.locations} locations:')
+    print(f'  one POST each:   {single_ms:10.0f} ms')
+    print(f'  one batch POST:  {batch_ms:10.0f} ms')
+
+    deep = args.locations - args.page
+    reads = [
+        ('whole list', '/favorites'),
+        ('first page', f'/favorites?limit={args.page}'),
+        ('deep page', f'/favorites?after={deep}&limit={args.page}'),
+        ('deep page, fields=latitude,longitude', f'/favorites?after={deep}&limit={args.page}&fields=latitude,longitude'),
+    ]
+    print(f'GET (page of {args.page}):')
+    for label, url in reads:
+        ms, response = timed(lambda: client.get(url), args.repeat)
+        print(f'  {label:<38} {ms:8.2f} ms {len(response.data) / 1024:8.1f} KiB')
+
+    discard.close()
+    shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
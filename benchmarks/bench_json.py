@@ -0,0 +1,92 @@
+"""
+Micro-benchmark for list endpoint serialization and compression.
+
+Compares Flask's default ``jsonify([dict(row) for row in rows])`` against the
+row encoders in ``json_provider.RowJSONProvider`` and reports bytes on the wire
+with and without compression.
+
+Usage:
+    python benchmarks/bench_json.py [--rows 24 1000 20000] [--repeat 20]
+"""
+import argparse
+import gzip
+import json
+import os
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from json_provider import RowJSONProvider, orjson
+from compression import brotli
+from conditions import ConditionEncoder
+
+DESCRIPTIONS = [('clear sky', '01d'), ('few clouds', '02d'), ('light rain', '10n'),
+                ('overcast clouds', '04d'), ('broken clouds', '04n')]
+
+
+def make_rows(count):
+    db = sqlite3.connect(':memory:')
+    db.row_factory = sqlite3.Row
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'schema.sql')) as f:
+        db.executescript(f.read())
+    encode_condition = ConditionEncoder(db)
+    db.executemany('''
+        INSERT INTO weather_history
+        (location_id, timestamp, temperature, feels_like, pressure, humidity,
+        wind_speed, wind_deg, condition_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [
+        (1, 1684926000 + i * 3600, 15 + (i % 24) * 0.37, 14 + (i % 24) * 0.35,
+         1000 + i % 30, 40 + i % 50, round(2 + (i % 11) * 0.41, 2), (i * 7) % 360,
+         encode_condition(*DESCRIPTIONS[i % len(DESCRIPTIONS)]))
+        for i in range(count)
+    ])
+    return db.execute('SELECT * FROM weather_history_rows ORDER BY timestamp DESC').fetchall()
+
+
+def time_per_row(fn, rows, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(rows)
+        best = min(best, time.perf_counter() - start)
+    return best / len(rows) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, nargs='+', default=[24, 1000, 20000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    candidates = {
+        'default (dict + json.dumps)': lambda rows: json.dumps(
+            [dict(r) for r in rows], sort_keys=True, separators=(',', ':')),
+    }
+    app.config['JSON_ROW_ENCODER'] = 'template'
+    candidates['RowJSONProvider template'] = RowJSONProvider(app).dumps
+    if orjson is not None:
+        app.config['JSON_ROW_ENCODER'] = 'orjson'
+        candidates['RowJSONProvider orjson'] = RowJSONProvider(app).dumps
+
+    for count in args.rows:
+        rows = make_rows(count)
+        print(f"\n=== {count} rows ===")
+        print("Serialization (best of %d):" % args.repeat)
+        for name, fn in candidates.items():
+            print(f"  {name:<30} {time_per_row(fn, rows, args.repeat):8.3f} us/row")
+
+        body = candidates['RowJSONProvider template'](rows).encode()
+        print("Bytes on the wire:")
+        print(f"  {'identity':<30} {len(body):>10}")
+        print(f"  {'gzip (level 6)':<30} {len(gzip.compress(body, 6, mtime=0)):>10}")
+        if brotli is not None:
+            print(f"  {'br (quality 4)':<30} {len(brotli.compress(body, quality=4)):>10}")
+
+
+if __name__ == '__main__':
+    main()
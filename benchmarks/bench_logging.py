@@ -0,0 +1,104 @@
+"""
+Request throughput with different logging setups.
+
+Drives the app in-process through the test client and compares the old
+behaviour (synchronous text logging of every payload) with the queued JSON
+logger, with and without payload logging, and with INFO logging disabled.
+Logs go to a temporary file so the cost of writing them is included; each
+setup gets a fresh database (in /dev/shm where available, so fsync does not
+drown out the logging cost).
+
+Usage:
+    python benchmarks/bench_logging.py [--requests 300] [--rows 200]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_logging
+from app import app
+from database import init_db
+
+SETUPS = [
+    ('sync text, all payloads', dict(LOG_ASYNC=False, LOG_FORMAT='text', LOG_PAYLOAD_SAMPLE_RATE=1.0)),
+    ('async json, all payloads', dict(LOG_ASYNC=True, LOG_FORMAT='json', LOG_PAYLOAD_SAMPLE_RATE=1.0)),
+    ('async json, 1% payloads', dict(LOG_ASYNC=True, LOG_FORMAT='json', LOG_PAYLOAD_SAMPLE_RATE=0.01)),
+    ('async json, no payloads', dict(LOG_ASYNC=True, LOG_FORMAT='json', LOG_PAYLOAD_SAMPLE_RATE=0.0)),
+    ('INFO disabled', dict(LOG_ASYNC=True, LOG_FORMAT='json', LOG_PAYLOAD_SAMPLE_RATE=0.0, LOG_LEVEL='WARNING')),
+]
+
+
+def history_payload(rows):
+    return {'hourly': [{
+        'dt': 1684926000 + hour * 3600, 'temp': 18.5, 'feels_like': 19.0, 'pressure': 1012,
+        'humidity': 75, 'wind_speed': 3.1, 'wind_deg': 270,
+        'weather': [{'description': 'light rain', 'icon': '10n'}]
+    } for hour in range(rows)]}
+
+
+def fresh_client(path):
+    if os.path.exists(path):
+        os.unlink(path)
+    app.config['DATABASE'] = path
+    with app.app_context():
+        init_db()
+    client = app.test_client()
+    client.post('/register', json={'username': 'bench', 'password': 'benchmark'})
+    client.post('/login', json={'username': 'bench', 'password': 'benchmark'})
+    client.post('/favorites', json={'location_name': 'Paris', 'latitude': 48.8575, 'longitude': 2.3514})
+    return client
+
+
+def measure(client, count, request):
+    start = time.perf_counter()
+    for _ in range(count):
+        request(client)
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--rows', type=int, default=200, help='rows per history POST')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='weather-logbench-',
+                               dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    payload = history_payload(args.rows)
+
+    workloads = {
+        'POST /weather/history': lambda c: c.post('/weather/history/1', json=payload),
+        'GET /favorites': lambda c: c.get('/favorites'),
+    }
+    defaults = {key: app.config[key] for key in
+                ('LOG_ASYNC', 'LOG_FORMAT', 'LOG_PAYLOAD_SAMPLE_RATE', 'LOG_LEVEL')}
+    # Logs of the setup requests between measurements are discarded
+    discard = open(os.devnull, 'w')
+    app_logging.init_app(app, discard)
+
+    print(f"{'setup':<26} " + ' '.join(f"{name + ' req/s':>28}" for name in workloads) + f" {'log MB':>8}")
+    for name, config in SETUPS:
+        log_path = os.path.join(workdir, 'app.log')
+        client = fresh_client(os.path.join(workdir, 'weather.db'))
+        with open(log_path, 'w') as stream:
+            app.config.update(defaults, **config)
+            app_logging.init_app(app, stream)
+            for request in workloads.values():
+                measure(client, 10, request)
+            rates = [measure(client, args.requests, request) for request in workloads.values()]
+            app_logging.init_app(app, discard)
+        size = os.path.getsize(log_path) / 1e6
+        print(f"{name:<26} " + ' '.join(f"{rate:>28.0f}" for rate in rates) + f" {size:>8.1f}")
+
+    discard.close()
+    for name in os.listdir(workdir):
+        os.unlink(os.path.join(workdir, name))
+    os.rmdir(workdir)
+
+
+if __name__ == '__main__':
+    main()
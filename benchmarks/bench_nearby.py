@@ -0,0 +1,102 @@
+"""
+Nearby-location search with the R*Tree against a full scan.
+
+Fills favorite_locations with random points (half of them clustered around
+a few cities, like real favorites) and times, per query point, the old way
+(fetch every location and compute distances in Python) and
+geo.nearby_locations on the R*Tree that schema.sql keeps in sync.
+
+Usage:
+    python benchmarks/bench_nearby.py [--locations 1000000] [--queries 200] [--radius-km 25]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from geo import haversine_km, nearby_locations
+
+CITIES = [(48.8575, 2.3514), (40.7128, -74.006), (35.6762, 139.6503), (-33.8688, 151.2093), (51.5072, -0.1276)]
+
+
+def build(path, count, rng):
+    db = sqlite3.connect(path)
+    with open(os.path.join(ROOT, 'schema.sql')) as f:
+        db.executescript(f.read())
+    db.execute('PRAGMA synchronous = OFF')
+
+    def point(index):
+        if index % 2:
+            lat, lon = CITIES[index % len(CITIES)]
+            return round(rng.gauss(lat, 0.5), 5), round(rng.gauss(lon, 0.5), 5)
+        return round(rng.uniform(-60, 70), 5), round(rng.uniform(-180, 180), 5)
+
+    db.executemany(
+        'INSERT INTO favorite_locations (user_id, location_name, latitude, longitude) VALUES (?, ?, ?, ?)',
+        ((index % 1000 + 1, f'Location {index}', *point(index)) for index in range(count))
+    )
+    db.commit()
+    db.row_factory = sqlite3.Row
+    return db
+
+
+def full_scan(db, lat, lon, radius_km, limit):
+    found = []
+    for row in db.execute('SELECT id, user_id, location_name, latitude, longitude FROM favorite_locations'):
+        distance = haversine_km(lat, lon, row['latitude'], row['longitude'])
+        if distance <= radius_km:
+            found.append((distance, row['id'], row))
+    found.sort(key=lambda match: match[:2])
+    return [(distance, row) for distance, _, row in found[:limit]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--locations', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--radius-km', type=float, default=25.0)
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--scan-queries', type=int, default=3, help='queries timed with the full scan')
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    workdir = tempfile.mkdtemp(prefix='weather-geobench-')
+    path = os.path.join(workdir, 'weather.db')
+    start = time.perf_counter()
+    db = build(path, args.locations, rng)
+    print(f'Inserted {args.locations} locations (with R*Tree triggers) in {time.perf_counter() - start:.1f} s, '
+          f'{os.path.getsize(path) / 1e6:.0f} MB')
+
+    points = [(rng.gauss(lat, 0.3), rng.gauss(lon, 0.3)) for lat, lon in CITIES] * (args.queries // len(CITIES))
+    points += [(rng.uniform(-60, 70), rng.uniform(-180, 180)) for _ in range(args.queries - len(points))]
+    for lat, lon in points[:args.scan_queries]:
+        assert ([row['id'] for _, row in full_scan(db, lat, lon, args.radius_km, args.limit)]
+                == [row['id'] for _, row in nearby_locations(db, lat, lon, args.radius_km, args.limit)])
+
+    start = time.perf_counter()
+    for lat, lon in points[:args.scan_queries]:
+        full_scan(db, lat, lon, args.radius_km, args.limit)
+    scan_ms = (time.perf_counter() - start) / args.scan_queries * 1000
+    timings = []
+    for lat, lon in points:
+        start = time.perf_counter()
+        nearby_locations(db, lat, lon, args.radius_km, args.limit)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    print(f'full scan:  {scan_ms:10.2f} ms per query')
+    print(f'R*Tree:     {sum(timings) / len(timings):10.3f} ms per query '
+          f'(p50 {timings[len(timings) // 2]:.3f}, p99 {timings[int(len(timings) * 0.99)]:.3f})')
+
+    db.close()
+    os.unlink(path)
+    os.rmdir(workdir)
+
+
+if __name__ == '__main__':
+    main()
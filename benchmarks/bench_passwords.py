@@ -0,0 +1,96 @@
+"""
+Login throughput per password hasher, and what a login flood does to other routes.
+
+Logs in from --clients threads (test clients) for --seconds against an
+on-disk database, while one more thread keeps reading GET /favorites, for:
+  - the original single SHA-256,
+  - PBKDF2 and scrypt at their default cost, hashing on a pool of
+    --workers threads (PASSWORD_HASH_WORKERS), and
+  - PBKDF2 with a pool as large as the number of clients, i.e. every login
+    hashing at once as it did on the request thread.
+
+Usage:
+    python benchmarks/bench_passwords.py [--clients 8] [--workers 1] [--seconds 5]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_logging
+import passwords
+from app import app
+from database import init_db
+
+
+def run(path, label, hasher, params, workers, clients, seconds):
+    app.config.update(PASSWORD_HASHER=hasher, PASSWORD_HASHER_PARAMS=params, DATABASE=path)
+    app.extensions['password_hashing'] = passwords.HashPool(workers, 4 * clients, 30.0)
+    with app.app_context():
+        init_db()
+    reader = app.test_client()
+    reader.post('/register', json={'username': 'bench', 'password': 'benchmark'})
+    reader.post('/login', json={'username': 'bench', 'password': 'benchmark'})
+    reader.post('/favorites', json={'location_name': 'Paris', 'latitude': 48.8575, 'longitude': 2.3514})
+
+    deadline = time.monotonic() + seconds
+    logins = [0] * clients
+    reads = []
+
+    def log_in(index):
+        client = app.test_client()
+        while time.monotonic() < deadline:
+            response = client.post('/login', json={'username': 'bench', 'password': 'benchmark'})
+            assert response.status_code == 200, response.status_code
+            logins[index] += 1
+
+    def read():
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            assert reader.get('/favorites').status_code == 200
+            reads.append((time.perf_counter() - start) * 1000)
+
+    threads = [threading.Thread(target=log_in, args=(index,)) for index in range(clients)]
+    threads.append(threading.Thread(target=read))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    reads.sort()
+    print(f'{label:<28} {sum(logins) / seconds:8.1f} logins/s   GET /favorites p50 '
+          f'{reads[len(reads) // 2]:7.1f} ms, p99 {reads[int(len(reads) * 0.99)]:7.1f} ms ({len(reads)} reads)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    args = parser.parse_args()
+
+    app.config.update(ADMISSION_ENABLED=False, LOG_LEVEL='WARNING', LOG_PAYLOAD_SAMPLE_RATE=0.0)
+    discard = open(os.devnull, 'w')
+    app_logging.init_app(app, discard)
+    workdir = tempfile.mkdtemp(prefix='weather-pwbench-')
+    for hasher_class in (passwords.Sha256Hasher, passwords.Pbkdf2Hasher, passwords.ScryptHasher):
+        print(f'{hasher_class().prefix:<28} {passwords.time_hash(hasher_class()) * 1000:8.2f} ms per hash')
+    runs = [
+        ('sha256 (original)', 'sha256', {}, args.workers),
+        (f'pbkdf2, {args.workers} hash worker(s)', 'pbkdf2_sha256', {}, args.workers),
+        (f'scrypt, {args.workers} hash worker(s)', 'scrypt', {}, args.workers),
+        (f'pbkdf2, {args.clients} hash workers', 'pbkdf2_sha256', {}, args.clients),
+    ]
+    for index, (label, hasher, params, workers) in enumerate(runs):
+        run(os.path.join(workdir, f'{index}.db'), label, hasher, params, workers, args.clients, args.seconds)
+
+    discard.close()
+    shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
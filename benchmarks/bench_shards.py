@@ -0,0 +1,96 @@
+"""
+Concurrent write throughput with and without location-sharded storage.
+
+Writer threads each POST hourly history for their own favorite location
+through the test client, against an on-disk database (so every commit
+pays for its journal and fsync). Unsharded, all of them queue on the main
+database's single write lock; with SHARDS set, writers of locations in
+different shard files commit in parallel. Admission control is disabled
+so it does not cap the concurrency being measured.
+
+Usage:
+    python benchmarks/bench_shards.py [--writers 8] [--requests 50] [--rows 24] [--shards 0 4]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_logging
+from app import app
+from database import init_db
+
+
+def history_payload(rows, offset):
+    return {'hourly': [{
+        'dt': 1684926000 + (offset + hour) * 3600, 'temp': 18.5, 'feels_like': 19.0, 'pressure': 1012,
+        'humidity': 75, 'wind_speed': 3.1, 'wind_deg': 270,
+        'weather': [{'description': 'light rain', 'icon': '10n'}]
+    } for hour in range(rows)]}
+
+
+def setup(workdir, shards, writers):
+    app.config.update(DATABASE=os.path.join(workdir, f'weather-{shards}.db'), SHARDS=shards)
+    with app.app_context():
+        init_db()
+    client = app.test_client()
+    client.post('/register', json={'username': 'bench', 'password': 'benchmark'})
+    client.post('/login', json={'username': 'bench', 'password': 'benchmark'})
+    for index in range(writers):
+        client.post('/favorites', json={'location_name': f'Location {index}', 'latitude': 0, 'longitude': 0})
+
+
+def run(writers, count, rows):
+    statuses = []
+    barrier = threading.Barrier(writers + 1)
+
+    def writer(location_id):
+        client = app.test_client()
+        client.post('/login', json={'username': 'bench', 'password': 'benchmark'})
+        barrier.wait()
+        for request in range(count):
+            response = client.post(f'/weather/history/{location_id}',
+                                   json=history_payload(rows, request * rows))
+            statuses.append(response.status_code)
+
+    threads = [threading.Thread(target=writer, args=(location_id,)) for location_id in range(1, writers + 1)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return statuses.count(200) / elapsed, len(statuses) - statuses.count(200)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=50, help='POSTs per writer')
+    parser.add_argument('--rows', type=int, default=24, help='rows per history POST')
+    parser.add_argument('--shards', type=int, nargs='+', default=[0, 4])
+    args = parser.parse_args()
+
+    app.config.update(ADMISSION_ENABLED=False, LOG_LEVEL='WARNING', LOG_PAYLOAD_SAMPLE_RATE=0.0)
+    discard = open(os.devnull, 'w')
+    app_logging.init_app(app, discard)
+    workdir = tempfile.mkdtemp(prefix='weather-shardbench-', dir=os.getcwd())
+
+    print(f"{'shards':>6} {'writers':>8} {'ok req/s':>10} {'failed':>8}")
+    for shards in args.shards:
+        setup(workdir, shards, args.writers)
+        rate, failed = run(args.writers, args.requests, args.rows)
+        print(f"{shards:>6} {args.writers:>8} {rate:>10.0f} {failed:>8}")
+
+    discard.close()
+    shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
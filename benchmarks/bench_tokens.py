@@ -0,0 +1,71 @@
+"""
+Authenticating machine clients: logging in per job against API tokens.
+
+Times, through the test client against an on-disk database:
+  - a refresh job that logs in (POST /login) and then makes one request,
+  - one GET /favorites with a session cookie,
+  - one GET /favorites with a bearer token verified from the cache, and
+  - the same with API_TOKEN_CACHE_TTL=0, so every request looks the token up.
+
+Usage:
+    python benchmarks/bench_tokens.py [--requests 2000]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_logging
+import tokens
+from app import app
+from database import init_db
+
+
+def per_request(func, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        assert func().status_code == 200
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    app.config.update(ADMISSION_ENABLED=False, LOG_LEVEL='WARNING', LOG_PAYLOAD_SAMPLE_RATE=0.0)
+    discard = open(os.devnull, 'w')
+    app_logging.init_app(app, discard)
+    workdir = tempfile.mkdtemp(prefix='weather-tokenbench-')
+    app.config['DATABASE'] = os.path.join(workdir, 'weather.db')
+    with app.app_context():
+        init_db()
+    client = app.test_client()
+    client.post('/register', json={'username': 'bench', 'password': 'benchmark'})
+    client.post('/login', json={'username': 'bench', 'password': 'benchmark'})
+    client.post('/favorites', json={'location_name': 'Paris', 'latitude': 48.8575, 'longitude': 2.3514})
+    token = client.post('/tokens', json={'name': 'bench'}).get_json()['token']
+    headers = {'Authorization': f'Bearer {token}'}
+    machine = app.test_client()
+
+    def login_job():
+        job = app.test_client()
+        job.post('/login', json={'username': 'bench', 'password': 'benchmark'})
+        return job.get('/favorites')
+
+    print(f'login + GET per job:       {per_request(login_job, args.requests // 4):8.0f} us')
+    print(f'GET, session cookie:       {per_request(lambda: client.get("/favorites"), args.requests):8.0f} us')
+    print(f'GET, token (cached):       {per_request(lambda: machine.get("/favorites", headers=headers), args.requests):8.0f} us')
+    app.extensions['api_tokens'] = tokens.TokenCache(0, 1)
+    print(f'GET, token (TTL 0, lookup): {per_request(lambda: machine.get("/favorites", headers=headers), args.requests):7.0f} us')
+
+    discard.close()
+    shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
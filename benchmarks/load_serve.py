@@ -0,0 +1,139 @@
+"""
+Load test for the gunicorn entry point in serve.py.
+
+Starts ``serve.py`` on a temporary database once per worker count, drives
+``GET /weather/history/<id>`` from several client processes and prints
+throughput, so scaling with cores is visible. With ``--reload`` the server
+is sent SIGHUP halfway through each run and failed requests are counted to
+check that the graceful reload drops nothing.
+
+Usage:
+    python benchmarks/load_serve.py [--workers 1 2 4] [--clients 8] [--duration 10] [--reload]
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+HISTORY = {
+    'hourly': [{
+        'dt': 1684926000 + hour * 3600,
+        'temp': 15 + hour * 0.4,
+        'feels_like': 14 + hour * 0.4,
+        'pressure': 1012,
+        'humidity': 70,
+        'wind_speed': 3.1,
+        'wind_deg': 270,
+        'weather': [{'description': 'light rain', 'icon': '10n'}]
+    } for hour in range(24)]
+}
+
+
+def create_database(path):
+    from app import app
+    from database import init_db
+    app.config['DATABASE'] = path
+    with app.app_context():
+        init_db()
+
+
+def wait_until_healthy(base_url, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(f"{base_url}/health", timeout=1).status_code == 200:
+                return
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"server at {base_url} did not become healthy")
+
+
+def seed(base_url):
+    session = requests.Session()
+    session.post(f"{base_url}/register", json={'username': 'loadtest', 'password': 'loadtest'})
+    session.post(f"{base_url}/login", json={'username': 'loadtest', 'password': 'loadtest'})
+    session.post(f"{base_url}/favorites", json={
+        'location_name': 'Boston', 'latitude': 42.3601, 'longitude': -71.0589
+    })
+    location_id = session.get(f"{base_url}/favorites").json()[0]['id']
+    session.post(f"{base_url}/weather/history/{location_id}", json=HISTORY)
+    return location_id
+
+
+def client(args):
+    base_url, location_id, duration = args
+    session = requests.Session()
+    session.post(f"{base_url}/login", json={'username': 'loadtest', 'password': 'loadtest'})
+    url = f"{base_url}/weather/history/{location_id}"
+    ok = failed = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        try:
+            if session.get(url).status_code == 200:
+                ok += 1
+            else:
+                failed += 1
+        except requests.RequestException:
+            failed += 1
+    return ok, failed
+
+
+def run(workers, clients, duration, port, reload):
+    db_fd, db_path = tempfile.mkstemp(suffix='.db')
+    os.close(db_fd)
+    create_database(db_path)
+    base_url = f"http://127.0.0.1:{port}"
+    env = dict(os.environ, WEATHER_DATABASE=f'"{db_path}"')
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'serve.py'),
+         '--bind', f'127.0.0.1:{port}', '--workers', str(workers)],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_until_healthy(base_url)
+        location_id = seed(base_url)
+        with multiprocessing.Pool(clients) as pool:
+            result = pool.map_async(client, [(base_url, location_id, duration)] * clients)
+            if reload:
+                time.sleep(duration / 2)
+                server.send_signal(signal.SIGHUP)
+            counts = result.get()
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+        os.unlink(db_path)
+
+    ok = sum(c[0] for c in counts)
+    failed = sum(c[1] for c in counts)
+    return ok / duration, failed
+
+
+def main():
+    cores = multiprocessing.cpu_count()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({1, 2, cores, cores * 2}))
+    parser.add_argument('--clients', type=int, default=max(4, cores * 2))
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--reload', action='store_true', help='send SIGHUP mid-run')
+    args = parser.parse_args()
+
+    print(f"{cores} cores, {args.clients} client processes, {args.duration}s per run")
+    print(f"{'workers':>8} {'req/s':>10} {'failed':>8}")
+    for workers in args.workers:
+        throughput, failed = run(workers, args.clients, args.duration, args.port, args.reload)
+        print(f"{workers:>8} {throughput:>10.1f} {failed:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+"""
+Reproducible load test for the weather API.
+
+Creates a temporary database, seeds it with ``seed.seed_database`` (thousands
+of users and favorites, millions of history rows at the default scale), starts
+the app with ``serve.py`` and drives a weighted mix of register / login /
+favorites / weather requests from a pool of client threads. Reports p50, p95,
+p99 and throughput per route and saves them as JSON. The app itself never
+calls OpenWeatherMap, so no upstream is needed for this mix.
+
+Usage:
+    python benchmarks/loadtest.py --output results.json
+    python benchmarks/loadtest.py --output new.json --compare results.json
+
+Scale with --users / --favorites-per-user / --history-hours; use the same
+--seed (and scale) for runs that are compared.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from seed import seed_database, seed_user_name, seed_favorite_ids, SEED_PASSWORD
+
+# (name, weight): the share of each operation in the mix
+DEFAULT_MIX = {
+    'register': 1,
+    'login': 4,
+    'favorites': 20,
+    'current': 30,
+    'forecast': 15,
+    'history': 25,
+    'store_current': 5,
+}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def create_database(path, args):
+    import sqlite3
+    db = sqlite3.connect(path)
+    with open(os.path.join(ROOT, 'schema.sql')) as f:
+        db.executescript(f.read())
+    summary = seed_database(db, args.users, args.favorites_per_user, args.history_hours, seed=args.seed)
+    db.close()
+    return summary
+
+
+def start_server(db_path, args):
+    env = dict(os.environ, WEATHER_DATABASE=json.dumps(db_path))
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'serve.py'), '--bind', f'127.0.0.1:{args.port}',
+         '--workers', str(args.workers), '--threads', str(args.threads)],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    base_url = f'http://127.0.0.1:{args.port}'
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if requests.get(f'{base_url}/health', timeout=1).status_code == 200:
+                return server, base_url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('server did not start')
+
+
+class Client:
+    """One simulated user issuing requests from the mix."""
+
+    def __init__(self, base_url, summary, rng, worker_id):
+        self.base_url = base_url
+        self.summary = summary
+        self.rng = rng
+        self.worker_id = worker_id
+        self.registered = 0
+        self.session = requests.Session()
+        self.login()
+
+    def login(self):
+        self.user_index = self.rng.randrange(self.summary['users'])
+        self.location_ids = seed_favorite_ids(self.user_index, self.summary['favorites_per_user'])
+        return self.session.post(f'{self.base_url}/login', json={
+            'username': seed_user_name(self.user_index), 'password': SEED_PASSWORD
+        })
+
+    def run(self, operation):
+        location_id = self.rng.choice(self.location_ids)
+        if operation == 'register':
+            self.registered += 1
+            return requests.post(f'{self.base_url}/register', json={
+                'username': f'load-{self.worker_id}-{self.registered}-{time.time_ns()}',
+                'password': SEED_PASSWORD
+            })
+        if operation == 'login':
+            return self.login()
+        if operation == 'favorites':
+            return self.session.get(f'{self.base_url}/favorites')
+        if operation == 'store_current':
+            return self.session.post(f'{self.base_url}/weather/current/{location_id}', json={
+                'current': {
+                    'dt': int(time.time()), 'temp': 20.5, 'feels_like': 21.0, 'pressure': 1013,
+                    'humidity': 65, 'wind_speed': 5.2, 'wind_deg': 180,
+                    'weather': [{'description': 'clear sky', 'icon': '01d'}]
+                }
+            })
+        return self.session.get(f'{self.base_url}/weather/{operation}/{location_id}')
+
+
+def drive(base_url, summary, args, mix):
+    operations = list(mix)
+    weights = [mix[name] for name in operations]
+    latencies = {name: [] for name in operations}
+    errors = {name: 0 for name in operations}
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + args.warmup + args.duration
+    measure_from = time.perf_counter() + args.warmup
+
+    def worker(worker_id):
+        rng = random.Random(args.seed * 1000 + worker_id)
+        client = Client(base_url, summary, rng, worker_id)
+        local_latencies = {name: [] for name in operations}
+        local_errors = {name: 0 for name in operations}
+        while True:
+            operation = rng.choices(operations, weights)[0]
+            start = time.perf_counter()
+            if start >= stop_at:
+                break
+            try:
+                ok = client.run(operation).status_code < 400
+            except requests.RequestException:
+                ok = False
+            end = time.perf_counter()
+            if start >= measure_from:
+                local_latencies[operation].append(end - start)
+                if not ok:
+                    local_errors[operation] += 1
+        with lock:
+            for name in operations:
+                latencies[name].extend(local_latencies[name])
+                errors[name] += local_errors[name]
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors
+
+
+def summarize(latencies, errors, duration):
+    routes = {}
+    for name, values in latencies.items():
+        values.sort()
+        routes[name] = {
+            'requests': len(values),
+            'errors': errors[name],
+            'throughput_rps': len(values) / duration,
+            'p50_ms': percentile(values, 0.50) and percentile(values, 0.50) * 1000,
+            'p95_ms': percentile(values, 0.95) and percentile(values, 0.95) * 1000,
+            'p99_ms': percentile(values, 0.99) and percentile(values, 0.99) * 1000,
+        }
+    total = sum(route['requests'] for route in routes.values())
+    return {'routes': routes, 'total_requests': total, 'throughput_rps': total / duration}
+
+
+def print_results(results):
+    print(f"\n{'route':<15} {'req':>8} {'err':>6} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, route in results['routes'].items():
+        if not route['requests']:
+            continue
+        print(f"{name:<15} {route['requests']:>8} {route['errors']:>6} {route['throughput_rps']:>9.1f} "
+              f"{route['p50_ms']:>9.2f} {route['p95_ms']:>9.2f} {route['p99_ms']:>9.2f}")
+    print(f"{'total':<15} {results['total_requests']:>8} {'':>6} {results['throughput_rps']:>9.1f}")
+
+
+def compare(results, baseline, threshold):
+    """Print per-route changes against a baseline run; return True if anything regressed."""
+    regressed = False
+    print(f"\nComparison with baseline (regression threshold {threshold:.0f}%):")
+    for name, route in results['routes'].items():
+        old = baseline['routes'].get(name)
+        if not old or not old['requests'] or not route['requests']:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms'):
+            change = (route[metric] - old[metric]) / old[metric] * 100
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressed = True
+            print(f"  {name:<15} {metric:<7} {old[metric]:>9.2f} -> {route[metric]:>9.2f} ({change:+.1f}%){flag}")
+        change = (route['throughput_rps'] - old['throughput_rps']) / old['throughput_rps'] * 100
+        flag = ''
+        if change < -threshold:
+            flag = '  REGRESSION'
+            regressed = True
+        print(f"  {name:<15} {'req/s':<7} {old['throughput_rps']:>9.1f} -> {route['throughput_rps']:>9.1f} "
+              f"({change:+.1f}%){flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--favorites-per-user', type=int, default=3)
+    parser.add_argument('--history-hours', type=int, default=24 * 180,
+                        help='history rows per location (default ~2.6M rows in total)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=3)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--port', type=int, default=5056)
+    parser.add_argument('--mix', type=json.loads, default=DEFAULT_MIX,
+                        help='JSON object of operation weights, e.g. \'{"history": 1}\'')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to compare against')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='percent change counted as a regression')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='weather-loadtest-')
+    db_path = os.path.join(workdir, 'weather.db')
+    print(f"Seeding {db_path} ...")
+    start = time.perf_counter()
+    summary = create_database(db_path, args)
+    print(f"Seeded {summary['users']} users, {summary['locations']} locations, "
+          f"{summary['history_rows']} history rows in {time.perf_counter() - start:.1f}s")
+
+    server, base_url = start_server(db_path, args)
+    try:
+        print(f"Driving {args.concurrency} clients for {args.duration}s (+{args.warmup}s warmup) ...")
+        latencies, errors = drive(base_url, summary, args, args.mix)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+        for name in os.listdir(workdir):
+            os.unlink(os.path.join(workdir, name))
+        os.rmdir(workdir)
+
+    results = summarize(latencies, errors, args.duration)
+    results['config'] = {key: value for key, value in vars(args).items()
+                         if key not in ('output', 'compare')}
+    results['dataset'] = summary
+    results['environment'] = {'python': platform.python_version(), 'platform': platform.platform(),
+                              'cpus': os.cpu_count()}
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+"""
+Change feed pushing new weather observations to subscribers of every process.
+
+The weather POST handlers publish one event per committed write by
+appending it to the weather_events table of the main database, whose ids
+order the feed across all gunicorn workers. Each process reads new events
+with one query per poll (woken at once by its own writes) and hands every
+event, serialized once, to the subscriptions of its location, each a bounded
+buffer read by a GET /weather/stream (Server-Sent Events) or
+GET /weather/updates (long-poll) request. A subscriber that falls behind
+loses its oldest events and is told so, instead of growing without bound.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict, deque
+from flask import current_app, jsonify
+from database import get_db
+
+
+
+class Event:
+    """
+    One published change.
+
+    Args:
+        seq (int): Position in the feed, increasing by one per event
+        location_id (int): The location whose weather changed
+        kind (str): "current", "forecast" or "history"
+        data (dict): The event body, sent to clients as JSON
+    """
+
+    def __init__(self, seq, location_id, kind, data):
+        self.seq = seq
+        self.location_id = location_id
+        self.kind = kind
+        self.data = data
+        # Encoded once here and shared by every stream it is sent to
+        self.sse = f'id: {seq}\nevent: {kind}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'.encode()
+
+    def to_json(self):
+        return {"id": self.seq, "location_id": self.location_id, "kind": self.kind, "data": self.data}
+
+
+class Subscription:
+    """
+    A bounded buffer of events for a set of locations.
+
+    Args:
+        location_ids (frozenset): Locations whose events are delivered
+        buffer_size (int): Events kept before the oldest are dropped
+    """
+
+    def __init__(self, location_ids, buffer_size):
+        self.location_ids = location_ids
+        self.events = deque(maxlen=buffer_size)
+        self.dropped = 0
+        # Feed position when subscribing: every earlier event of these
+        # locations has been replayed or was never asked for
+        self.cursor = 0
+        self._cond = threading.Condition()
+
+    def put(self, event):
+        with self._cond:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            self.events.append(event)
+            self._cond.notify()
+
+    def skip(self, count):
+        """Count events that were lost before they could be buffered."""
+        with self._cond:
+            self.dropped += count
+            self._cond.notify()
+
+    def get(self, timeout):
+        """
+        Wait up to ``timeout`` seconds for events.
+
+        Returns:
+            tuple: ``(events, dropped)``, the buffered events (possibly none)
+            and how many were dropped since the last call
+        """
+        with self._cond:
+            if not self.events:
+                self._cond.wait(timeout)
+            events = list(self.events)
+            self.events.clear()
+            dropped, self.dropped = self.dropped, 0
+        return events, dropped
+
+
+class FeedFull(Exception):
+    """Raised by ChangeFeed.subscribe when the process has max_clients subscriptions."""
+
+
+class ChangeFeed:
+    """
+    Routes the events of the weather_events table to the subscriptions of their location.
+
+    The newest ``history_size`` events are kept in the table, so a client
+    reconnecting with the id of the last event it saw (SSE Last-Event-ID, or
+    ``since`` when long-polling) receives what it missed, whichever process
+    it reconnects to.
+
+    Args:
+        connect (callable): Opens a connection to the main database, for the
+            background thread reading new events
+        buffer_size (int): Per-subscription buffer, see Subscription
+        history_size (int): Recent events kept for reconnecting clients
+        max_clients (int): Subscriptions allowed at once (0 = no limit)
+        poll_interval (float): Seconds between reads of events published by
+            other processes
+    """
+
+    def __init__(self, connect, buffer_size=64, history_size=1024, max_clients=0, poll_interval=0.25):
+        self.connect = connect
+        self.buffer_size = buffer_size
+        self.history_size = history_size
+        self.max_clients = max_clients
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set)
+        self._clients = set()
+        self._wake = threading.Event()
+        self._poller_pid = None
+        # Id of the newest event handed to the subscriptions
+        self.last_seq = 0
+
+    def publish(self, db, location_id, kind, data):
+        """
+        Append an event for every process's subscriptions of the location.
+
+        Args:
+            db (sqlite3.Connection): The main database connection, with no
+                transaction open (the event is committed on its own)
+
+        Returns:
+            Event: The published event
+        """
+        seq = db.execute('INSERT INTO weather_events (location_id, kind, data) VALUES (?, ?, ?)',
+                         (location_id, kind, json.dumps(data, separators=(",", ":")))).lastrowid
+        db.execute('DELETE FROM weather_events WHERE id <= ?', (seq - self.history_size,))
+        db.commit()
+        self._wake.set()
+        return Event(seq, location_id, kind, data)
+
+    def poll(self, db):
+        """
+        Hand the events published since the last poll to the subscriptions.
+
+        Returns:
+            int: Events read
+        """
+        rows = db.execute('SELECT id, location_id, kind, data FROM weather_events WHERE id > ? ORDER BY id',
+                          (self.last_seq,)).fetchall()
+        events = [Event(seq, location_id, kind, json.loads(data)) for seq, location_id, kind, data in rows]
+        with self._lock:
+            # Trimmed by publishers before this process read them
+            missed = events[0].seq - self.last_seq - 1 if events else 0
+            if missed > 0:
+                for subscription in self._clients:
+                    subscription.skip(missed)
+            for event in events:
+                for subscription in self._subscriptions.get(event.location_id, ()):
+                    # Newer than what subscribe already replayed
+                    if event.seq > subscription.cursor:
+                        subscription.put(event)
+            if events:
+                self.last_seq = max(self.last_seq, events[-1].seq)
+        return len(events)
+
+    def _run_poller(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            if not self._clients:
+                continue
+            try:
+                db = self.connect()
+                try:
+                    self.poll(db)
+                finally:
+                    db.close()
+            except sqlite3.Error:
+                # Locked or not yet created; retried on the next poll
+                pass
+
+    def subscribe(self, db, location_ids, since=None):
+        """
+        Start receiving the events of some locations.
+
+        Args:
+            db (sqlite3.Connection): The main database connection
+            location_ids (iterable): The locations to follow
+            since (int): Also deliver the kept events after this id; if
+                some of them are no longer kept, the subscription starts
+                with a nonzero ``dropped`` count
+
+        Returns:
+            Subscription: Call unsubscribe with it when done
+
+        Raises:
+            FeedFull: If ``max_clients`` subscriptions are open
+        """
+        subscription = Subscription(frozenset(location_ids), self.buffer_size)
+        # The thread of a process forked after the feed was created is not inherited
+        if self._poller_pid != os.getpid():
+            self._poller_pid = os.getpid()
+            threading.Thread(target=self._run_poller, daemon=True).start()
+        with self._lock:
+            if self.max_clients and len(self._clients) >= self.max_clients:
+                raise FeedFull()
+            # The last id handed out, even if that event was trimmed since
+            newest = db.execute("SELECT IFNULL(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'weather_events'"
+                                ).fetchone()[0]
+            if since is not None and since < newest:
+                oldest = db.execute('SELECT MIN(id) FROM weather_events').fetchone()[0]
+                if oldest is None or oldest > since + 1:
+                    subscription.dropped = 1
+                for seq, location_id, kind, data in db.execute(
+                    'SELECT id, location_id, kind, data FROM weather_events WHERE id > ? ORDER BY id', (since,)
+                ):
+                    if location_id in subscription.location_ids:
+                        subscription.put(Event(seq, location_id, kind, json.loads(data)))
+            subscription.cursor = newest
+            if not self._clients:
+                # Nothing was read while no one was subscribed
+                self.last_seq = max(self.last_seq, newest)
+            self._clients.add(subscription)
+            for location_id in subscription.location_ids:
+                self._subscriptions[location_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._clients.discard(subscription)
+            for location_id in subscription.location_ids:
+                subscribers = self._subscriptions.get(location_id)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscriptions[location_id]
+
+    def stats(self):
+        with self._lock:
+            return {"subscribers": len(self._clients), "locations": len(self._subscriptions),
+                    "last_id": self.last_seq}
+
+
+def get_feed():
+    return current_app.extensions['change_feed']
+
+
+def publish(location_id, kind, data):
+    """
+    Publish an event on the current app's feed (call after the write is committed).
+
+    Returns:
+        Event or None: The event, None if it could not be stored (the write
+        itself succeeded, so this is logged rather than raised)
+    """
+    try:
+        return get_feed().publish(get_db(), location_id, kind, data)
+    except sqlite3.Error as e:
+        current_app.logger.warning("\nUnable to publish %s event of location %s: %s", kind, location_id, e)
+        return None
+
+
+def full_response():
+    """The 503 sent when the process already serves STREAM_MAX_CLIENTS feed clients."""
+    current_app.logger.warning("\nChange feed is at capacity.")
+    response = jsonify({"error": "Server is busy, please retry later"})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(current_app.config['STREAM_RETRY_AFTER'])
+    return response
+
+
+def sse_stream(subscription, heartbeat, max_seconds):
+    """
+    Generate the Server-Sent Events of a subscription.
+
+    Ends after ``max_seconds`` (the browser reconnects with Last-Event-ID and
+    misses nothing still in the feed's history), sending a comment line
+    every ``heartbeat`` seconds without events so proxies keep it open.
+
+    Note:
+        The caller unsubscribes when the response is closed (a generator
+        that never started would not run a ``finally`` block).
+    """
+    deadline = time.monotonic() + max_seconds
+    yield b'retry: 1000\n\n'
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        events, dropped = subscription.get(min(heartbeat, remaining))
+        if dropped:
+            # The client has missed events and should refetch
+            yield f'event: overflow\ndata: {{"dropped":{dropped}}}\n\n'.encode()
+        if events:
+            yield b''.join(event.sse for event in events)
+        elif not dropped:
+            yield b': keepalive\n\n'
+
+
+def init_app(app):
+    """
+    Set up the change feed behind GET /weather/stream and GET /weather/updates.
+
+    Config:
+        STREAM_BUFFER_SIZE (int): Events buffered per connected client
+        STREAM_HISTORY_SIZE (int): Recent events kept for reconnecting clients
+        STREAM_HEARTBEAT (float): Seconds between keepalive comments
+        STREAM_MAX_SECONDS (float): Lifetime of one SSE response; keep it below
+            the gunicorn worker timeout (serve --timeout) for sync workers
+        LONG_POLL_TIMEOUT (float): Longest wait of GET /weather/updates
+        STREAM_MAX_CLIENTS (int): Streams and long-polls served at once by
+            one process; each holds a worker thread, so keep it below the
+            threads per worker (serve --threads) to leave room for other
+            requests (0 = no limit)
+        STREAM_RETRY_AFTER (int): Retry-After sent when that limit is reached
+        STREAM_POLL_INTERVAL (float): Seconds between reads of the events
+            published by other processes (the added latency of those)
+
+    Side-effects:
+        - Stores the ChangeFeed in app.extensions['change_feed']
+
+    Note:
+        Events reach every process, but the clients are per process. The
+        feed routes are exempt from admission control (see admission.py);
+        STREAM_MAX_CLIENTS applies instead.
+    """
+    app.config.setdefault('STREAM_BUFFER_SIZE', 64)
+    app.config.setdefault('STREAM_HISTORY_SIZE', 1024)
+    app.config.setdefault('STREAM_HEARTBEAT', 15.0)
+    app.config.setdefault('STREAM_MAX_SECONDS', 25.0)
+    app.config.setdefault('LONG_POLL_TIMEOUT', 25.0)
+    app.config.setdefault('STREAM_MAX_CLIENTS', 8)
+    app.config.setdefault('STREAM_RETRY_AFTER', 5)
+    app.config.setdefault('STREAM_POLL_INTERVAL', 0.25)
+    app.extensions['change_feed'] = ChangeFeed(
+        lambda: sqlite3.connect(app.config.get('DATABASE', 'weather.db')),
+        app.config['STREAM_BUFFER_SIZE'], app.config['STREAM_HISTORY_SIZE'],
+        app.config['STREAM_MAX_CLIENTS'], app.config['STREAM_POLL_INTERVAL']
+    )
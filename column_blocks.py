@@ -0,0 +1,149 @@
+"""
+Compressed column encodings for cold weather history.
+
+A column (a list of values in timestamp order) is encoded into one
+self-describing blob: a small header followed by zlib-compressed data.
+The encoding is chosen from the values:
+
+- ``dod``: delta-of-delta integers, for regularly spaced timestamps and ids,
+  where nearly every entry is 0
+- ``delta``: delta integers, for slowly changing integer readings
+- ``scaled``: floats with at most 3 decimals, as delta-encoded fixed-point
+  integers
+- ``xor``: any other floats, each IEEE 754 bit pattern XORed with the
+  previous one (identical and close values leave mostly zero bytes)
+- ``json``: anything else (mixed types), so the round trip is always exact
+
+Decoding is done with C-level primitives (zlib, array, itertools.accumulate,
+map over operator functions) rather than a Python loop per value.
+"""
+import array
+import json
+import operator
+import struct
+import sys
+import zlib
+from itertools import accumulate, repeat
+
+RAW, DELTA, DOD, SCALED, XOR = range(5)
+CODEC_NAMES = {RAW: 'json', DELTA: 'delta', DOD: 'dod', SCALED: 'scaled', XOR: 'xor'}
+
+# codec, decimal places (scaled), has a null mask, value count
+_HEADER = struct.Struct('<BBBI')
+
+
+def _to_bytes(values, typecode):
+    packed = array.array(typecode, values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def _from_bytes(data, typecode):
+    packed = array.array(typecode)
+    packed.frombytes(data)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed
+
+
+def _deltas(values):
+    return [values[0]] + list(map(operator.sub, values[1:], values[:-1])) if values else []
+
+
+def _decimals(values):
+    """Fewest decimal places (up to 3) that represent every float exactly, or None."""
+    for places in range(4):
+        scale = 10 ** places
+        try:
+            if all(round(value * scale) / scale == value for value in values):
+                return places
+        except (OverflowError, ValueError):  # inf / nan
+            return None
+    return None
+
+
+def encode_column(values, regular=False):
+    """
+    Encode a column of values.
+
+    Args:
+        values (list): Values in row order; None is allowed anywhere
+        regular (bool): The values are (nearly) evenly spaced integers,
+            such as hourly timestamps, so delta-of-delta suits them best
+
+    Returns:
+        bytes: The encoded column
+    """
+    nulls = [value is None for value in values]
+    has_nulls = any(nulls)
+    present = [value for value in values if value is not None]
+    filled = [0 if value is None else value for value in values] if has_nulls else values
+    types = set(map(type, present))
+    codec, places, payload = RAW, 0, None
+    try:
+        if types <= {int}:
+            codec = DOD if regular else DELTA
+            deltas = _deltas(filled)
+            payload = _to_bytes(_deltas(deltas) if regular else deltas, 'q')
+        elif types <= {float}:
+            places = _decimals(present)
+            if places is not None:
+                codec, scale = SCALED, 10 ** places
+                payload = _to_bytes(_deltas([round(value * scale) for value in filled]), 'q')
+            else:
+                codec, places = XOR, 0
+                bits = _from_bytes(_to_bytes([float(value) for value in filled], 'd'), 'Q').tolist()
+                xors = [bits[0]] + list(map(operator.xor, bits[1:], bits[:-1])) if bits else []
+                payload = _to_bytes(xors, 'Q')
+    except OverflowError:  # integers beyond 64 bits
+        codec, places, payload = RAW, 0, None
+    if payload is None:
+        codec, places = RAW, 0
+        payload = json.dumps(values).encode()
+        has_nulls = False
+    mask = bytes(nulls) if has_nulls else b''
+    return _HEADER.pack(codec, places, has_nulls, len(values)) + zlib.compress(mask + payload, 9)
+
+
+def decode_column(blob, stop=None):
+    """
+    Decode a column encoded by encode_column.
+
+    Args:
+        blob (bytes): The encoded column
+        stop (int): Decode only the first ``stop`` values; every encoding is
+            a running sum, so the rest is neither decompressed nor summed
+
+    Returns:
+        list: The original values, with the original types
+    """
+    codec, places, has_nulls, count = _HEADER.unpack_from(blob)
+    stop = count if stop is None else min(stop, count)
+    if not stop:
+        return []
+    if codec == RAW:
+        return json.loads(zlib.decompress(blob[_HEADER.size:]))[:stop]
+    mask_size = count if has_nulls else 0
+    data = zlib.decompressobj().decompress(blob[_HEADER.size:], mask_size + stop * 8)
+    mask = data[:stop] if has_nulls else None
+    data = data[mask_size:]
+    if codec == XOR:
+        bits = accumulate(_from_bytes(data, 'Q'), operator.xor)
+        values = _from_bytes(_to_bytes(bits, 'Q'), 'd').tolist()
+    else:
+        values = accumulate(_from_bytes(data, 'q'))
+        if codec == DOD:
+            values = accumulate(values)
+        values = list(values)
+        if codec == SCALED:
+            # int / int is correctly rounded, so 1234 / 100 is exactly 12.34
+            values = list(map(operator.truediv, values, repeat(10 ** places)))
+    if mask:
+        values = [None if null else value for value, null in zip(values, mask)]
+    return values
+
+
+def column_codec(blob):
+    """Name of the encoding used for a blob, e.g. for reports."""
+    return CODEC_NAMES[blob[0]]
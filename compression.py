@@ -0,0 +1,75 @@
+import gzip
+from flask import request, current_app
+
+try:
+    import brotli
+except ImportError:  # optional, gzip is always available
+    brotli = None
+
+
+def init_app(app):
+    """
+    Enable content-negotiated compression of large responses.
+
+    Config:
+        COMPRESS_MIN_SIZE (int): Bodies smaller than this many bytes are sent as-is
+        COMPRESS_MIMETYPES (set): Mimetypes eligible for compression
+        COMPRESS_GZIP_LEVEL (int): gzip compression level
+        COMPRESS_BR_QUALITY (int): brotli quality, used when brotli is installed
+
+    Side-effects:
+        - Registers an after_request hook on the app
+    """
+    app.config.setdefault('COMPRESS_MIN_SIZE', 1024)
+    app.config.setdefault('COMPRESS_MIMETYPES', {'application/json'})
+    app.config.setdefault('COMPRESS_GZIP_LEVEL', 6)
+    app.config.setdefault('COMPRESS_BR_QUALITY', 4)
+    app.after_request(compress_response)
+
+
+def _choose_encoding():
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return request.accept_encodings.best_match(offered)
+
+
+def compress_response(response):
+    """
+    Compress a response body if the client accepts it and it is large enough.
+
+    Args:
+        response (flask.Response): The outgoing response
+
+    Returns:
+        flask.Response: The same response, possibly with a compressed body
+
+    Side-effects:
+        - Sets Content-Encoding and Content-Length on compressed responses
+        - Adds Accept-Encoding to Vary for every compressible mimetype
+    """
+    config = current_app.config
+
+    if (response.mimetype not in config['COMPRESS_MIMETYPES']
+            or response.direct_passthrough
+            or response.status_code < 200
+            or response.status_code >= 300
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    length = response.calculate_content_length()
+    if length is None or length < config['COMPRESS_MIN_SIZE']:
+        return response
+
+    encoding = _choose_encoding()
+    if encoding is None:
+        return response
+
+    body = response.get_data()
+    if encoding == 'br':
+        body = brotli.compress(body, quality=config['COMPRESS_BR_QUALITY'])
+    else:
+        body = gzip.compress(body, compresslevel=config['COMPRESS_GZIP_LEVEL'], mtime=0)
+
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    return response
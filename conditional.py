@@ -0,0 +1,73 @@
+from flask import request, jsonify, current_app
+from metrics import record_cache
+
+
+def rows_etag(db, id_query, params, prefix):
+    """
+    Build an ETag for a result set without fetching or serializing it.
+
+    Args:
+        db (sqlite3.Connection): The open database connection
+        id_query (str): A query selecting only the ``id`` column of the rows
+            the real endpoint would return (same WHERE / ORDER BY / LIMIT)
+        params (tuple): Parameters for ``id_query``
+        prefix (str): A short tag identifying the resource (e.g. "history-3")
+
+    Returns:
+        str: An opaque validator that changes whenever rows enter or leave
+        the result set
+
+    Note:
+        Row ids come from AUTOINCREMENT columns, so a newly inserted row always
+        raises MAX(id) and a removed row always changes COUNT(*) or TOTAL(id).
+        With the (location_id, timestamp) indexes the query is answered from
+        the index alone.
+    """
+    count, max_id, id_total = db.execute(
+        f'SELECT COUNT(*), MAX(id), TOTAL(id) FROM ({id_query})',
+        params
+    ).fetchone()
+    return f"{prefix}-{count}-{max_id or 0}-{int(id_total)}"
+
+
+def not_modified(etag):
+    """
+    Short-circuit a GET whose If-None-Match header matches the current ETag.
+
+    Args:
+        etag (str): The current validator for the requested resource
+
+    Returns:
+        flask.Response or None: An empty 304 response carrying the ETag, or
+        None if the client's copy is missing or stale
+
+    Side-effects:
+        - Counts a hit or miss for the "etag" cache in the metrics registry
+    """
+    if etag and request.if_none_match.contains_weak(etag):
+        record_cache('etag', True)
+        response = current_app.response_class(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+    record_cache('etag', False)
+    return None
+
+
+def conditional_jsonify(payload, etag):
+    """
+    Serialize a payload and attach its ETag.
+
+    Args:
+        payload: Any object accepted by ``jsonify``
+        etag (str): The validator computed by ``rows_etag``
+
+    Returns:
+        flask.Response: The JSON response with a weak ETag header
+
+    Note:
+        The ETag is weak because it identifies the data, not the exact bytes;
+        the same rows may be sent compressed or uncompressed.
+    """
+    response = jsonify(payload)
+    response.set_etag(etag, weak=True)
+    return response
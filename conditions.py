@@ -0,0 +1,143 @@
+import click
+from flask.cli import with_appcontext
+from database import get_db, init_db
+
+# Tables whose rows reference weather_conditions
+ENCODED_TABLES = ('current_weather', 'weather_forecast', 'weather_history', 'weather_history_daily')
+
+# Matches a pair the way idx_weather_conditions_pair (schema.sql) compares them
+_PAIR_MATCHES = "IFNULL(description, '') = IFNULL(?, '') AND IFNULL(icon, '') = IFNULL(?, '')"
+
+
+class ConditionEncoder:
+    """
+    Encodes description / icon pairs as weather_conditions ids.
+
+    Ids are remembered in a dict, so storing a batch of rows costs one lookup
+    per distinct condition. Create one per connection (e.g. per request).
+
+    Args:
+        db (sqlite3.Connection): The open database connection
+
+    Note:
+        Reads decode the ids again through the ``*_rows`` views in schema.sql,
+        which join the (tiny, always cached) lookup table inside SQLite.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.codes = {}
+
+    def __call__(self, description, icon):
+        """
+        Returns:
+            int or None: The id of the pair, added to the table if it is new;
+            None when both values are missing
+        """
+        if description is None and icon is None:
+            return None
+        key = (description, icon)
+        code = self.codes.get(key)
+        if code is None:
+            self.db.execute('INSERT OR IGNORE INTO weather_conditions (description, icon) VALUES (?, ?)', key)
+            code = self.db.execute(f'SELECT id FROM weather_conditions WHERE {_PAIR_MATCHES}', key).fetchone()[0]
+            self.codes[key] = code
+        return code
+
+
+def merge_duplicate_conditions(db):
+    """
+    Point rows at the first of each set of equal pairs and delete the others.
+
+    Before idx_weather_conditions_pair, a pair with a NULL was added again by
+    every encoder (UNIQUE treats NULLs as distinct); init_db runs this before
+    creating the index, which would fail on such duplicates.
+
+    Returns:
+        int: Duplicate pairs deleted
+    """
+    exists = db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'weather_conditions'")
+    if exists.fetchone() is None:
+        return 0
+    db.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS condition_duplicates AS
+        SELECT c.id AS duplicate, k.id AS keep FROM weather_conditions c
+        JOIN weather_conditions k ON k.id = (
+            SELECT MIN(id) FROM weather_conditions
+            WHERE IFNULL(description, '') = IFNULL(c.description, '') AND IFNULL(icon, '') = IFNULL(c.icon, '')
+        )
+        WHERE k.id != c.id
+    ''')
+    merged = db.execute('SELECT COUNT(*) FROM condition_duplicates').fetchone()[0]
+    if merged:
+        for table in ENCODED_TABLES:
+            if 'condition_id' not in {row[1] for row in db.execute(f'PRAGMA table_info({table})')}:
+                continue
+            db.execute(f'''
+                UPDATE {table} SET condition_id = (
+                    SELECT keep FROM condition_duplicates WHERE duplicate = condition_id
+                )
+                WHERE condition_id IN (SELECT duplicate FROM condition_duplicates)
+            ''')
+        db.execute('DELETE FROM weather_conditions WHERE id IN (SELECT duplicate FROM condition_duplicates)')
+    db.execute('DROP TABLE temp.condition_duplicates')
+    db.commit()
+    return merged
+
+
+def migrate_conditions(db):
+    """
+    Move description / icon text out of the observation tables of an older database.
+
+    Adds condition_id to every table that still has a description column,
+    fills weather_conditions and the ids, then drops the text columns.
+
+    Returns:
+        dict: Rows converted per table
+    """
+    legacy = []
+    for table in ENCODED_TABLES:
+        columns = {row[1] for row in db.execute(f'PRAGMA table_info({table})')}
+        if 'description' not in columns:
+            continue
+        legacy.append(table)
+        if 'condition_id' not in columns:
+            db.execute(f'ALTER TABLE {table} ADD COLUMN condition_id INTEGER REFERENCES weather_conditions (id)')
+    # Every table has condition_id now; DROP COLUMN re-checks all the *_rows views
+    converted = {}
+    for table in legacy:
+        db.execute(f'''
+            INSERT OR IGNORE INTO weather_conditions (description, icon)
+            SELECT DISTINCT description, icon FROM {table}
+            WHERE description IS NOT NULL OR icon IS NOT NULL
+        ''')
+        converted[table] = db.execute(f'''
+            UPDATE {table} SET condition_id = (
+                SELECT id FROM weather_conditions c
+                WHERE IFNULL(c.description, '') = IFNULL({table}.description, '')
+                AND IFNULL(c.icon, '') = IFNULL({table}.icon, '')
+            )
+            WHERE description IS NOT NULL OR icon IS NOT NULL
+        ''').rowcount
+        db.execute(f'ALTER TABLE {table} DROP COLUMN description')
+        db.execute(f'ALTER TABLE {table} DROP COLUMN icon')
+    db.commit()
+    return converted
+
+
+@click.command('migrate-conditions')
+@click.option('--vacuum/--no-vacuum', default=True, show_default=True,
+              help='Rebuild the database file afterwards to give the space back.')
+@with_appcontext
+def migrate_conditions_command(vacuum):
+    """Convert a database created before weather_conditions existed (init-db does too)."""
+    converted = init_db()
+    db = get_db()
+    if not converted:
+        click.echo('Nothing to migrate.')
+        return
+    for table, rows in converted.items():
+        click.echo(f'{table}: {rows} rows encoded')
+    if vacuum:
+        db.execute('VACUUM')
+        click.echo('Vacuumed the database.')
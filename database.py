@@ -1,37 +1,367 @@
+import os
 import sqlite3
+import time
+import zlib
 import click
 from flask import current_app, g
 from flask.cli import with_appcontext
 
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    Cursor that reports the time spent executing and fetching each statement.
+
+    Every listener in ``connection.listeners`` is called as
+    ``listener(sql, phase, seconds)`` with phase "execute" or "fetch".
+    """
+
+    def _report(self, sql, phase, start):
+        elapsed = time.perf_counter() - start
+        for listener in self.connection.listeners:
+            listener(sql, phase, elapsed)
+
+    def execute(self, sql, parameters=()):
+        self._sql = sql
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._report(sql, 'execute', start)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._sql = sql
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._report(sql, 'execute', start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self._report(self._sql, 'fetch', start)
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            self._report(self._sql, 'fetch', start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._report(self._sql, 'fetch', start)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors are InstrumentedCursor instances."""
+
+    listeners = ()
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+# Tables holding per-location weather rows; in sharded mode they live in the shard files
+WEATHER_TABLES = ('current_weather', 'weather_forecast', 'weather_history', 'weather_history_daily')
+
+def _connect(db_path):
+    listeners = current_app.extensions.get('db_listeners')
+    db = sqlite3.connect(
+        db_path,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        # Lets ATTACH open history partitions read-only (file:...?mode=ro)
+        uri=True,
+        factory=InstrumentedConnection if listeners else sqlite3.Connection
+    )
+    db.row_factory = sqlite3.Row
+    if listeners:
+        db.listeners = listeners
+    for hook in current_app.extensions.get('db_connection_hooks', ()):
+        hook(db)
+    return db
+
 def get_db():
+    """
+    Returns the request's database connection, opening it on first use.
+
+    If any callables are registered in ``current_app.extensions['db_listeners']``
+    the connection is an InstrumentedConnection reporting statement timings to
+    them. Callables in ``current_app.extensions['db_connection_hooks']`` are
+    called with each new connection (shard connections included). The time
+    taken to open the connection is stored in g.db_connect_seconds.
+    """
     if 'db' not in g:
-        db_path = current_app.config.get('DATABASE', 'weather.db')
-        g.db = sqlite3.connect(
-            db_path,
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+        start = time.perf_counter()
+        g.db = _connect(current_app.config.get('DATABASE', 'weather.db'))
+        g.db_connect_seconds = time.perf_counter() - start
 
     return g.db
 
+def shard_count():
+    """
+    Returns:
+        int: The number of weather shards (config SHARDS); 0 when the weather
+        tables are in the main database
+    """
+    return current_app.config.get('SHARDS', 0)
+
+def shard_index(location_id, shards):
+    """
+    Returns the shard holding a location's weather rows.
+
+    Uses CRC-32 of the id rather than hash(), so the mapping is the same in
+    every process and Python version and consecutive ids are spread out.
+    """
+    return zlib.crc32(int(location_id).to_bytes(8, 'little', signed=True)) % shards
+
+def shard_path(database, index):
+    """Path of shard ``index`` of a database, e.g. weather.shard0.db next to weather.db."""
+    root, ext = os.path.splitext(database)
+    return f'{root}.shard{index}{ext or ".db"}'
+
+def weather_shard(location_id):
+    """
+    Returns:
+        int or None: The location's shard, None when not sharded
+    """
+    shards = shard_count()
+    return shard_index(location_id, shards) if shards else None
+
+def _get_shard_db(index):
+    if 'shard_dbs' not in g:
+        g.shard_dbs = {}
+    if index not in g.shard_dbs:
+        g.shard_dbs[index] = _connect(shard_path(current_app.config.get('DATABASE', 'weather.db'), index))
+    return g.shard_dbs[index]
+
+def get_weather_db(location_id):
+    """
+    Returns the connection holding a location's weather rows.
+
+    That is get_db() unless SHARDS is set, in which case it is the request's
+    connection to the location's shard file, opened on first use. Writes to
+    different shards take different SQLite write locks, so they run in parallel.
+    """
+    index = weather_shard(location_id)
+    return get_db() if index is None else _get_shard_db(index)
+
+def get_shard_dbs():
+    """
+    Returns:
+        list or None: A connection to every shard, in shard order, or None
+        when not sharded
+    """
+    shards = shard_count()
+    return [_get_shard_db(index) for index in range(shards)] if shards else None
+
+def weather_dbs():
+    """
+    Returns:
+        list: The connections holding weather tables (every shard, or just get_db())
+    """
+    return get_shard_dbs() or [get_db()]
+
+
+# Most location ids bound in one fan_out query; SQLite before 3.32 allows
+# only 999 parameters per statement
+MAX_QUERY_LOCATIONS = 500
+
+def fan_out(location_ids, query, params=()):
+    """
+    Run a multi-location query on each shard with the locations it holds.
+
+    Locations are grouped by shard and ``query`` runs once per shard that has
+    any, with ``{locations}`` replaced by the placeholders of that shard's ids
+    (once per MAX_QUERY_LOCATIONS of them when a shard holds more).
+
+    Args:
+        location_ids (list): The locations to read
+        query (str): SQL with a ``location_id IN ({locations})`` condition
+        params (tuple): Parameters following the location ids
+
+    Returns:
+        list: The rows of every shard, in shard order
+    """
+    groups = {}
+    for location_id in location_ids:
+        groups.setdefault(weather_shard(location_id), []).append(location_id)
+    rows = []
+    for index in sorted(groups, key=lambda index: -1 if index is None else index):
+        ids = groups[index]
+        db = get_db() if index is None else _get_shard_db(index)
+        for start in range(0, len(ids), MAX_QUERY_LOCATIONS):
+            chunk = ids[start:start + MAX_QUERY_LOCATIONS]
+            rows += db.execute(query.format(locations=', '.join('?' * len(chunk))), (*chunk, *params)).fetchall()
+    return rows
+
 def close_db(e=None):
     db = g.pop('db', None)
 
     if db is not None:
         db.close()
+    for shard_db in g.pop('shard_dbs', {}).values():
+        shard_db.close()
+
+def _schema():
+    with current_app.open_resource('schema.sql') as f:
+        return f.read().decode('utf8')
+
+def _add_provenance_columns(db, schema):
+    """Adds the current_weather provenance columns to a database created before them."""
+    columns = {row[1] for row in db.execute('PRAGMA table_info(current_weather)')}
+    if 'source_location_id' not in columns:
+        db.execute('ALTER TABLE current_weather ADD COLUMN source_location_id INTEGER')
+        db.execute('ALTER TABLE current_weather ADD COLUMN source_distance_km REAL')
+        db.execute('DROP VIEW IF EXISTS current_weather_rows')
+        db.executescript(schema)
 
 def init_db():
-    db = get_db()
+    """
+    Create the tables (in the main database and every shard) if they don't exist.
 
-    with current_app.open_resource('schema.sql') as f:
-        db.executescript(f.read().decode('utf8'))
+    Also brings a database created by an older version up to date: the
+    current_weather provenance columns are added, duplicate condition pairs
+    are merged and description / icon text is moved into weather_conditions
+    (see conditions.py), without which the ``*_rows`` views cannot be read.
+
+    Returns:
+        dict: Rows whose conditions were converted, per table
+    """
+    # conditions imports this module
+    from conditions import merge_duplicate_conditions, migrate_conditions
+    schema = _schema()
+    converted = {}
+    for db in [get_db()] + (get_shard_dbs() or []):
+        merge_duplicate_conditions(db)
+        db.executescript(schema)
+        _add_provenance_columns(db, schema)
+        for table, rows in migrate_conditions(db).items():
+            converted[table] = converted.get(table, 0) + rows
+    return converted
 
 def clear_db():
+    for db in weather_dbs():
+        for table in WEATHER_TABLES:
+            db.execute(f'DELETE FROM {table}')
+        db.commit()
     db = get_db()
-    db.execute('DELETE FROM favorite_locations')
-    db.execute('DELETE FROM users')
+    for table in ('favorite_locations', 'orphaned_locations', 'weather_events', 'api_tokens', 'users'):
+        db.execute(f'DELETE FROM {table}')
     db.commit()
 
+def reshard(database, source, target):
+    """
+    Move every location's weather rows from ``source`` shards to ``target`` shards.
+
+    The rows are copied into new files (``*.resharding``) with condition ids
+    translated to the target's weather_conditions, the copy is checked
+    against the source row counts, and only then are the new files moved into
+    place and the old rows removed. Row ids are assigned afresh, since ids of
+    different source shards overlap.
+
+    Args:
+        database (str): Path of the main database
+        source (int): Current number of shards (0 = weather tables in the main database)
+        target (int): Number of shards wanted (0 = back into the main database)
+
+    Returns:
+        dict: Rows moved per weather table
+
+    Note:
+        Run it with the app stopped; writes made during the copy would be lost.
+        Archived history partitions (HISTORY_ARCHIVE_DIR) are not moved.
+    """
+    if source == target:
+        return {}
+    sources = [shard_path(database, index) for index in range(source)] if source else [database]
+    targets = [shard_path(database, index) + '.resharding' for index in range(target)] if target else [database]
+    if not target:
+        main = sqlite3.connect(database)
+        leftover = sum(main.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0] for table in WEATHER_TABLES)
+        main.close()
+        if leftover:
+            raise RuntimeError(f'{database} already holds {leftover} weather rows; nothing was changed.')
+    schema = _schema()
+    for path in targets:
+        if path != database and os.path.exists(path):
+            os.unlink(path)
+        created = sqlite3.connect(path)
+        created.executescript(schema)
+        created.close()
+
+    expected = dict.fromkeys(WEATHER_TABLES, 0)
+    moved = dict.fromkeys(WEATHER_TABLES, 0)
+    for path in sources:
+        db = sqlite3.connect(path)
+        db.create_function('shard_index', 2, shard_index, deterministic=True)
+        for table in WEATHER_TABLES:
+            expected[table] += db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+        for index, target_path in enumerate(targets):
+            db.execute('ATTACH DATABASE ? AS target', (target_path,))
+            db.execute('''
+                INSERT OR IGNORE INTO target.weather_conditions (description, icon)
+                SELECT description, icon FROM main.weather_conditions
+            ''')
+            for table in WEATHER_TABLES:
+                columns = ', '.join(row[1] for row in db.execute(f'PRAGMA main.table_info({table})')
+                                    if row[1] not in ('id', 'condition_id'))
+                moved[table] += db.execute(f'''
+                    INSERT INTO target.{table} ({columns}, condition_id)
+                    SELECT {', '.join('s.' + column for column in columns.split(', '))},
+                           (SELECT c.id FROM target.weather_conditions c
+                            WHERE IFNULL(c.description, '') = IFNULL(sc.description, '')
+                            AND IFNULL(c.icon, '') = IFNULL(sc.icon, ''))
+                    FROM main.{table} s
+                    LEFT JOIN main.weather_conditions sc ON sc.id = s.condition_id
+                    WHERE ? = 0 OR shard_index(s.location_id, ?) = ?
+                ''', (target, target or 1, index)).rowcount
+            db.commit()
+            db.execute('DETACH DATABASE target')
+        db.close()
+    for path in targets:
+        db = sqlite3.connect(path)
+        db.execute('ANALYZE')
+        db.close()
+
+    if moved != expected:
+        for path in targets:
+            if path != database:
+                os.unlink(path)
+            else:
+                clear = sqlite3.connect(database)
+                for table in WEATHER_TABLES:
+                    clear.execute(f'DELETE FROM {table}')
+                clear.commit()
+                clear.close()
+        raise RuntimeError(f'Copied row counts {moved} do not match the source {expected}; nothing was changed.')
+
+    if source:
+        for path in sources:
+            os.replace(path, path + '.old')
+    for index, path in enumerate(targets):
+        if path != database:
+            os.replace(path, shard_path(database, index))
+    if source:
+        for path in sources:
+            os.unlink(path + '.old')
+    else:
+        db = sqlite3.connect(database)
+        for table in WEATHER_TABLES:
+            db.execute(f'DELETE FROM {table}')
+        db.commit()
+        db.execute('VACUUM')
+        db.close()
+    return moved
+
 @click.command('init-db')
 @with_appcontext
 def init_db_command():
@@ -39,6 +369,28 @@ def init_db_command():
     init_db()
     click.echo('Initialized the database.')
 
+@click.command('reshard')
+@click.argument('shards', type=int)
+@click.option('--from', 'source', type=int,
+              help='Shards the data is in now (defaults to the SHARDS setting).')
+@with_appcontext
+def reshard_command(shards, source):
+    """Move the weather tables into SHARDS files (0 = back into the main database)."""
+    source = shard_count() if source is None else source
+    if source == shards:
+        click.echo(f'Already in {shards} shards.')
+        return
+    def layout(count):
+        return f'{count} shards' if count else 'the main database'
+
+    close_db()
+    moved = reshard(current_app.config.get('DATABASE', 'weather.db'), source, shards)
+    click.echo(f"Moved {', '.join(f'{rows} {table}' for table, rows in moved.items())} rows "
+               f"from {layout(source)} to {layout(shards)}.")
+    click.echo(f'Now run the app with WEATHER_SHARDS={shards}.')
+    if current_app.config.get('HISTORY_ARCHIVE_DIR'):
+        click.echo('Note: archived history partitions were not moved.')
+
 @click.command('clear-db')
 @with_appcontext
 def clear_db_command():
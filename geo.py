@@ -0,0 +1,153 @@
+"""
+Nearby-location search over the favorite_locations R*Tree, and reuse of
+fresh weather observed at a nearby location.
+
+favorite_locations_rtree (schema.sql) holds every favorite as a point and is
+kept in sync by triggers, so a search reads the index entries inside a
+latitude / longitude box and computes great-circle distances only for those.
+"""
+import math
+import time
+from database import get_weather_db
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Box overlap, not containment: the R*Tree stores 32-bit floats rounded
+# outwards, so a point on the box edge may be stored a hair outside it
+_NEARBY_SQL = '''
+    SELECT f.id, f.user_id, f.location_name, f.latitude, f.longitude
+    FROM favorite_locations_rtree r JOIN favorite_locations f ON f.id = r.id
+    WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ?
+'''
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points in kilometres."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_boxes(lat, lon, radius_km):
+    """
+    Latitude / longitude boxes covering every point within ``radius_km``.
+
+    Args:
+        lat (float): Latitude of the centre in degrees
+        lon (float): Longitude of the centre in degrees
+        radius_km (float): Search radius
+
+    Returns:
+        list: ``(min_lat, max_lat, min_lon, max_lon)`` boxes; two when the
+        circle crosses the antimeridian, one spanning all longitudes when it
+        contains a pole
+    """
+    angle = radius_km / EARTH_RADIUS_KM
+    dlat = math.degrees(angle)
+    min_lat, max_lat = lat - dlat, lat + dlat
+    if min_lat <= -90 or max_lat >= 90 or angle >= math.pi / 2:
+        return [(max(min_lat, -90.0), min(max_lat, 90.0), -180.0, 180.0)]
+    # Widest longitude offset of the circle, reached north of the centre's
+    # parallel in the northern hemisphere (and south of it in the southern)
+    ratio = math.sin(angle) / math.cos(math.radians(lat))
+    if ratio >= 1:
+        return [(min_lat, max_lat, -180.0, 180.0)]
+    dlon = math.degrees(math.asin(ratio))
+    min_lon, max_lon = lon - dlon, lon + dlon
+    if min_lon < -180:
+        return [(min_lat, max_lat, min_lon + 360, 180.0), (min_lat, max_lat, -180.0, max_lon)]
+    if max_lon > 180:
+        return [(min_lat, max_lat, min_lon, 180.0), (min_lat, max_lat, -180.0, max_lon - 360)]
+    return [(min_lat, max_lat, min_lon, max_lon)]
+
+
+def nearby_locations(db, lat, lon, radius_km, limit=10, user_id=None):
+    """
+    The stored favorite locations nearest to a point.
+
+    The search starts with a small box and widens it (up to ``radius_km``)
+    until it holds ``limit`` locations within the searched distance, so in
+    a dense area only the index entries around the point are read.
+
+    Args:
+        db (sqlite3.Connection): The open database connection
+        lat (float): Latitude in degrees
+        lon (float): Longitude in degrees
+        radius_km (float): Largest distance to return
+        limit (int): Most locations to return
+        user_id (int): Only return this user's locations (None: everyone's)
+
+    Returns:
+        list: ``(distance_km, row)`` pairs, nearest first; rows have id,
+        user_id, location_name, latitude and longitude
+    """
+    query, owner = _NEARBY_SQL, ()
+    if user_id is not None:
+        query, owner = _NEARBY_SQL + ' AND f.user_id = ?', (user_id,)
+    searched = min(radius_km, 1.0)
+    while True:
+        found = []
+        for box in bounding_boxes(lat, lon, searched):
+            for row in db.execute(query, box + owner):
+                distance = haversine_km(lat, lon, row['latitude'], row['longitude'])
+                if distance <= searched:
+                    found.append((distance, row['id'], row))
+        # Everything within ``searched`` km is in its boxes, so these are
+        # the nearest once there are enough of them
+        if len(found) >= limit or searched >= radius_km:
+            found.sort(key=lambda match: match[:2])
+            return [(distance, row) for distance, _, row in found[:limit]]
+        searched = min(radius_km, searched * 4)
+
+
+def fresh_nearby_observation(db, location, max_distance_km, max_age, now=None, candidates=10):
+    """
+    The latest first-hand current weather of the nearest location that has a fresh one.
+
+    Only observations fetched for their own location (no source_location_id)
+    are considered, so reused readings never drift further by being reused
+    again.
+
+    Args:
+        db (sqlite3.Connection): The main database connection
+        location (sqlite3.Row): The favorite_locations row needing weather
+        max_distance_km (float): Farthest location to reuse from
+        max_age (int): Oldest observation to reuse, in seconds
+        now (int): Current timestamp (defaults to the clock)
+        candidates (int): Nearest locations checked for a fresh observation
+
+    Returns:
+        tuple or None: ``(distance_km, row)`` with a current_weather_rows row
+        (conditions decoded, since ids differ between shards), or None
+    """
+    now = int(time.time()) if now is None else now
+    for distance, nearby in nearby_locations(db, location['latitude'], location['longitude'],
+                                             max_distance_km, candidates + 1):
+        if nearby['id'] == location['id']:
+            continue
+        row = get_weather_db(nearby['id']).execute('''
+            SELECT * FROM current_weather_rows
+            WHERE location_id = ? AND source_location_id IS NULL AND timestamp >= ?
+            ORDER BY timestamp DESC LIMIT 1
+        ''', (nearby['id'], now - max_age)).fetchone()
+        if row is not None:
+            return distance, row
+    return None
+
+
+def init_app(app):
+    """
+    Configure nearby-location search.
+
+    Config:
+        NEARBY_MAX_RADIUS_KM (float): Largest radius_km GET /locations/nearby accepts
+        NEARBY_MAX_RESULTS (int): Largest limit it accepts
+        REUSE_DISTANCE_KM (float): How far away a fresh observation may be to
+            serve another location's current weather (0 disables reuse)
+        REUSE_MAX_AGE (int): How old, in seconds, such an observation may be
+    """
+    app.config.setdefault('NEARBY_MAX_RADIUS_KM', 500.0)
+    app.config.setdefault('NEARBY_MAX_RESULTS', 100)
+    app.config.setdefault('REUSE_DISTANCE_KM', 1.0)
+    app.config.setdefault('REUSE_MAX_AGE', 600)
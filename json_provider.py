@@ -0,0 +1,153 @@
+import json
+import sqlite3
+from math import isfinite
+from json.encoder import encode_basestring, encode_basestring_ascii
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # optional, the template encoder needs only the stdlib
+    orjson = None
+
+
+def _encode_null(value):
+    return 'null'
+
+
+def _encode_float(value):
+    # value - value is NaN for NaN and +/-inf; let json.dumps spell those
+    return float.__repr__(value) if value - value == 0 else json.dumps(value)
+
+
+def _encode_column(column, encoders, fallback):
+    types = set(map(type, column))
+    if types == {float} and all(map(isfinite, column)):
+        return map(float.__repr__, column)
+    if len(types) == 1:
+        encoder = encoders.get(types.pop())
+        if encoder is not None:
+            return map(encoder, column)
+    return [(encoders.get(type(value)) or fallback)(value) for value in column]
+
+
+def encode_rows(rows, sort_keys=True, ensure_ascii=True, default=None):
+    """
+    Serialize a list of sqlite3.Row objects as a JSON array of objects.
+
+    Args:
+        rows (list): Rows sharing one cursor description
+        sort_keys (bool): Emit keys in sorted order, like ``json.dumps``
+        ensure_ascii (bool): Escape non-ASCII characters in strings
+        default (callable): Fallback for values that are not int, float, str or None
+
+    Returns:
+        str: The JSON text, identical in content to ``json.dumps([dict(r) for r in rows])``
+
+    Note:
+        The keys are encoded once into a ``%s`` template for the whole result set.
+        Values are encoded a column at a time, so a column holding a single type
+        is encoded by one ``map`` call, and no per-row dict is ever built.
+    """
+    if not rows:
+        return '[]'
+
+    encode_string = encode_basestring_ascii if ensure_ascii else encode_basestring
+    encoders = {
+        int: int.__repr__,
+        float: _encode_float,
+        str: encode_string,
+        type(None): _encode_null,
+    }
+
+    def fallback(value):
+        return json.dumps(value, default=default, ensure_ascii=ensure_ascii)
+
+    keys = rows[0].keys()
+    order = sorted(range(len(keys)), key=keys.__getitem__) if sort_keys else range(len(keys))
+    template = '{' + ','.join(
+        encode_string(keys[i]).replace('%', '%%') + ':%s' for i in order
+    ) + '}'
+
+    columns = list(zip(*rows))
+    encoded = [_encode_column(columns[i], encoders, fallback) for i in order]
+    return '[' + ','.join([template % values for values in zip(*encoded)]) + ']'
+
+
+class RowJSONProvider(DefaultJSONProvider):
+    """
+    JSON provider that serializes sqlite3.Row results without converting them to dicts.
+
+    Routes can pass ``fetchall()`` / ``fetchone()`` results straight to ``jsonify``.
+    The row encoder is chosen with the ``JSON_ROW_ENCODER`` config value:
+
+        - "template" (default): stdlib only, encodes values column by column
+          into a key template without building a dict per row
+        - "orjson": uses orjson when it is installed; this builds a short-lived
+          dict per row, trading memory churn for speed (see benchmarks/bench_json.py)
+        - "auto": orjson if installed, otherwise template
+
+    Everything else (plain dicts, error payloads) goes through the default provider.
+    """
+
+    def __init__(self, app):
+        super().__init__(app)
+        choice = app.config.get('JSON_ROW_ENCODER', 'template')
+        if choice == 'auto':
+            choice = 'orjson' if orjson is not None else 'template'
+        if choice == 'orjson' and orjson is None:
+            raise RuntimeError("JSON_ROW_ENCODER is 'orjson' but orjson is not installed")
+        self.row_encoder = choice
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, sqlite3.Row):
+            return dict(o)
+        return DefaultJSONProvider.default(o)
+
+    def dumps(self, obj, **kwargs):
+        """
+        Serialize data as JSON, taking the fast path for rows.
+
+        Lists of sqlite3.Row (or a single Row) use the configured row encoder
+        unless indentation was requested; anything else is delegated to
+        ``DefaultJSONProvider.dumps``.
+        """
+        if kwargs.get('indent') is None:
+            if isinstance(obj, sqlite3.Row):
+                return self.dumps_rows([obj])[1:-1]
+            if isinstance(obj, list) and obj and isinstance(obj[0], sqlite3.Row):
+                return self.dumps_rows(obj)
+        return super().dumps(obj, **kwargs)
+
+    def dumps_rows(self, rows):
+        if self.row_encoder == 'orjson':
+            keys = rows[0].keys()
+            option = orjson.OPT_SORT_KEYS if self.sort_keys else 0
+            return orjson.dumps(
+                [dict(zip(keys, row)) for row in rows],
+                default=self.default,
+                option=option
+            ).decode()
+        return encode_rows(rows, self.sort_keys, self.ensure_ascii, self.default)
+
+
+def columnar_payload(cursor):
+    """
+    Build a column-oriented payload straight from an executed cursor.
+
+    Args:
+        cursor (sqlite3.Cursor): A cursor whose query has been executed
+
+    Returns:
+        dict: ``{"format": "columnar", "fields": [...], "columns": [[...], ...]}``
+        where ``columns[i]`` holds every value of ``fields[i]`` in row order
+
+    Note:
+        The cursor's row factory is switched to plain tuples, so rows are
+        transposed with ``zip`` and column names are sent once instead of per row.
+    """
+    cursor.row_factory = None
+    fields = [column[0] for column in cursor.description]
+    rows = cursor.fetchall()
+    columns = [list(column) for column in zip(*rows)] if rows else [[] for _ in fields]
+    return {"format": "columnar", "fields": fields, "columns": columns}
@@ -0,0 +1,260 @@
+import os
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+import click
+import requests as http
+from flask import request, g, current_app, jsonify
+from flask.cli import with_appcontext
+
+
+def rss_bytes():
+    """Resident set size of this process, or None where /proc is unavailable."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def site_label(traceback):
+    frame = traceback[0]
+    path = os.path.relpath(frame.filename)
+    if path.startswith('..'):
+        path = os.path.join(*frame.filename.split(os.sep)[-2:])
+    return f"{path}:{frame.lineno}"
+
+
+def top_sites(snapshot, previous, limit):
+    """
+    Diff two snapshots by allocation site.
+
+    Returns:
+        list: {"site", "size_diff", "count_diff", "size"} for the sites whose
+        retained size changed most, largest growth first
+    """
+    stats = snapshot.compare_to(previous, 'lineno')
+    return [{
+        "site": site_label(stat.traceback),
+        "size_diff": stat.size_diff,
+        "count_diff": stat.count_diff,
+        "size": stat.size,
+    } for stat in stats[:limit] if stat.size_diff]
+
+
+class MemoryProfiler:
+    """
+    Per-route allocation statistics from tracemalloc.
+
+    Every request records how far traced memory rose above its level at the
+    start of the request (the request's peak allocation). Every
+    ``snapshot_every``-th request of a route is also snapshotted before the view
+    and again once the response is built; the difference attributes the memory
+    the request still holds (response body, caches, leaks) to call sites.
+
+    Note:
+        tracemalloc has one process-wide peak, so with several threads serving
+        requests at once a request's peak includes its neighbours'
+        allocations. Run one thread per worker for exact numbers.
+    """
+
+    def __init__(self, frames=5, snapshot_every=10, top=10):
+        self.frames = frames
+        self.snapshot_every = snapshot_every
+        self.top = top
+        self.routes = defaultdict(lambda: {
+            "requests": 0, "peak_total": 0, "peak_max": 0,
+            "snapshots": 0, "sites": defaultdict(lambda: [0, 0]),
+        })
+        self._lock = threading.Lock()
+        self.started = None
+        self.baseline = None
+        self.previous = None
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        self.started = time.time()
+        self.baseline = self.previous = self._snapshot()
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+        ))
+
+    def before(self, route):
+        with self._lock:
+            sample = self.snapshot_every and self.routes[route]["requests"] % self.snapshot_every == 0
+        snapshot = self._snapshot() if sample else None
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        return current, snapshot
+
+    def after(self, route, start):
+        current_at_start, snapshot = start
+        _, peak = tracemalloc.get_traced_memory()
+        sites = top_sites(self._snapshot(), snapshot, self.top) if snapshot else None
+        with self._lock:
+            stats = self.routes[route]
+            stats["requests"] += 1
+            peak = max(0, peak - current_at_start)
+            stats["peak_total"] += peak
+            stats["peak_max"] = max(stats["peak_max"], peak)
+            if sites is not None:
+                stats["snapshots"] += 1
+                for site in sites:
+                    totals = stats["sites"][site["site"]]
+                    totals[0] += site["size_diff"]
+                    totals[1] += site["count_diff"]
+
+    def report(self, since='previous'):
+        """
+        Summarize memory use.
+
+        Args:
+            since (str): "previous" diffs against the snapshot taken by the last
+                report (and replaces it), "start" diffs against the one taken
+                when profiling started
+
+        Returns:
+            dict: RSS, traced memory, the snapshot diff and per-route statistics
+        """
+        snapshot = self._snapshot()
+        reference = self.baseline if since == 'start' else self.previous
+        growth = top_sites(snapshot, reference, self.top)
+        if since != 'start':
+            self.previous = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+
+        with self._lock:
+            routes = {}
+            for route, stats in self.routes.items():
+                sites = sorted(stats["sites"].items(), key=lambda item: -abs(item[1][0]))
+                routes[route] = {
+                    "requests": stats["requests"],
+                    "peak_bytes_mean": stats["peak_total"] // max(stats["requests"], 1),
+                    "peak_bytes_max": stats["peak_max"],
+                    "snapshots": stats["snapshots"],
+                    "retained_sites": [{
+                        "site": site,
+                        "size_diff_mean": size // max(stats["snapshots"], 1),
+                        "count_diff_mean": count / max(stats["snapshots"], 1),
+                    } for site, (size, count) in sites[:self.top]],
+                }
+
+        return {
+            "pid": os.getpid(),
+            "rss_bytes": rss_bytes(),
+            "traced_bytes": current,
+            "traced_peak_bytes": peak,
+            "tracing_since": self.started,
+            "diff_since": since,
+            "growth": growth,
+            "routes": routes,
+        }
+
+
+def init_app(app):
+    """
+    Enable allocation tracking and the /debug/memory endpoint when MEMORY_PROFILE is set.
+
+    Config:
+        MEMORY_PROFILE (bool): Turn tracemalloc tracking on (off by default; it
+            slows allocations down noticeably)
+        MEMORY_TRACE_FRAMES (int): Stack frames stored per allocation
+        MEMORY_SNAPSHOT_EVERY (int): Snapshot every Nth request per route (0 = never)
+        MEMORY_TOP (int): Call sites listed per report
+
+    Side-effects:
+        - Starts tracemalloc and stores the profiler in app.extensions['memory']
+        - Registers before_request / teardown_request hooks and GET /debug/memory
+    """
+    app.config.setdefault('MEMORY_PROFILE', False)
+    app.config.setdefault('MEMORY_TRACE_FRAMES', 5)
+    app.config.setdefault('MEMORY_SNAPSHOT_EVERY', 10)
+    app.config.setdefault('MEMORY_TOP', 10)
+    app.cli.add_command(memory_report_command)
+    if not app.config['MEMORY_PROFILE']:
+        return
+
+    profiler = MemoryProfiler(
+        app.config['MEMORY_TRACE_FRAMES'],
+        app.config['MEMORY_SNAPSHOT_EVERY'],
+        app.config['MEMORY_TOP'],
+    )
+    profiler.start()
+    app.extensions['memory'] = profiler
+    app.before_request(start_request)
+    app.teardown_request(finish_request)
+    app.add_url_rule('/debug/memory', 'debug_memory', debug_memory)
+
+
+def _route():
+    rule = request.url_rule
+    return f'{request.method} {rule.rule}' if rule else None
+
+
+def start_request():
+    route = _route()
+    if route is None or request.endpoint == 'debug_memory':
+        return
+    g.memory_start = (route, current_app.extensions['memory'].before(route))
+
+
+def finish_request(e=None):
+    start = g.pop('memory_start', None)
+    if start is not None:
+        current_app.extensions['memory'].after(*start)
+
+
+def debug_memory():
+    """
+    Report this worker's memory use.
+
+    Query:
+        since: "previous" (default) or "start", see MemoryProfiler.report
+    """
+    since = request.args.get('since', 'previous')
+    if since not in ('previous', 'start'):
+        return jsonify({"error": "since must be 'previous' or 'start'"}), 400
+    return jsonify(current_app.extensions['memory'].report(since))
+
+
+def print_report(report):
+    mib = 1024 * 1024
+    rss = f"{report['rss_bytes'] / mib:.1f} MiB" if report['rss_bytes'] else 'n/a'
+    click.echo(f"\npid {report['pid']}  rss {rss}  traced {report['traced_bytes'] / mib:.1f} MiB  "
+               f"traced peak {report['traced_peak_bytes'] / mib:.1f} MiB")
+    click.echo(f"Growth since {report['diff_since']} report:")
+    for site in report['growth']:
+        click.echo(f"  {site['size_diff'] / 1024:>+10.1f} KiB {site['count_diff']:>+8} blocks  {site['site']}")
+    click.echo(f"\n{'route':<45} {'requests':>8} {'peak mean KiB':>14} {'peak max KiB':>13}")
+    for route, stats in sorted(report['routes'].items(), key=lambda item: -item[1]['peak_bytes_max']):
+        click.echo(f"{route:<45} {stats['requests']:>8} {stats['peak_bytes_mean'] / 1024:>14.1f} "
+                   f"{stats['peak_bytes_max'] / 1024:>13.1f}")
+        for site in stats['retained_sites'][:3]:
+            click.echo(f"    retains {site['size_diff_mean'] / 1024:>+9.1f} KiB  {site['site']}")
+
+
+@click.command('memory-report')
+@click.option('--url', default='http://127.0.0.1:5000', show_default=True,
+              help='Base URL of an app started with WEATHER_MEMORY_PROFILE=true.')
+@click.option('--since', type=click.Choice(['previous', 'start']), default='previous', show_default=True)
+@click.option('--watch', default=0.0, help='Repeat every N seconds, printing growth since the last report.')
+@click.option('--count', default=0, help='Stop after this many reports when watching (0 = forever).')
+@with_appcontext
+def memory_report_command(url, since, watch, count):
+    """Print a running app's memory report, optionally repeatedly."""
+    reports = 0
+    while True:
+        response = http.get(f"{url.rstrip('/')}/debug/memory", params={'since': since}, timeout=30)
+        if response.status_code != 200:
+            raise click.ClickException(
+                f"{response.status_code} from /debug/memory; is the app running with MEMORY_PROFILE?")
+        print_report(response.json())
+        reports += 1
+        if not watch or reports == count:
+            break
+        time.sleep(watch)
@@ -0,0 +1,229 @@
+import re
+import threading
+import time
+from collections import defaultdict
+from flask import request, g, current_app
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_WHITESPACE = re.compile(r'\s+')
+# IN lists with one placeholder per value, as built by database.fan_out
+_PLACEHOLDER_LIST = re.compile(r'\bIN \(\?(?:, ?\?)*\)', re.IGNORECASE)
+# Distinct statement labels kept; later new statements are counted as "other"
+MAX_STATEMENT_LABELS = 500
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def normalize_sql(sql):
+    """
+    Collapse whitespace, and ``IN (?, ?, ...)`` lists to ``IN (...)``, so the
+    same statement always maps to one label whatever the number of values.
+    """
+    return _PLACEHOLDER_LIST.sub('IN (...)', _WHITESPACE.sub(' ', sql).strip())
+
+
+class MetricsRegistry:
+    """
+    Process-wide request, database and cache metrics.
+
+    All updates take a single lock and touch only a few dict entries, so the
+    cost per request is a handful of microseconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.request_latency = defaultdict(Histogram)
+        self.statement_latency = defaultdict(Histogram)
+        self.statement_fetch_seconds = defaultdict(float)
+        self.db_connect = Histogram()
+        self.cache = defaultdict(lambda: [0, 0])
+        self._sql_labels = {}
+
+    def observe_request(self, method, route, status, seconds):
+        with self._lock:
+            self.requests[(method, route, status)] += 1
+            self.request_latency[(method, route)].observe(seconds)
+
+    def observe_statement(self, sql, phase, seconds):
+        label = self._sql_labels.get(sql)
+        if label is None:
+            label = normalize_sql(sql)
+            if label not in self.statement_latency and len(self.statement_latency) >= MAX_STATEMENT_LABELS:
+                label = 'other'
+            if len(self._sql_labels) < 4 * MAX_STATEMENT_LABELS:
+                self._sql_labels[sql] = label
+        with self._lock:
+            if phase == 'execute':
+                self.statement_latency[label].observe(seconds)
+            else:
+                self.statement_fetch_seconds[label] += seconds
+
+    def observe_connect(self, seconds):
+        with self._lock:
+            self.db_connect.observe(seconds)
+
+    def record_cache(self, name, hit):
+        with self._lock:
+            self.cache[name][0 if hit else 1] += 1
+
+    def render(self, admission=None):
+        """
+        Render all metrics in the Prometheus text exposition format (0.0.4).
+
+        Args:
+            admission (AdmissionController): Optional controller whose queue
+                depth and shed counts are included
+
+        Returns:
+            str: The exposition text
+        """
+        lines = []
+        with self._lock:
+            lines.append('# HELP weather_http_requests_total HTTP requests by route and status.')
+            lines.append('# TYPE weather_http_requests_total counter')
+            for (method, route, status), count in sorted(self.requests.items()):
+                lines.append(
+                    f'weather_http_requests_total{{method="{method}",route="{_label(route)}",'
+                    f'status="{status}"}} {count}'
+                )
+
+            lines.append('# HELP weather_http_request_duration_seconds Request latency by route.')
+            lines.append('# TYPE weather_http_request_duration_seconds histogram')
+            for (method, route), histogram in sorted(self.request_latency.items()):
+                lines.extend(histogram.render(
+                    'weather_http_request_duration_seconds',
+                    f'method="{method}",route="{_label(route)}"'
+                ))
+
+            lines.append('# HELP weather_db_statement_duration_seconds SQLite execute() time per statement.')
+            lines.append('# TYPE weather_db_statement_duration_seconds histogram')
+            for sql, histogram in sorted(self.statement_latency.items()):
+                lines.extend(histogram.render(
+                    'weather_db_statement_duration_seconds', f'statement="{_label(sql)}"'
+                ))
+
+            lines.append('# HELP weather_db_statement_fetch_seconds_total Time spent fetching rows per statement.')
+            lines.append('# TYPE weather_db_statement_fetch_seconds_total counter')
+            for sql, seconds in sorted(self.statement_fetch_seconds.items()):
+                lines.append(f'weather_db_statement_fetch_seconds_total{{statement="{_label(sql)}"}} {seconds}')
+
+            lines.append('# HELP weather_db_connect_duration_seconds Time to open a connection in get_db.')
+            lines.append('# TYPE weather_db_connect_duration_seconds histogram')
+            lines.extend(self.db_connect.render('weather_db_connect_duration_seconds', 'database="main"'))
+
+            lines.append('# HELP weather_cache_requests_total Cache lookups by cache and result.')
+            lines.append('# TYPE weather_cache_requests_total counter')
+            lines.append('# HELP weather_cache_hit_ratio Hits divided by lookups per cache.')
+            lines.append('# TYPE weather_cache_hit_ratio gauge')
+            for name, (hits, misses) in sorted(self.cache.items()):
+                lines.append(f'weather_cache_requests_total{{cache="{name}",result="hit"}} {hits}')
+                lines.append(f'weather_cache_requests_total{{cache="{name}",result="miss"}} {misses}')
+                lines.append(f'weather_cache_hit_ratio{{cache="{name}"}} {hits / (hits + misses)}')
+
+        if admission is not None:
+            stats = admission.stats()
+            lines.append('# HELP weather_admission_queue_depth Requests waiting for a slot.')
+            lines.append('# TYPE weather_admission_queue_depth gauge')
+            lines.append(f'weather_admission_queue_depth {stats["queue_depth"]}')
+            lines.append('# HELP weather_admission_shed_total Requests rejected with 503.')
+            lines.append('# TYPE weather_admission_shed_total counter')
+            for route, route_stats in stats['routes'].items():
+                lines.append(f'weather_admission_shed_total{{route="{_label(route)}"}} {route_stats["shed"]}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def record_cache(name, hit):
+    """
+    Count a cache hit or miss if metrics are enabled on the current app.
+
+    Args:
+        name (str): The cache name used as the ``cache`` label
+        hit (bool): Whether the lookup was served from the cache
+    """
+    registry = current_app.extensions.get('metrics')
+    if registry is not None:
+        registry.record_cache(name, hit)
+
+
+def init_app(app):
+    """
+    Collect request and database metrics for the app.
+
+    Config:
+        METRICS_ENABLED (bool): Turn metric collection on or off
+
+    Side-effects:
+        - Stores a MetricsRegistry in app.extensions['metrics']
+        - Adds a statement listener to app.extensions['db_listeners']
+        - Registers before_request / after_request / teardown_request hooks
+    """
+    app.config.setdefault('METRICS_ENABLED', True)
+    if not app.config['METRICS_ENABLED']:
+        return
+
+    registry = MetricsRegistry()
+    app.extensions['metrics'] = registry
+    app.extensions.setdefault('db_listeners', []).append(registry.observe_statement)
+    app.before_request(start_timer)
+    app.after_request(record_status)
+    app.teardown_request(observe_request)
+
+
+def start_timer():
+    g.metrics_start = time.perf_counter()
+
+
+def record_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+def observe_request(e=None):
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return
+    registry = current_app.extensions['metrics']
+    rule = request.url_rule
+    registry.observe_request(
+        request.method,
+        rule.rule if rule is not None else 'unmatched',
+        g.pop('metrics_status', 500),
+        time.perf_counter() - start
+    )
+    connect_seconds = g.pop('db_connect_seconds', None)
+    if connect_seconds is not None:
+        registry.observe_connect(connect_seconds)
@@ -0,0 +1,240 @@
+"""
+Deterministic local stand-in for the OpenWeatherMap One Call 3.0 API.
+
+Serves ``/data/3.0/onecall`` and ``/data/3.0/onecall/timemachine`` with synthetic
+but stable data: the same seed, coordinates and hour always produce the same
+weather. Latency, 5xx errors and 429 rate limiting can be injected, and every
+request is counted so cache effectiveness can be measured.
+
+Usage:
+    python owm_stub.py --port 5001 --latency lognormal:40:0.5 --rate-limit-rate 0.02
+    OPENWEATHER_BASE_URL=http://127.0.0.1:5001 python run.py
+
+Endpoints besides the API:
+    GET  /__stats  request counts per endpoint and status
+    POST /__reset  reset the counters
+"""
+import argparse
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from flask import Flask, request, jsonify
+
+CONDITIONS = [
+    (800, 'Clear', 'clear sky', '01'), (801, 'Clouds', 'few clouds', '02'),
+    (802, 'Clouds', 'scattered clouds', '03'), (803, 'Clouds', 'broken clouds', '04'),
+    (804, 'Clouds', 'overcast clouds', '04'), (500, 'Rain', 'light rain', '10'),
+    (501, 'Rain', 'moderate rain', '10'), (211, 'Thunderstorm', 'thunderstorm', '11'),
+    (600, 'Snow', 'light snow', '13'), (701, 'Mist', 'mist', '50'),
+]
+
+
+def parse_latency(spec):
+    """
+    Parse a latency distribution into a function returning seconds.
+
+    Args:
+        spec (str): "none", "fixed:MS", "uniform:MIN_MS:MAX_MS" or
+            "lognormal:MEDIAN_MS:SIGMA"
+
+    Returns:
+        callable: Takes a random.Random and returns a delay in seconds
+    """
+    kind, *params = spec.split(':')
+    values = [float(p) for p in params]
+    if kind == 'none':
+        return lambda rng: 0.0
+    if kind == 'fixed':
+        return lambda rng: values[0] / 1000
+    if kind == 'uniform':
+        return lambda rng: rng.uniform(values[0], values[1]) / 1000
+    if kind == 'lognormal':
+        mu = math.log(values[0])
+        return lambda rng: rng.lognormvariate(mu, values[1]) / 1000
+    raise ValueError(f"unknown latency distribution: {spec}")
+
+
+def convert_temperature(kelvin, units):
+    if units == 'metric':
+        return round(kelvin - 273.15, 2)
+    if units == 'imperial':
+        return round((kelvin - 273.15) * 9 / 5 + 32, 2)
+    return round(kelvin, 2)
+
+
+def observation(seed, lat, lon, dt, units):
+    """
+    Synthesize one hourly observation for a point and time.
+
+    The values depend only on (seed, lat, lon, hour of dt), so repeated calls
+    agree with each other and with the timemachine endpoint.
+    """
+    hour = dt // 3600
+    rng = random.Random(f'{seed}:{lat:.4f}:{lon:.4f}:{hour}')
+    daily_cycle = math.sin((hour % 24 - 9) / 24 * 2 * math.pi)
+    seasonal = math.cos((dt / 86400 % 365 - 200) / 365 * 2 * math.pi) * (1 if lat >= 0 else -1)
+    kelvin = 298.0 - abs(lat) * 0.4 + 8 * seasonal + 5 * daily_cycle + rng.uniform(-1.5, 1.5)
+    wind_speed = round(rng.uniform(0, 12), 2)
+    condition_id, main, description, icon = CONDITIONS[rng.randrange(len(CONDITIONS))]
+    if units == 'imperial':
+        wind_speed = round(wind_speed * 2.237, 2)
+    return {
+        'dt': dt,
+        'temp': convert_temperature(kelvin, units),
+        'feels_like': convert_temperature(kelvin - wind_speed * 0.3, units),
+        'pressure': rng.randint(990, 1030),
+        'humidity': rng.randint(30, 95),
+        'dew_point': convert_temperature(kelvin - rng.uniform(2, 10), units),
+        'uvi': round(max(0.0, daily_cycle) * rng.uniform(0, 9), 2),
+        'clouds': rng.randint(0, 100),
+        'visibility': 10000,
+        'wind_speed': wind_speed,
+        'wind_deg': rng.randrange(360),
+        'weather': [{
+            'id': condition_id, 'main': main, 'description': description,
+            'icon': icon + ('d' if 6 <= hour % 24 < 18 else 'n')
+        }],
+    }
+
+
+def daily(seed, lat, lon, dt, units):
+    noon = dt // 86400 * 86400 + 12 * 3600
+    day = observation(seed, lat, lon, noon, units)
+    night = observation(seed, lat, lon, noon + 12 * 3600, units)
+    low, high = sorted((day['temp'], night['temp']))
+    return dict(
+        day,
+        temp={'day': day['temp'], 'min': low, 'max': high, 'night': night['temp'],
+              'eve': day['temp'], 'morn': night['temp']},
+        feels_like={'day': day['feels_like'], 'night': night['feels_like'],
+                    'eve': day['feels_like'], 'morn': night['feels_like']},
+        pop=round(random.Random(f'{seed}:{noon}').random(), 2),
+    )
+
+
+def create_stub_app(seed=42, latency='none', error_rate=0.0, rate_limit_rate=0.0, now=None):
+    """
+    Build the stub Flask app.
+
+    Args:
+        seed (int): Seed for the synthetic data
+        latency (str): Latency distribution, see ``parse_latency``
+        error_rate (float): Probability of answering with 500
+        rate_limit_rate (float): Probability of answering with 429
+        now (callable): Returns the current timestamp (defaults to time.time)
+
+    Returns:
+        Flask: The app; its ``stats`` attribute holds the request counters
+    """
+    stub = Flask(__name__)
+    delay = parse_latency(latency)
+    rng = random.Random(seed)
+    rng_lock = threading.Lock()
+    stats_lock = threading.Lock()
+    stub.stats = defaultdict(int)
+    now = now or time.time
+
+    def count(status):
+        with stats_lock:
+            stub.stats[f'{request.path} {status}'] += 1
+
+    @stub.before_request
+    def inject_faults():
+        if request.path.startswith('/__'):
+            return None
+        with rng_lock:
+            sleep_for = delay(rng)
+            roll = rng.random()
+        if sleep_for:
+            time.sleep(sleep_for)
+        if not request.args.get('appid'):
+            count(401)
+            return jsonify({'cod': 401, 'message': 'Invalid API key.'}), 401
+        if roll < rate_limit_rate:
+            count(429)
+            return jsonify({'cod': 429, 'message': 'Too many requests.'}), 429, {'Retry-After': '1'}
+        if roll < rate_limit_rate + error_rate:
+            count(500)
+            return jsonify({'cod': 500, 'message': 'Internal error.'}), 500
+        return None
+
+    def coordinates():
+        try:
+            return float(request.args['lat']), float(request.args['lon'])
+        except (KeyError, ValueError):
+            return None
+
+    @stub.route('/data/3.0/onecall')
+    def onecall():
+        point = coordinates()
+        if point is None:
+            count(400)
+            return jsonify({'cod': '400', 'message': 'wrong latitude or longitude'}), 400
+        lat, lon = point
+        units = request.args.get('units', 'standard')
+        exclude = set(filter(None, request.args.get('exclude', '').split(',')))
+        current_time = int(now())
+        hour = current_time // 3600 * 3600
+        body = {'lat': lat, 'lon': lon, 'timezone': 'UTC', 'timezone_offset': 0}
+        if 'current' not in exclude:
+            body['current'] = dict(observation(seed, lat, lon, hour, units), dt=current_time)
+        if 'minutely' not in exclude:
+            body['minutely'] = [{'dt': current_time // 60 * 60 + m * 60, 'precipitation': 0}
+                                for m in range(60)]
+        if 'hourly' not in exclude:
+            body['hourly'] = [observation(seed, lat, lon, hour + h * 3600, units) for h in range(48)]
+        if 'daily' not in exclude:
+            body['daily'] = [daily(seed, lat, lon, hour + d * 86400, units) for d in range(8)]
+        if 'alerts' not in exclude:
+            body['alerts'] = []
+        count(200)
+        return jsonify(body)
+
+    @stub.route('/data/3.0/onecall/timemachine')
+    def timemachine():
+        point = coordinates()
+        if point is None or not request.args.get('dt', '').isdigit():
+            count(400)
+            return jsonify({'cod': '400', 'message': 'wrong latitude, longitude or dt'}), 400
+        lat, lon = point
+        dt = int(request.args['dt'])
+        units = request.args.get('units', 'standard')
+        count(200)
+        return jsonify({
+            'lat': lat, 'lon': lon, 'timezone': 'UTC', 'timezone_offset': 0,
+            'data': [observation(seed, lat, lon, dt, units)]
+        })
+
+    @stub.route('/__stats')
+    def stats():
+        with stats_lock:
+            return jsonify(dict(stub.stats))
+
+    @stub.route('/__reset', methods=['POST'])
+    def reset():
+        with stats_lock:
+            stub.stats.clear()
+        return jsonify({'message': 'reset'})
+
+    return stub
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--latency', default='none',
+                        help='none | fixed:MS | uniform:MIN:MAX | lognormal:MEDIAN_MS:SIGMA')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    stub = create_stub_app(args.seed, args.latency, args.error_rate, args.rate_limit_rate)
+    stub.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,479 @@
+import calendar
+import os
+import re
+import shutil
+import sqlite3
+import stat
+import time
+import urllib.parse
+from bisect import bisect_left
+from itertools import repeat
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from column_blocks import encode_column, decode_column
+
+# SQLite's default SQLITE_MAX_ATTACHED is 10; a range read attaches at most
+# this many partitions and serves anything older from the daily rollups
+MAX_ATTACHED = 8
+
+_WRITE_BITS = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+# weather_history_YYYY_MM.db, or weather_history_YYYY_MM.shardN.db for shard N
+# (condition ids are per shard, so each shard archives into its own files)
+PARTITION_NAME = re.compile(r'^weather_history_(\d{4})_(\d{2})(?:\.shard(\d+))?\.db$')
+
+# Columns of a block, each stored as one column_blocks blob; ids and
+# timestamps are (nearly) evenly spaced, so they use delta-of-delta
+BLOCK_COLUMNS = ('id', 'timestamp', 'temperature', 'feels_like', 'pressure',
+                 'humidity', 'wind_speed', 'wind_deg', 'condition_id')
+REGULAR_COLUMNS = ('id', 'timestamp')
+
+# A partition file is a standalone database: the archived rows of one month
+# (ids kept from weather_history) and a copy of the condition lookup table.
+# While the month is open rows are appended to weather_history; sealing packs
+# them into one compressed block per location in weather_history_blocks.
+PARTITION_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS weather_conditions (
+    id INTEGER PRIMARY KEY,
+    description TEXT,
+    icon TEXT
+);
+
+CREATE TABLE IF NOT EXISTS weather_history (
+    id INTEGER PRIMARY KEY,
+    location_id INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    temperature REAL,
+    feels_like REAL,
+    pressure INTEGER,
+    humidity INTEGER,
+    wind_speed REAL,
+    wind_deg INTEGER,
+    condition_id INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS idx_weather_history_location_time
+    ON weather_history (location_id, timestamp);
+
+CREATE TABLE IF NOT EXISTS weather_history_blocks (
+    location_id INTEGER PRIMARY KEY,
+    first_timestamp INTEGER NOT NULL,
+    last_timestamp INTEGER NOT NULL,
+    row_count INTEGER NOT NULL,
+    id BLOB,
+    timestamp BLOB,
+    temperature BLOB,
+    feels_like BLOB,
+    pressure BLOB,
+    humidity BLOB,
+    wind_speed BLOB,
+    wind_deg BLOB,
+    condition_id BLOB
+);
+
+CREATE VIEW IF NOT EXISTS weather_history_rows AS
+SELECT w.id, w.location_id, w.timestamp, w.temperature, w.feels_like, w.pressure,
+       w.humidity, w.wind_speed, w.wind_deg, c.description, c.icon
+FROM weather_history w LEFT JOIN weather_conditions c ON c.id = w.condition_id;
+'''
+
+
+def month_start(timestamp):
+    """First second (UTC) of the month containing ``timestamp``."""
+    year, month = time.gmtime(timestamp)[:2]
+    return calendar.timegm((year, month, 1, 0, 0, 0))
+
+
+def next_month(timestamp):
+    """First second (UTC) of the month after the one containing ``timestamp``."""
+    year, month = time.gmtime(timestamp)[:2]
+    return calendar.timegm((year + month // 12, month % 12 + 1, 1, 0, 0, 0))
+
+
+def month_label(timestamp):
+    return time.strftime('%Y-%m', time.gmtime(timestamp))
+
+
+def parse_month(label):
+    """
+    Returns:
+        int: The month start of a "YYYY-MM" label
+
+    Raises:
+        ValueError: If the label is not a month
+    """
+    return calendar.timegm(time.strptime(label, '%Y-%m'))
+
+
+class HistoryArchive:
+    """
+    Monthly weather_history partitions stored as separate SQLite files.
+
+    The main database's weather_history table is the hot partition: requests
+    only ever write there. Retention moves raw rows that leave the raw window
+    into the file of their month, and once a month is entirely outside the
+    window its file is vacuumed and sealed (made read-only). Range reads
+    attach just the files of the months they overlap.
+
+    Args:
+        directory (str): Folder holding the ``weather_history_YYYY_MM.db`` files
+        shard (int): The weather shard whose history this is (None when not
+            sharded); its files are named ``weather_history_YYYY_MM.shardN.db``
+
+    Note:
+        Sealed files never change, so they can be backed up or detached
+        (moved out of the folder) as whole files.
+    """
+
+    def __init__(self, directory, shard=None):
+        self.directory = directory
+        self.shard = shard
+
+    def path(self, month):
+        suffix = '.db' if self.shard is None else f'.shard{self.shard}.db'
+        return os.path.join(self.directory, time.strftime('weather_history_%Y_%m', time.gmtime(month)) + suffix)
+
+    def partitions(self):
+        """
+        Returns:
+            list: ``(month_start, path, sealed)`` of every partition file, oldest first
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        found = []
+        for entry in os.scandir(self.directory):
+            match = PARTITION_NAME.match(entry.name)
+            if match and (None if match[3] is None else int(match[3])) == self.shard:
+                month = calendar.timegm((int(match[1]), int(match[2]), 1, 0, 0, 0))
+                found.append((month, entry.path, is_sealed(entry.path)))
+        return sorted(found)
+
+    def archive_rows(self, db, location_id, start, end):
+        """
+        Copy one location's weather_history rows in [start, end) into their month files.
+
+        Each month's copy is committed before returning, so call it with no
+        transaction open and delete the rows from weather_history afterwards;
+        copying again after a crash in between is harmless (ids are kept).
+
+        Returns:
+            tuple: (rows archived, rows skipped because their month is sealed)
+        """
+        archived = skipped = 0
+        month = month_start(start)
+        while month < end:
+            lower, upper = max(start, month), min(end, next_month(month))
+            path = self.path(month)
+            if os.path.exists(path) and is_sealed(path):
+                skipped += db.execute(
+                    'SELECT COUNT(*) FROM weather_history WHERE location_id = ? AND timestamp >= ? AND timestamp < ?',
+                    (location_id, lower, upper)
+                ).fetchone()[0]
+            else:
+                archived += self._copy_month(db, path, location_id, lower, upper)
+            month = next_month(month)
+        return archived, skipped
+
+    def _copy_month(self, db, path, location_id, lower, upper):
+        if not os.path.exists(path):
+            os.makedirs(self.directory, exist_ok=True)
+            partition = sqlite3.connect(path)
+            partition.executescript(PARTITION_SCHEMA)
+            partition.close()
+        alias = 'archive_' + os.path.basename(path)[len('weather_history_'):-len('.db')]
+        db.execute('ATTACH DATABASE ? AS ' + alias, (path,))
+        try:
+            db.execute(f'''
+                INSERT OR IGNORE INTO {alias}.weather_conditions
+                SELECT * FROM main.weather_conditions
+                WHERE id > (SELECT IFNULL(MAX(id), 0) FROM {alias}.weather_conditions)
+            ''')
+            copied = db.execute(f'''
+                INSERT OR IGNORE INTO {alias}.weather_history
+                SELECT id, location_id, timestamp, temperature, feels_like, pressure,
+                       humidity, wind_speed, wind_deg, condition_id
+                FROM main.weather_history
+                WHERE location_id = ? AND timestamp >= ? AND timestamp < ?
+            ''', (location_id, lower, upper)).rowcount
+            db.commit()
+        finally:
+            db.execute('DETACH DATABASE ' + alias)
+        return copied
+
+    def delete_location(self, location_id):
+        """
+        Delete a location's rows from every open partition.
+
+        Sealed partitions are read-only and keep the rows of a deleted
+        location until the month is detached.
+
+        Returns:
+            int: Rows deleted
+        """
+        deleted = 0
+        for month, path, sealed in self.partitions():
+            if sealed:
+                continue
+            partition = sqlite3.connect(path)
+            try:
+                deleted += partition.execute('DELETE FROM weather_history WHERE location_id = ?',
+                                             (location_id,)).rowcount
+                partition.commit()
+            finally:
+                partition.close()
+        return deleted
+
+    def seal_before(self, cutoff):
+        """
+        Pack, vacuum and make read-only every open partition of a month ending by ``cutoff``.
+
+        Returns:
+            list: Labels of the months sealed
+        """
+        sealed = []
+        for month, path, already_sealed in self.partitions():
+            if already_sealed or next_month(month) > cutoff:
+                continue
+            partition = sqlite3.connect(path)
+            pack_blocks(partition)
+            partition.execute('VACUUM')
+            partition.close()
+            make_read_only(path)
+            sealed.append(month_label(month))
+        return sealed
+
+    def attach_for_range(self, db, start, end):
+        """
+        Attach (read-only) the partitions overlapping [start, end), newest first.
+
+        At most MAX_ATTACHED are attached; partitions stay attached until the
+        connection is closed, which for request connections is at teardown.
+
+        Returns:
+            list: ``(schema_name, month_start)`` of the attached partitions
+        """
+        attached = {row[1] for row in db.execute('PRAGMA database_list')}
+        selected = []
+        for month, path, sealed in reversed(self.partitions()):
+            if month >= end or next_month(month) <= start:
+                continue
+            if len(selected) == MAX_ATTACHED:
+                break
+            name = time.strftime('history_%Y_%m', time.gmtime(month))
+            if name not in attached:
+                db.execute(f'ATTACH DATABASE ? AS {name}', (read_only_uri(path, immutable=sealed),))
+            selected.append((name, month))
+        return selected
+
+
+def pack_blocks(partition):
+    """
+    Replace a partition's weather_history rows by compressed column blocks.
+
+    Each location's rows become one row of weather_history_blocks holding
+    every column as a column_blocks blob, in timestamp order.
+
+    Args:
+        partition (sqlite3.Connection): Writable connection to the partition file
+
+    Returns:
+        int: Rows packed
+    """
+    partition.executescript(PARTITION_SCHEMA)
+    packed = 0
+    locations = [row[0] for row in partition.execute('SELECT DISTINCT location_id FROM weather_history')]
+    for location_id in locations:
+        rows = partition.execute(f'''
+            SELECT {', '.join(BLOCK_COLUMNS)} FROM weather_history
+            WHERE location_id = ? ORDER BY timestamp, id
+        ''', (location_id,)).fetchall()
+        block = partition.execute('SELECT * FROM weather_history_blocks WHERE location_id = ?',
+                                  (location_id,)).fetchone()
+        if block is not None:
+            rows = sorted(_block_rows(block) + rows, key=lambda row: (row[1], row[0]))
+        columns = [list(column) for column in zip(*rows)]
+        partition.execute(f'''
+            INSERT OR REPLACE INTO weather_history_blocks
+            (location_id, first_timestamp, last_timestamp, row_count, {', '.join(BLOCK_COLUMNS)})
+            VALUES (?, ?, ?, ?, {', '.join('?' * len(BLOCK_COLUMNS))})
+        ''', (location_id, columns[1][0], columns[1][-1], len(rows),
+              *(encode_column(column, name in REGULAR_COLUMNS) for name, column in zip(BLOCK_COLUMNS, columns))))
+        packed += partition.execute('DELETE FROM weather_history WHERE location_id = ?', (location_id,)).rowcount
+        partition.commit()
+    return packed
+
+
+def _block_rows(block):
+    """Rows (in BLOCK_COLUMNS order) of a ``SELECT *`` weather_history_blocks row."""
+    return list(zip(*(decode_column(blob) for blob in block[4:])))
+
+
+def load_blocks(db, schemas, location_id, start, end):
+    """
+    Decode the blocks of a location overlapping [start, end) into temp.cold_history.
+
+    Args:
+        db (sqlite3.Connection): Connection the partitions are attached to
+        schemas (list): Names of the attached partitions
+
+    Returns:
+        int or None: The oldest timestamp in the location's blocks, so the
+        caller knows which days raw rows cover
+    """
+    db.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS cold_history (
+            id INTEGER, location_id INTEGER, timestamp INTEGER, temperature REAL,
+            feels_like REAL, pressure INTEGER, humidity INTEGER, wind_speed REAL,
+            wind_deg INTEGER, condition_id INTEGER
+        )
+    ''')
+    db.execute('DELETE FROM temp.cold_history')
+    oldest = None
+    for schema in schemas:
+        if not db.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE name = 'weather_history_blocks'").fetchone():
+            continue  # sealed before blocks existed; its rows are still in weather_history
+        block = db.execute(f'''
+            SELECT first_timestamp, last_timestamp, {', '.join(BLOCK_COLUMNS)}
+            FROM {schema}.weather_history_blocks WHERE location_id = ?
+        ''', (location_id,)).fetchone()
+        if block is None:
+            continue
+        oldest = block[0] if oldest is None else min(oldest, block[0])
+        if block[0] >= end or block[1] < start:
+            continue
+        timestamps = decode_column(block[3])
+        first, last = bisect_left(timestamps, start), bisect_left(timestamps, end)
+        columns = [timestamps[first:last] if name == 'timestamp' else decode_column(blob, last)[first:]
+                   for name, blob in zip(BLOCK_COLUMNS, block[2:])]
+        db.executemany(
+            'INSERT INTO temp.cold_history VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            zip(columns[0], repeat(location_id), *columns[1:])
+        )
+    # Only the temp database was written; end the transaction so no read lock lingers
+    db.commit()
+    return oldest
+
+
+def read_only_uri(path, immutable=False):
+    """
+    URI opening ``path`` read-only; ``immutable`` (only for sealed files)
+    also skips file locking and change detection.
+    """
+    uri = 'file:' + urllib.parse.quote(os.path.abspath(path)) + '?mode=ro'
+    return uri + '&immutable=1' if immutable else uri
+
+
+def is_sealed(path):
+    return not os.stat(path).st_mode & _WRITE_BITS
+
+
+def make_read_only(path):
+    os.chmod(path, os.stat(path).st_mode & ~_WRITE_BITS)
+
+
+def get_archive(app=None, shard=None):
+    """
+    Args:
+        app (Flask): The app (defaults to current_app)
+        shard (int): The weather shard (see database.weather_shard), None when not sharded
+
+    Returns:
+        HistoryArchive or None: The archive, None when HISTORY_ARCHIVE_DIR is not set
+    """
+    directory = (app or current_app).config.get('HISTORY_ARCHIVE_DIR')
+    return HistoryArchive(directory, shard) if directory else None
+
+
+def init_app(app):
+    """
+    Configure monthly history partitions.
+
+    Config:
+        HISTORY_ARCHIVE_DIR (str): Folder for the monthly partition files
+            (None keeps all raw history in weather_history and lets
+            retention delete it after RETENTION_RAW_DAYS)
+
+    Side-effects:
+        - Registers the history-partitions, detach-history and
+          attach-history commands
+    """
+    app.config.setdefault('HISTORY_ARCHIVE_DIR', None)
+    app.cli.add_command(history_partitions_command)
+    app.cli.add_command(detach_history_command)
+    app.cli.add_command(attach_history_command)
+
+
+def _require_archives():
+    """The archive of every weather shard (just one when not sharded)."""
+    if not current_app.config.get('HISTORY_ARCHIVE_DIR'):
+        raise click.ClickException('HISTORY_ARCHIVE_DIR is not set.')
+    shards = current_app.config.get('SHARDS', 0)
+    return [get_archive(shard=shard) for shard in (range(shards) if shards else [None])]
+
+
+@click.command('history-partitions')
+@with_appcontext
+def history_partitions_command():
+    """List the monthly history partition files."""
+    archives = _require_archives()
+    partitions = sorted(partition for archive in archives for partition in archive.partitions())
+    if not partitions:
+        click.echo(f'No partitions in {archives[0].directory}.')
+    for month, path, sealed in partitions:
+        partition = sqlite3.connect(read_only_uri(path), uri=True)
+        rows = partition.execute('SELECT COUNT(*) FROM weather_history').fetchone()[0]
+        blocks = packed = 0
+        if partition.execute("SELECT 1 FROM sqlite_master WHERE name = 'weather_history_blocks'").fetchone():
+            blocks, packed = partition.execute(
+                'SELECT COUNT(*), IFNULL(SUM(row_count), 0) FROM weather_history_blocks'
+            ).fetchone()
+        partition.close()
+        click.echo(f"{os.path.basename(path):<36}  {rows + packed:>10} rows  {blocks:>6} blocks  "
+                   f"{os.path.getsize(path) / 1e6:>8.1f} MB  {'sealed' if sealed else 'open'}")
+
+
+@click.command('detach-history')
+@click.argument('month')
+@click.option('--to', 'destination', required=True, type=click.Path(file_okay=False),
+              help='Folder the partition file is moved to.')
+@with_appcontext
+def detach_history_command(month, destination):
+    """Move the sealed partition(s) of MONTH (YYYY-MM) out of the archive."""
+    try:
+        paths = [archive.path(parse_month(month)) for archive in _require_archives()]
+    except ValueError:
+        raise click.BadParameter('expected YYYY-MM', param_hint='MONTH')
+    paths = [path for path in paths if os.path.exists(path)]
+    if not paths:
+        raise click.ClickException(f'No partition for {month}.')
+    if not all(map(is_sealed, paths)):
+        raise click.ClickException(f'{month} is still open; it is sealed once retention has moved all of it.')
+    os.makedirs(destination, exist_ok=True)
+    for path in paths:
+        shutil.move(path, os.path.join(destination, os.path.basename(path)))
+    click.echo(f'Detached {month}; range reads serve it from the daily rollups until it is attached again.')
+
+
+@click.command('attach-history')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@with_appcontext
+def attach_history_command(path):
+    """Move a partition file (e.g. a detached one) back into the archive, read-only."""
+    archive = _require_archives()[0]
+    if not PARTITION_NAME.match(os.path.basename(path)):
+        raise click.BadParameter('expected a weather_history_YYYY_MM[.shardN].db file', param_hint='PATH')
+    partition = sqlite3.connect(read_only_uri(path), uri=True)
+    try:
+        partition.execute('SELECT id, location_id, timestamp, condition_id FROM weather_history LIMIT 1')
+    except sqlite3.DatabaseError as e:
+        raise click.ClickException(f'{path} is not a history partition: {e}')
+    finally:
+        partition.close()
+    target = os.path.join(archive.directory, os.path.basename(path))
+    if os.path.exists(target):
+        raise click.ClickException(f'{target} already exists.')
+    os.makedirs(archive.directory, exist_ok=True)
+    shutil.move(path, target)
+    make_read_only(target)
+    click.echo(f'Attached {target}.')
@@ -0,0 +1,367 @@
+"""
+Password hashing: pluggable key-derivation hashers, calibration of their
+cost, and a bounded pool that runs them off the request thread.
+
+A stored hash names its hasher and parameters, e.g.
+``pbkdf2_sha256$600000$<hex>`` or ``scrypt$32768$8$1$<hex>``; hashes written
+before this module (a bare SHA-256 hex digest) are still verified. On login
+a hash not made with the configured hasher and parameters is replaced.
+"""
+import functools
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import click
+from flask import current_app, has_app_context, jsonify
+from flask.cli import with_appcontext
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+
+class Pbkdf2Hasher:
+    """
+    PBKDF2-HMAC-SHA256.
+
+    Args:
+        iterations (int): Cost, linear in the time a hash takes
+    """
+    algorithm = 'pbkdf2_sha256'
+
+    def __init__(self, iterations=600000):
+        self.iterations = int(iterations)
+
+    @property
+    def prefix(self):
+        return f'{self.algorithm}${self.iterations}'
+
+    @classmethod
+    def from_encoded(cls, encoded):
+        return cls(encoded.split('$')[1])
+
+    def encode(self, password, salt):
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), self.iterations)
+        return f'{self.prefix}${digest.hex()}'
+
+    @classmethod
+    def calibrate(cls, target, measure):
+        """Parameters taking about ``target`` seconds, using ``measure(hasher)``."""
+        probe = cls(100000)
+        iterations = probe.iterations * target / measure(probe)
+        return {"iterations": max(1000, int(round(iterations, -3)))}
+
+
+class ScryptHasher:
+    """
+    scrypt, memory-hard: a hash needs about 128 * n * r bytes.
+
+    Args:
+        n (int): CPU and memory cost, a power of two
+        r (int): Block size
+        p (int): Parallelism
+    """
+    algorithm = 'scrypt'
+
+    def __init__(self, n=2 ** 15, r=8, p=1):
+        self.n, self.r, self.p = int(n), int(r), int(p)
+
+    @property
+    def prefix(self):
+        return f'{self.algorithm}${self.n}${self.r}${self.p}'
+
+    @classmethod
+    def from_encoded(cls, encoded):
+        return cls(*encoded.split('$')[1:4])
+
+    def encode(self, password, salt):
+        digest = hashlib.scrypt(password.encode(), salt=salt.encode(), n=self.n, r=self.r, p=self.p,
+                                maxmem=256 * self.n * self.r * self.p, dklen=32)
+        return f'{self.prefix}${digest.hex()}'
+
+    @classmethod
+    def calibrate(cls, target, measure):
+        """The smallest n (r=8, p=1) taking at least ``target`` seconds, up to 1 GiB."""
+        n = 2 ** 14
+        while measure(cls(n)) < target and n < 2 ** 20:
+            n *= 2
+        return {"n": n, "r": 8, "p": 1}
+
+
+class Sha256Hasher:
+    """
+    The original single SHA-256 of password and salt, only for verifying
+    hashes stored before the key-derivation hashers.
+    """
+    algorithm = 'sha256'
+    prefix = 'sha256'
+
+    @classmethod
+    def from_encoded(cls, encoded):
+        return cls()
+
+    def encode(self, password, salt):
+        return hashlib.sha256((password + salt).encode()).hexdigest()
+
+
+# Hashers by the name that starts their stored hashes; register another
+# class with the same interface here to make it configurable
+HASHERS = {hasher.algorithm: hasher for hasher in (Pbkdf2Hasher, ScryptHasher, Sha256Hasher)}
+
+
+def identify(encoded):
+    """
+    The hasher that produced a stored hash, with its parameters.
+
+    Raises:
+        ValueError: If the hash names no known hasher
+    """
+    if '$' not in encoded:
+        return Sha256Hasher()
+    algorithm = encoded.split('$', 1)[0]
+    if algorithm not in HASHERS:
+        raise ValueError(f'Unknown password hasher: {algorithm}')
+    return HASHERS[algorithm].from_encoded(encoded)
+
+
+def get_hasher():
+    """The configured hasher (the default PBKDF2 outside an app context)."""
+    if not has_app_context():
+        return Pbkdf2Hasher()
+    config = current_app.config
+    return HASHERS[config['PASSWORD_HASHER']](**config['PASSWORD_HASHER_PARAMS'])
+
+
+def verify(encoded, salt, password):
+    """Whether ``password`` matches a stored hash, compared in constant time."""
+    return hmac.compare_digest(identify(encoded).encode(password, salt), encoded)
+
+
+def needs_rehash(encoded):
+    """Whether a stored hash was made with another hasher or other parameters."""
+    return identify(encoded).prefix != get_hasher().prefix
+
+
+# A hash of a random password per hasher configuration, and its salt
+_dummy_hashes = {}
+_DUMMY_SALT = os.urandom(16).hex()
+
+
+def verify_unknown_user(password):
+    """
+    Verify a password against a hash made with the configured hasher that
+    no password matches.
+
+    Login calls it when the username does not exist, so an unknown user
+    costs as much as a wrong password and response times do not reveal
+    which usernames are registered.
+
+    Returns:
+        bool: Always False
+    """
+    hasher = get_hasher()
+    if hasher.prefix not in _dummy_hashes:
+        _dummy_hashes[hasher.prefix] = hasher.encode(os.urandom(16).hex(), _DUMMY_SALT)
+    verify(_dummy_hashes[hasher.prefix], _DUMMY_SALT, password)
+    return False
+
+
+class HashPoolBusy(Exception):
+    """Raised when the hashing pool's queue is full or a hash waited too long."""
+
+
+class HostSlots:
+    """
+    A limit on hashes computed at once by all processes on the host.
+
+    Each slot is a lock file; a hash runs while holding an exclusive flock
+    on one of them, so the gunicorn workers (which each have a HashPool)
+    together use at most ``count`` cores for hashing.
+
+    Args:
+        directory (str): Where the lock files are kept
+        count (int): Slots, i.e. concurrent hashes per host
+    """
+
+    def __init__(self, directory, count):
+        self.paths = [os.path.join(directory, f'password-hash.{index}.lock') for index in range(count)]
+
+    def run(self, func, deadline):
+        """
+        Run ``func()`` once a slot is free.
+
+        Raises:
+            HashPoolBusy: If no slot was free before ``deadline`` (time.monotonic())
+        """
+        os.makedirs(os.path.dirname(self.paths[0]), exist_ok=True)
+        while True:
+            for path in self.paths:
+                with open(path, 'a') as lock:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        continue
+                    # Closing the file releases the lock
+                    return func()
+            if time.monotonic() >= deadline:
+                raise HashPoolBusy()
+            time.sleep(0.005)
+
+
+class HashPool:
+    """
+    A bounded pool of threads for password hashing.
+
+    At most ``workers`` hashes run at once (hashlib releases the GIL while
+    hashing, so the request threads of other routes keep running), and at
+    most ``queue_size`` more wait; further requests are refused instead of
+    piling up behind a login flood. With ``host_slots`` a hash also waits for
+    one of the host-wide slots shared with the other worker processes.
+
+    Args:
+        workers (int): Hashes computed concurrently
+        queue_size (int): Hashes allowed to wait for a worker
+        timeout (float): Longest a caller waits for its result
+        host_slots (HostSlots): Optional limit across processes
+    """
+
+    def __init__(self, workers, queue_size, timeout, host_slots=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.host_slots = host_slots
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+            self.completed += 1
+        self._slots.release()
+
+    def run(self, func, *args):
+        """
+        Run ``func(*args)`` on the pool and wait for its result.
+
+        Raises:
+            HashPoolBusy: If the queue is full or the result took longer
+                than ``timeout`` (the hash still completes in the background)
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HashPoolBusy()
+        with self._lock:
+            self.pending += 1
+        if self.host_slots is not None:
+            future = self._executor.submit(self.host_slots.run, functools.partial(func, *args),
+                                           time.monotonic() + self.timeout)
+        else:
+            future = self._executor.submit(func, *args)
+        future.add_done_callback(self._done)
+        try:
+            return future.result(self.timeout)
+        except FutureTimeoutError:
+            with self._lock:
+                self.rejected += 1
+            raise HashPoolBusy() from None
+
+    def stats(self):
+        with self._lock:
+            return {"workers": self.workers, "pending": self.pending,
+                    "completed": self.completed, "rejected": self.rejected}
+
+
+def offload(func, *args):
+    """
+    Run a hashing function on the app's HashPool inside the app context.
+
+    Raises:
+        HashPoolBusy: See HashPool.run
+    """
+    app = current_app._get_current_object()
+
+    def call():
+        with app.app_context():
+            return func(*args)
+    return app.extensions['password_hashing'].run(call)
+
+
+def busy_response():
+    """The 503 sent when the hashing pool refuses work."""
+    current_app.logger.warning("\nPassword hashing pool is at capacity.")
+    response = jsonify({"error": "Server is busy, please retry later"})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(current_app.config['PASSWORD_HASH_RETRY_AFTER'])
+    return response
+
+
+def time_hash(hasher, repeat=3):
+    """Best time in seconds of ``repeat`` hashes with a hasher."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        hasher.encode('calibration password', os.urandom(16).hex())
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+@click.command('calibrate-passwords')
+@click.option('--algorithm', type=click.Choice(['pbkdf2_sha256', 'scrypt']), default='pbkdf2_sha256',
+              show_default=True)
+@click.option('--target-ms', default=250.0, show_default=True, help='Time one verification should take.')
+@with_appcontext
+def calibrate_passwords_command(algorithm, target_ms):
+    """Pick hasher parameters for a target verify time on this machine and print the config."""
+    hasher_class = HASHERS[algorithm]
+    params = hasher_class.calibrate(target_ms / 1000, time_hash)
+    measured = time_hash(hasher_class(**params)) * 1000
+    click.echo(f'# {algorithm} {params}: {measured:.0f} ms per hash on this machine')
+    click.echo(f'WEATHER_PASSWORD_HASHER={algorithm}')
+    click.echo(f"WEATHER_PASSWORD_HASHER_PARAMS='{json.dumps(params)}'")
+
+
+def init_app(app):
+    """
+    Configure password hashing.
+
+    Config:
+        PASSWORD_HASHER (str): Hasher for new and upgraded hashes, a key of
+            HASHERS ("pbkdf2_sha256" or "scrypt")
+        PASSWORD_HASHER_PARAMS (dict): Its parameters; see
+            ``flask calibrate-passwords`` (default: the hasher's defaults)
+        PASSWORD_HASH_WORKERS (int): Hashes computed at once per process
+        PASSWORD_HASH_HOST_SLOTS (int): Hashes computed at once by all
+            processes on the host, through lock files in the instance folder
+            (0 = no host-wide limit; also none where fcntl is unavailable)
+        PASSWORD_HASH_QUEUE_SIZE (int): Hashes allowed to wait for a worker
+        PASSWORD_HASH_TIMEOUT (float): Seconds a request waits for its hash
+        PASSWORD_HASH_RETRY_AFTER (int): Retry-After sent when the pool is busy
+
+    Side-effects:
+        - Stores the HashPool in app.extensions['password_hashing']
+        - Registers the calibrate-passwords command
+    """
+    app.config.setdefault('PASSWORD_HASHER', 'pbkdf2_sha256')
+    app.config.setdefault('PASSWORD_HASHER_PARAMS', {})
+    app.config.setdefault('PASSWORD_HASH_WORKERS', max(1, (os.cpu_count() or 2) // 2))
+    app.config.setdefault('PASSWORD_HASH_HOST_SLOTS', max(1, (os.cpu_count() or 2) // 2))
+    app.config.setdefault('PASSWORD_HASH_QUEUE_SIZE', 32)
+    app.config.setdefault('PASSWORD_HASH_TIMEOUT', 5.0)
+    app.config.setdefault('PASSWORD_HASH_RETRY_AFTER', 1)
+    host_slots = None
+    if app.config['PASSWORD_HASH_HOST_SLOTS'] and fcntl:
+        host_slots = HostSlots(app.instance_path, app.config['PASSWORD_HASH_HOST_SLOTS'])
+    app.extensions['password_hashing'] = HashPool(app.config['PASSWORD_HASH_WORKERS'],
+                                                  app.config['PASSWORD_HASH_QUEUE_SIZE'],
+                                                  app.config['PASSWORD_HASH_TIMEOUT'],
+                                                  host_slots)
+    app.cli.add_command(calibrate_passwords_command)
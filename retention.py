@@ -0,0 +1,518 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from database import get_db, get_shard_dbs, shard_index, weather_dbs, WEATHER_TABLES
+import partitions
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+DAY = 86400
+
+_start_lock = threading.Lock()
+
+# Rolls up one batch of raw rows (one location, whole days before a bound).
+# The condition is the most frequent one of the day and the wind direction
+# the circular mean (the direction of the summed unit vectors, so 350 and 10
+# degrees average to 0, not 180). Rows merged into an existing rollup (late
+# data for a compacted day) update it by weighting the averages and the
+# wind directions with the sample counts, and keep the condition of the
+# larger side.
+_ROLLUP_SQL = '''
+    INSERT INTO weather_history_daily
+    (location_id, day, samples, temperature, temperature_min, temperature_max,
+    feels_like, pressure, humidity, wind_speed, wind_speed_max, wind_deg,
+    condition_id)
+    WITH batch AS (
+        SELECT * FROM weather_history
+        WHERE location_id = ? AND timestamp < ?
+    ),
+    modes AS (
+        SELECT timestamp / 86400 * 86400 AS day, condition_id,
+               ROW_NUMBER() OVER (PARTITION BY timestamp / 86400
+                                  ORDER BY COUNT(*) DESC, condition_id) AS rank
+        FROM batch
+        GROUP BY day, condition_id
+    )
+    SELECT b.location_id, m.day, COUNT(*), AVG(b.temperature), MIN(b.temperature),
+           MAX(b.temperature), AVG(b.feels_like), AVG(b.pressure), AVG(b.humidity),
+           AVG(b.wind_speed), MAX(b.wind_speed),
+           CAST(ROUND(degrees(atan2(AVG(sin(radians(b.wind_deg))), AVG(cos(radians(b.wind_deg))))) + 360)
+                AS INTEGER) % 360,
+           m.condition_id
+    FROM batch b
+    JOIN modes m ON m.day = b.timestamp / 86400 * 86400
+    WHERE m.rank = 1
+    GROUP BY m.day
+    ON CONFLICT (location_id, day) DO UPDATE SET
+        temperature = (temperature * samples + excluded.temperature * excluded.samples)
+                      / (samples + excluded.samples),
+        temperature_min = MIN(temperature_min, excluded.temperature_min),
+        temperature_max = MAX(temperature_max, excluded.temperature_max),
+        feels_like = (feels_like * samples + excluded.feels_like * excluded.samples)
+                     / (samples + excluded.samples),
+        pressure = (pressure * samples + excluded.pressure * excluded.samples)
+                   / (samples + excluded.samples),
+        humidity = (humidity * samples + excluded.humidity * excluded.samples)
+                   / (samples + excluded.samples),
+        wind_speed = (wind_speed * samples + excluded.wind_speed * excluded.samples)
+                     / (samples + excluded.samples),
+        wind_speed_max = MAX(wind_speed_max, excluded.wind_speed_max),
+        wind_deg = CASE
+            WHEN wind_deg IS NULL THEN excluded.wind_deg
+            WHEN excluded.wind_deg IS NULL THEN wind_deg
+            ELSE CAST(ROUND(degrees(atan2(
+                sin(radians(wind_deg)) * samples + sin(radians(excluded.wind_deg)) * excluded.samples,
+                cos(radians(wind_deg)) * samples + cos(radians(excluded.wind_deg)) * excluded.samples
+            )) + 360) AS INTEGER) % 360
+        END,
+        condition_id = CASE
+            WHEN condition_id IS NULL OR excluded.samples > samples THEN excluded.condition_id
+            ELSE condition_id
+        END,
+        samples = samples + excluded.samples
+'''
+
+# SQL functions the rollup needs; SQLite only has them when built with
+# SQLITE_ENABLE_MATH_FUNCTIONS, so they are registered from Python otherwise
+_MATH_FUNCTIONS = {'atan2': (2, math.atan2), 'sin': (1, math.sin), 'cos': (1, math.cos),
+                   'radians': (1, math.radians), 'degrees': (1, math.degrees)}
+
+
+def _null_safe(func):
+    return lambda *args: None if None in args else func(*args)
+
+
+def ensure_math_functions(db):
+    """Register the trigonometric SQL functions on a connection whose SQLite lacks them."""
+    try:
+        db.execute('SELECT atan2(0, 1), sin(0), cos(0), radians(0), degrees(0)')
+    except sqlite3.OperationalError:
+        for name, (arity, func) in _MATH_FUNCTIONS.items():
+            db.create_function(name, arity, _null_safe(func), deterministic=True)
+
+
+def day_floor(timestamp):
+    return timestamp // DAY * DAY
+
+
+def reclaim_space(db, pages):
+    """
+    Return up to ``pages`` free pages to the file system.
+
+    Returns:
+        int: Pages released (0 unless the database uses auto_vacuum=INCREMENTAL)
+    """
+    if db.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return 0
+    before = db.execute('PRAGMA freelist_count').fetchone()[0]
+    # Through execute() the pragma stops after one page; executescript runs it to completion
+    db.executescript(f'PRAGMA incremental_vacuum({int(pages)});')
+    return before - db.execute('PRAGMA freelist_count').fetchone()[0]
+
+
+def _delete_in_batches(db, table, id_query, params, batch_size, vacuum_pages, pause, stats):
+    total = 0
+    while True:
+        deleted = db.execute(
+            f'DELETE FROM {table} WHERE id IN ({id_query} LIMIT ?)', (*params, batch_size)
+        ).rowcount
+        db.commit()
+        stats["pages_freed"] += reclaim_space(db, vacuum_pages)
+        total += deleted
+        if deleted < batch_size:
+            return total
+        if pause:
+            time.sleep(pause)
+
+
+def compact_history(db, now=None, raw_days=30, rollup_days=730, current_days=7,
+                    batch_size=5000, vacuum_pages=2000, pause=0.0, archive=None):
+    """
+    Enforce the retention policy.
+
+    1. Raw weather_history rows older than ``raw_days`` are aggregated into
+       weather_history_daily and deleted, one location and at most about
+       ``batch_size`` rows (always whole days) per transaction. With an
+       ``archive`` they are first copied into their monthly partition file,
+       and partitions of months now wholly past the cutoff are sealed.
+    2. Rollups older than ``rollup_days`` are deleted.
+    3. current_weather rows older than ``current_days`` are deleted, except
+       the newest row of each location.
+
+    After every batch the transaction is committed (so writers are blocked
+    for one batch at most) and up to ``vacuum_pages`` free pages are returned
+    to the file system.
+
+    Args:
+        db (sqlite3.Connection): The open database connection
+        now (int): Current timestamp (defaults to time.time())
+        pause (float): Seconds to sleep between batches
+        archive (partitions.HistoryArchive): Where raw rows are kept by month
+            (None deletes them)
+
+    Returns:
+        dict: Rows rolled up and deleted, rollup days written and pages freed,
+        plus rows archived and partitions sealed when archiving
+    """
+    now = int(now or time.time())
+    raw_cutoff = day_floor(now - raw_days * DAY)
+    stats = {"history_rows_rolled_up": 0, "rollup_days_written": 0, "rollups_deleted": 0,
+             "current_rows_deleted": 0, "pages_freed": 0, "raw_cutoff": raw_cutoff}
+    if archive:
+        stats.update(rows_archived=0, rows_not_archived=0)
+    ensure_math_functions(db)
+
+    locations = [row[0] for row in db.execute(
+        'SELECT DISTINCT location_id FROM weather_history WHERE timestamp < ?', (raw_cutoff,)
+    )]
+    for location_id in locations:
+        while True:
+            oldest = db.execute(
+                'SELECT MIN(timestamp) FROM weather_history WHERE location_id = ? AND timestamp < ?',
+                (location_id, raw_cutoff)
+            ).fetchone()[0]
+            if oldest is None:
+                break
+            row = db.execute('''
+                SELECT timestamp FROM weather_history
+                WHERE location_id = ? AND timestamp < ?
+                ORDER BY timestamp LIMIT 1 OFFSET ?
+            ''', (location_id, raw_cutoff, batch_size)).fetchone()
+            bound = raw_cutoff
+            if row is not None:
+                # Stop at a day boundary so a day is never split between batches
+                bound = max(day_floor(row[0]), day_floor(oldest) + DAY)
+            if archive:
+                # Rows of months already sealed (late data) only survive in the rollup
+                archived, skipped = archive.archive_rows(db, location_id, oldest, bound)
+                stats["rows_archived"] += archived
+                stats["rows_not_archived"] += skipped
+            stats["rollup_days_written"] += db.execute(_ROLLUP_SQL, (location_id, bound)).rowcount
+            stats["history_rows_rolled_up"] += db.execute(
+                'DELETE FROM weather_history WHERE location_id = ? AND timestamp < ?',
+                (location_id, bound)
+            ).rowcount
+            db.commit()
+            stats["pages_freed"] += reclaim_space(db, vacuum_pages)
+            if bound == raw_cutoff:
+                break
+            if pause:
+                time.sleep(pause)
+
+    if archive:
+        stats["partitions_sealed"] = archive.seal_before(raw_cutoff)
+
+    rollup_cutoff = day_floor(now - rollup_days * DAY)
+    stats["rollups_deleted"] = _delete_in_batches(
+        db, 'weather_history_daily', 'SELECT id FROM weather_history_daily WHERE day < ?',
+        (rollup_cutoff,), batch_size, vacuum_pages, pause, stats
+    )
+    stats["current_rows_deleted"] = _delete_in_batches(
+        db, 'current_weather', '''
+            SELECT id FROM current_weather c
+            WHERE timestamp < ? AND id != (
+                SELECT id FROM current_weather latest
+                WHERE latest.location_id = c.location_id
+                ORDER BY timestamp DESC LIMIT 1
+            )
+        ''', (now - current_days * DAY,), batch_size, vacuum_pages, pause, stats
+    )
+    return stats
+
+
+def collect_orphans(db, batch_size=5000, vacuum_pages=2000, pause=0.0, scan=False, shards=None,
+                    archive_for=None):
+    """
+    Delete the weather rows of deleted favorite locations.
+
+    Deleting a favorite queues its id in orphaned_locations (a trigger in
+    schema.sql). Each queued location's rows are removed from every weather
+    table in transactions of at most ``batch_size`` rows through the
+    location_id indexes, so writers are never blocked for long, and the
+    location leaves the queue once all its rows are gone.
+
+    Args:
+        db (sqlite3.Connection): The open database connection
+        batch_size (int): Rows per delete transaction
+        vacuum_pages (int): Pages returned to the OS after each batch
+        pause (float): Seconds to sleep between batches
+        scan (bool): First queue orphans the trigger never saw (rows left
+            behind before it existed) by scanning the weather tables
+        shards (list): Connections to the weather shards (see
+            database.get_shard_dbs) when the weather tables are not in ``db``
+        archive_for (callable): Returns the HistoryArchive of a shard index
+            (None when not sharded), whose open monthly partitions lose the
+            location's rows too; sealed months keep them until detached
+
+    Returns:
+        dict: Locations collected, rows deleted per table and in total,
+        archived rows deleted, pages and bytes freed
+    """
+    stats = {"locations": 0, "pages_freed": 0, "archived_rows_deleted": 0}
+    if scan:
+        favorites = {row[0] for row in db.execute('SELECT id FROM favorite_locations')}
+        for weather_db in shards or [db]:
+            for table in WEATHER_TABLES:
+                orphans = [row[:1] for row in weather_db.execute(f'SELECT DISTINCT location_id FROM {table}')
+                           if row[0] not in favorites]
+                db.executemany('''
+                    INSERT OR IGNORE INTO orphaned_locations (location_id, deleted_at)
+                    VALUES (?, CAST(strftime('%s', 'now') AS INTEGER))
+                ''', orphans)
+        db.commit()
+
+    queued = db.execute('SELECT location_id FROM orphaned_locations ORDER BY deleted_at').fetchall()
+    for table in WEATHER_TABLES:
+        stats[table] = 0
+    for (location_id,) in queued:
+        shard = shard_index(location_id, len(shards)) if shards else None
+        weather_db = db if shard is None else shards[shard]
+        archive = archive_for(shard) if archive_for else None
+        if archive:
+            stats["archived_rows_deleted"] += archive.delete_location(location_id)
+        for table in WEATHER_TABLES:
+            stats[table] += _delete_in_batches(
+                weather_db, table, f'SELECT id FROM {table} WHERE location_id = ?', (location_id,),
+                batch_size, vacuum_pages, pause, stats
+            )
+        db.execute('DELETE FROM orphaned_locations WHERE location_id = ?', (location_id,))
+        db.commit()
+        stats["locations"] += 1
+
+    stats["rows_deleted"] = sum(stats[table] for table in WEATHER_TABLES)
+    stats["bytes_freed"] = stats["pages_freed"] * db.execute('PRAGMA page_size').fetchone()[0]
+    return stats
+
+
+def compact_all(settings, archive_for=None):
+    """
+    Run compact_history on every database holding weather tables.
+
+    Args:
+        settings (dict): compact_history keyword arguments
+        archive_for (callable): Returns the HistoryArchive of a shard index
+            (None when not sharded), or None to delete instead of archiving
+
+    Returns:
+        dict: The stats of every run added up (months sealed in any shard)
+    """
+    total = {}
+    shards = get_shard_dbs()
+    for index, weather_db in enumerate(shards or [get_db()]):
+        shard = index if shards else None
+        stats = compact_history(weather_db, archive=archive_for(shard) if archive_for else None, **settings)
+        for key, value in stats.items():
+            if key == 'partitions_sealed':
+                value = sorted(set(total.get(key, [])) | set(value))
+            elif key != 'raw_cutoff' and key in total:
+                value += total[key]
+            total[key] = value
+    return total
+
+
+def history_range(db, location_id, start, end, limit, archive=None):
+    """
+    Query history between two timestamps, using rollups where raw rows are gone.
+
+    Raw rows come from weather_history and, with an ``archive``, from the
+    monthly partitions overlapping the range (see partitions.HistoryArchive),
+    decoding the compressed blocks of sealed months.
+    Days before the oldest of those raw rows come from weather_history_daily,
+    so callers don't need to know how far compaction has progressed.
+
+    Args:
+        db (sqlite3.Connection): The open database connection
+        location_id (int): The location
+        start (int): First timestamp included
+        end (int): First timestamp excluded
+        limit (int): Maximum number of rows
+        archive (partitions.HistoryArchive): Partitions to read, if any
+
+    Returns:
+        sqlite3.Cursor: Rows with the weather_history columns plus
+        ``resolution`` ("hourly" or "daily"), ``samples``, ``temperature_min``
+        and ``temperature_max``, newest first
+    """
+    schemas = ['main']
+    oldest = []
+    if archive:
+        schemas += [name for name, _ in archive.attach_for_range(db, start, end)]
+        # Sealed months are compressed blocks; the overlapping ones are decoded into a temp table
+        oldest.append(partitions.load_blocks(db, schemas[1:], location_id, start, end))
+    oldest += [db.execute(
+        f'SELECT MIN(timestamp) FROM {schema}.weather_history WHERE location_id = ?', (location_id,)
+    ).fetchone()[0] for schema in schemas]
+    oldest_raw = min((timestamp for timestamp in oldest if timestamp is not None), default=None)
+    rollup_end = min(end, day_floor(oldest_raw)) if oldest_raw is not None else end
+    sources = [f'{schema}.weather_history' for schema in schemas] + (['temp.cold_history'] if archive else [])
+    raw = ' UNION ALL '.join(f'''
+            SELECT w.id, w.location_id, w.timestamp, w.temperature, w.feels_like, w.pressure,
+                   w.humidity, w.wind_speed, w.wind_deg, c.description, c.icon,
+                   'hourly' AS resolution, 1 AS samples,
+                   w.temperature AS temperature_min, w.temperature AS temperature_max
+            FROM {source} w
+            LEFT JOIN main.weather_conditions c ON c.id = w.condition_id
+            WHERE w.location_id = ? AND w.timestamp >= ? AND w.timestamp < ?
+    ''' for source in sources)
+    return db.execute(f'''
+        SELECT * FROM (
+            {raw}
+            UNION ALL
+            SELECT d.id, d.location_id, d.day, d.temperature, d.feels_like, d.pressure,
+                   d.humidity, d.wind_speed, d.wind_deg, c.description, c.icon,
+                   'daily', d.samples, d.temperature_min, d.temperature_max
+            FROM weather_history_daily d
+            LEFT JOIN weather_conditions c ON c.id = d.condition_id
+            WHERE d.location_id = ? AND d.day >= ? AND d.day < ?
+        )
+        ORDER BY timestamp DESC
+        LIMIT ?
+    ''', (*(location_id, start, end) * len(sources), location_id, start, rollup_end, limit))
+
+
+def _retention_settings(app):
+    config = app.config
+    return dict(
+        raw_days=config['RETENTION_RAW_DAYS'],
+        rollup_days=config['RETENTION_ROLLUP_DAYS'],
+        current_days=config['RETENTION_CURRENT_DAYS'],
+        batch_size=config['RETENTION_BATCH_SIZE'],
+        vacuum_pages=config['RETENTION_VACUUM_PAGES'],
+        pause=config['RETENTION_BATCH_PAUSE'],
+    )
+
+
+def _archive_for(app):
+    return lambda shard: partitions.get_archive(app, shard)
+
+
+def init_app(app):
+    """
+    Configure retention and optionally run it in the background.
+
+    Config:
+        RETENTION_RAW_DAYS (int): Days of raw hourly history kept
+        RETENTION_ROLLUP_DAYS (int): Days of daily rollups kept
+        RETENTION_CURRENT_DAYS (int): Days of current_weather rows kept
+            (the newest row per location is always kept)
+        RETENTION_BATCH_SIZE (int): Rows per delete transaction
+        RETENTION_VACUUM_PAGES (int): Pages returned to the OS per batch
+        RETENTION_BATCH_PAUSE (float): Seconds to sleep between batches
+        RETENTION_INTERVAL (float): Seconds between background runs of the
+            compaction and the orphan GC (0 = only via ``flask compact-history``
+            and ``flask gc-weather``)
+
+    Side-effects:
+        - Registers the compact-history and gc-weather commands
+        - With RETENTION_INTERVAL set, registers a before_request hook that
+          starts the background thread (see start_background) in the process
+          serving requests, never in the one that only imported the app
+    """
+    app.config.setdefault('RETENTION_RAW_DAYS', 30)
+    app.config.setdefault('RETENTION_ROLLUP_DAYS', 730)
+    app.config.setdefault('RETENTION_CURRENT_DAYS', 7)
+    app.config.setdefault('RETENTION_BATCH_SIZE', 5000)
+    app.config.setdefault('RETENTION_VACUUM_PAGES', 2000)
+    app.config.setdefault('RETENTION_BATCH_PAUSE', 0.0)
+    app.config.setdefault('RETENTION_INTERVAL', 0)
+    app.cli.add_command(compact_history_command)
+    app.cli.add_command(gc_weather_command)
+    if app.config['RETENTION_INTERVAL']:
+        app.before_request(lambda: start_background(app))
+
+
+def start_background(app):
+    """
+    Start the retention thread of this process, once.
+
+    Called from gunicorn's post_fork hook (see serve.py) and, for other
+    servers, on the first request. A thread started at import would run in
+    the gunicorn master under --preload (and be lost by the forked workers);
+    a lock file in the instance folder makes only one process per host run
+    the compaction, the others' threads just find it held.
+    """
+    if not app.config['RETENTION_INTERVAL'] or app.extensions.get('retention_pid') == os.getpid():
+        return
+    with _start_lock:
+        if app.extensions.get('retention_pid') == os.getpid():
+            return
+        app.extensions['retention_pid'] = os.getpid()
+        threading.Thread(target=_run_periodically, args=(app,), daemon=True).start()
+
+
+def _run_periodically(app):
+    os.makedirs(app.instance_path, exist_ok=True)
+    lock_path = os.path.join(app.instance_path, 'retention.lock')
+    while True:
+        time.sleep(app.config['RETENTION_INTERVAL'])
+        with open(lock_path, 'w') as lock:
+            if fcntl:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+            try:
+                settings = _retention_settings(app)
+                with app.app_context():
+                    stats = compact_all(settings, _archive_for(app))
+                    collected = collect_orphans(get_db(), settings['batch_size'], settings['vacuum_pages'],
+                                                settings['pause'], shards=get_shard_dbs(),
+                                                archive_for=_archive_for(app))
+                app.logger.info("\nRetention run finished: %s; orphan GC: %s", stats, collected)
+            except Exception:
+                app.logger.exception("\nRetention run failed.")
+
+
+@click.command('compact-history')
+@click.option('--raw-days', type=int, help='Override RETENTION_RAW_DAYS.')
+@click.option('--rollup-days', type=int, help='Override RETENTION_ROLLUP_DAYS.')
+@click.option('--enable-incremental-vacuum', is_flag=True,
+              help='Switch an existing database to auto_vacuum=INCREMENTAL (runs a full VACUUM once).')
+@with_appcontext
+def compact_history_command(raw_days, rollup_days, enable_incremental_vacuum):
+    """Roll up old history into daily aggregates and delete expired rows."""
+    databases = weather_dbs()
+    for db in databases:
+        if enable_incremental_vacuum and db.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            click.echo('Switching to incremental auto-vacuum (full VACUUM)...')
+            db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            db.execute('VACUUM')
+    settings = _retention_settings(current_app)
+    if raw_days is not None:
+        settings['raw_days'] = raw_days
+    if rollup_days is not None:
+        settings['rollup_days'] = rollup_days
+    stats = compact_all(settings, _archive_for(current_app))
+    click.echo(f"Rolled up {stats['history_rows_rolled_up']} history rows into "
+               f"{stats['rollup_days_written']} daily rows, deleted {stats['rollups_deleted']} rollups "
+               f"and {stats['current_rows_deleted']} current weather rows, freed {stats['pages_freed']} pages.")
+    if 'rows_archived' in stats:
+        click.echo(f"Archived {stats['rows_archived']} history rows ({stats['rows_not_archived']} late rows of "
+                   f"sealed months kept only as rollups); sealed: {', '.join(stats['partitions_sealed']) or 'none'}.")
+    if any(db.execute('PRAGMA auto_vacuum').fetchone()[0] != 2 for db in databases):
+        click.echo('Note: the database does not use incremental auto-vacuum, so freed pages are only '
+                   'reused, not returned; run once with --enable-incremental-vacuum.')
+
+
+@click.command('gc-weather')
+@click.option('--scan', is_flag=True,
+              help='Also find orphaned rows left behind before deletions were tracked (full index scan).')
+@with_appcontext
+def gc_weather_command(scan):
+    """Delete weather rows of deleted favorite locations in small batches."""
+    settings = _retention_settings(current_app)
+    stats = collect_orphans(get_db(), settings['batch_size'], settings['vacuum_pages'],
+                            settings['pause'], scan=scan, shards=get_shard_dbs(),
+                            archive_for=_archive_for(current_app))
+    click.echo(f"Collected {stats['locations']} deleted locations: "
+               + ', '.join(f"{stats[table]} {table}" for table in WEATHER_TABLES)
+               + f" rows ({stats['rows_deleted']} total), {stats['archived_rows_deleted']} archived rows, "
+               f"freed {stats['pages_freed']} pages ({stats['bytes_freed'] / 1024:.0f} KiB).")
@@ -0,0 +1,174 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from database import get_db, init_db
+from seed import seed_database, seed_user_name, shard_seeded, SEED_PASSWORD
+
+
+def frame_label(frame):
+    code = frame.f_code
+    name = getattr(code, 'co_qualname', code.co_name)
+    return f"{os.path.basename(code.co_filename)}:{name}"
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread at a fixed interval.
+
+    A background thread reads ``sys._current_frames()`` for the target thread
+    and counts each stack. The interpreter's switch interval is lowered to the
+    sampling interval while running, otherwise the sampler would only get the
+    GIL every 5 ms.
+
+    Args:
+        interval (float): Seconds between samples
+        thread_id (int): Thread to sample (defaults to the calling thread)
+        root (code): Stacks are cut above the first frame running this code
+            object, dropping the frames common to every sample
+
+    Results:
+        stacks (Counter): "outer;...;inner" collapsed stacks -> sample count
+    """
+
+    def __init__(self, interval=0.001, thread_id=None, root=None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.root = root
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._switch_interval = None
+
+    def _run(self):
+        own_frames = sys._current_frames
+        while not self._stop.wait(self.interval):
+            frame = own_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(frame_label(frame))
+                if frame.f_code is self.root:
+                    break
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(labels))] += 1
+            self.samples += 1
+
+    def start(self):
+        self._switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(self._switch_interval, self.interval))
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        sys.setswitchinterval(self._switch_interval)
+
+    def collapsed(self):
+        """Return the samples in the folded format read by flamegraph.pl and speedscope."""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top_functions(self, limit=20):
+        """
+        Summarize samples per function.
+
+        Returns:
+            list: (function, self samples, total samples) sorted by total samples;
+            "total" counts each sample once even for recursive functions
+        """
+        self_counts = Counter()
+        total_counts = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            self_counts[frames[-1]] += count
+            for label in set(frames):
+                total_counts[label] += count
+        return [(label, self_counts[label], total)
+                for label, total in total_counts.most_common(limit)]
+
+
+@click.command('profile-route')
+@click.argument('path')
+@click.option('--method', default='GET', show_default=True)
+@click.option('--body', default=None, help='JSON request body for POST requests.')
+@click.option('-n', '--requests', 'count', default=500, show_default=True, help='Requests to profile.')
+@click.option('--warmup', default=20, show_default=True, help='Unprofiled requests sent first.')
+@click.option('--interval', default=0.001, show_default=True, help='Sampling interval in seconds.')
+@click.option('--output', default='profile.folded', show_default=True,
+              help='Collapsed-stack output for flamegraph.pl / speedscope.')
+@click.option('--top', default=25, show_default=True, help='Rows in the top-functions table.')
+@click.option('--users', default=50, show_default=True, help='Seeded users.')
+@click.option('--favorites-per-user', default=3, show_default=True)
+@click.option('--history-hours', default=24 * 30, show_default=True)
+@click.option('--seed', default=42, show_default=True, help='Seed for the synthetic data.')
+@with_appcontext
+def profile_route_command(path, method, body, count, warmup, interval, output, top,
+                          users, favorites_per_user, history_hours, seed):
+    """
+    Profile PATH (e.g. /weather/history/1) through the test client.
+
+    Requests run against a temporary database seeded by seed.seed_database
+    with the given --seed, logged in as user0 (who owns favorites 1..N), so
+    runs before and after a change see identical data.
+    """
+    app = current_app._get_current_object()
+    workdir = tempfile.mkdtemp(prefix='weather-profile-')
+    db_path = os.path.join(workdir, 'weather.db')
+    had_database = 'DATABASE' in app.config
+    original_database = app.config.get('DATABASE')
+    app.config['DATABASE'] = db_path
+    try:
+        with app.app_context():
+            init_db()
+            summary = seed_database(get_db(), users, favorites_per_user, history_hours,
+                                    seed=seed, now=1700000000)
+            shard_seeded()
+        click.echo(f"Seeded {summary['locations']} locations and {summary['history_rows']} history rows.")
+
+        client = app.test_client()
+        client.post('/login', json={'username': seed_user_name(0), 'password': SEED_PASSWORD})
+        payload = json.loads(body) if body else None
+
+        def send():
+            return client.open(path, method=method, json=payload)
+
+        status = send().status_code
+        for _ in range(warmup):
+            send()
+
+        profiler = SamplingProfiler(interval, root=send.__code__)
+        start = time.perf_counter()
+        profiler.start()
+        try:
+            for _ in range(count):
+                send()
+        finally:
+            profiler.stop()
+        elapsed = time.perf_counter() - start
+    finally:
+        if had_database:
+            app.config['DATABASE'] = original_database
+        else:
+            app.config.pop('DATABASE')
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(output, 'w') as f:
+        f.write(profiler.collapsed())
+
+    click.echo(f"\n{method} {path} -> {status}: {count} requests in {elapsed:.2f}s "
+               f"({elapsed / count * 1000:.3f} ms/request), {profiler.samples} samples")
+    click.echo(f"Collapsed stacks written to {output}\n")
+    click.echo(f"{'self %':>7} {'total %':>8}  function")
+    samples = profiler.samples or 1
+    for label, self_samples, total_samples in profiler.top_functions(top):
+        click.echo(f"{self_samples / samples * 100:>7.1f} {total_samples / samples * 100:>8.1f}  {label}")
@@ -6,6 +6,8 @@ from requests.sessions import Session
 from getpass import getpass
 from dotenv import load_dotenv
 import os
+from functools import wraps
+from tracing import Tracer
 
 BASE_URL = "http://127.0.0.1:5000"
 session = Session()
@@ -14,6 +16,78 @@ session = Session()
 load_dotenv()
 
 API_KEY = os.getenv("OPENWEATHER_API_KEY")
+# Point at a local stand-in (see owm_stub.py) to run without network access
+OPENWEATHER_BASE_URL = os.getenv("OPENWEATHER_BASE_URL", "https://api.openweathermap.org").rstrip("/")
+
+# Set API_TOKEN (see `flask create-token` or POST /tokens) to authenticate
+# with a long-lived token instead of logging in
+API_TOKEN = os.getenv("API_TOKEN")
+if API_TOKEN:
+    session.headers["Authorization"] = f"Bearer {API_TOKEN}"
+
+# Set TRACE_FILE (and WEATHER_TRACE_FILE for the app) to record each interaction
+# as a Chrome trace; see tracing.py
+tracer = Tracer(os.getenv("TRACE_FILE"), "run.py")
+if tracer.enabled:
+    session.hooks["response"].append(tracer.response_hook)
+
+def traced(name):
+    """Run each call of the decorated function as a new trace sent to the app in X-Trace-Id."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with tracer.trace(name, session.headers):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Last successful response per URL, keyed by URL and stored with its ETag
+_response_cache = {}
+
+def cached_get(url):
+    """
+    GET a URL from the app, revalidating any copy we already have.
+
+    If a previous 200 response for the URL carried an ETag, it is sent back as
+    If-None-Match; on 304 Not Modified the stored response is returned instead,
+    so callers always see a 200 response with a usable body.
+    """
+    cached = _response_cache.get(url)
+    if cached:
+        response = session.get(url, headers={"If-None-Match": cached[0]})
+        if response.status_code == 304:
+            return cached[1]
+    else:
+        response = session.get(url)
+
+    etag = response.headers.get("ETag") if response.status_code == 200 else None
+    if isinstance(etag, str):
+        _response_cache[url] = (etag, response)
+    else:
+        _response_cache.pop(url, None)
+    return response
+
+def rows_from_columnar(payload):
+    """
+    Convert a ``format=columnar`` response back into a list of row dicts.
+
+    Payloads that are not columnar (e.g. error messages) are returned unchanged.
+    """
+    if not isinstance(payload, dict) or payload.get("format") != "columnar":
+        return payload
+    fields = payload["fields"]
+    return [dict(zip(fields, values)) for values in zip(*payload["columns"])]
+
+def get_favorite_location(location_id):
+    """
+    GET just the coordinates of one favorite location from the app.
+
+    Asks for the one-row page of favorites after ``location_id - 1``, so the
+    response holds that location (if it is the user's) instead of the whole list.
+    """
+    return cached_get(f"{BASE_URL}/favorites?after={location_id - 1}&limit=1&fields=id,latitude,longitude")
 
 def get_weather_api_data(location_id):
     """
@@ -21,7 +95,7 @@ def get_weather_api_data(location_id):
     """
     try:
         # Get the location coordinates
-        response = session.get(f"{BASE_URL}/favorites")
+        response = get_favorite_location(location_id)
         if response.status_code == 200:
             favorites = response.json()
             location = next((loc for loc in favorites if loc["id"] == location_id), None)
@@ -33,7 +107,7 @@ def get_weather_api_data(location_id):
             return None
         
         # Calling OpenWeatherMap API 3.0
-        url = "https://api.openweathermap.org/data/3.0/onecall"
+        url = f"{OPENWEATHER_BASE_URL}/data/3.0/onecall"
         params = {
             "lat": location["latitude"],
             "lon": location["longitude"],
@@ -42,7 +116,8 @@ def get_weather_api_data(location_id):
             "units": "metric"
         }
         
-        response = requests.get(url, params=params)
+        with tracer.span(f"GET {url}", "upstream"):
+            response = requests.get(url, params=params)
         if response.status_code == 200:
             data = response.json()
             current_time = int(time.time())
@@ -76,7 +151,7 @@ def get_forecast_api_data(location_id):
     Fetch weather forecast data from OpenWeatherMap.
     """
     try:
-        response = session.get(f"{BASE_URL}/favorites")
+        response = get_favorite_location(location_id)
         if response.status_code == 200:
             favorites = response.json()
             location = next((loc for loc in favorites if loc["id"] == location_id), None)
@@ -87,7 +162,7 @@ def get_forecast_api_data(location_id):
             print(f"\nFailed to fetch favorites: {response.status_code}")
             return None
 
-        url = "https://api.openweathermap.org/data/3.0/onecall"
+        url = f"{OPENWEATHER_BASE_URL}/data/3.0/onecall"
         params = {
             "lat": location["latitude"],
             "lon": location["longitude"],
@@ -96,7 +171,8 @@ def get_forecast_api_data(location_id):
             "units": "metric"
         }
 
-        response = requests.get(url, params=params)
+        with tracer.span(f"GET {url}", "upstream"):
+            response = requests.get(url, params=params)
         if response.status_code == 200:
             data = response.json()
             return {
@@ -116,7 +192,7 @@ def get_history_api_data(location_id):
     Fetch historical weather data from OpenWeatherMap.
     """
     try:
-        response = session.get(f"{BASE_URL}/favorites")
+        response = get_favorite_location(location_id)
         if response.status_code == 200:
             favorites = response.json()
             location = next((loc for loc in favorites if loc["id"] == location_id), None)
@@ -127,7 +203,7 @@ def get_history_api_data(location_id):
             print(f"\nFailed to fetch favorites: {response.status_code}")
             return None
 
-        url = "https://api.openweathermap.org/data/3.0/onecall/timemachine"
+        url = f"{OPENWEATHER_BASE_URL}/data/3.0/onecall/timemachine"
         params = {
             "lat": location["latitude"],
             "lon": location["longitude"],
@@ -136,7 +212,8 @@ def get_history_api_data(location_id):
             "units": "metric"
         }
 
-        response = requests.get(url, params=params)
+        with tracer.span(f"GET {url}", "upstream"):
+            response = requests.get(url, params=params)
         if response.status_code == 200:
             data = response.json()
             if 'data' in data:
@@ -154,18 +231,21 @@ def get_history_api_data(location_id):
         print(f"\nError getting history: {str(e)}")
         return None
 
+@traced("register")
 def register_user(username, password):
     response = session.post(f"{BASE_URL}/register", 
         json={"username": username, "password": password})
     return response.status_code == 200
 
+@traced("login")
 def login_user(username, password):
     response = session.post(f"{BASE_URL}/login", 
         json={"username": username, "password": password})
     return response.status_code == 200
 
+@traced("list favorites")
 def get_favorites():
-    response = session.get(f"{BASE_URL}/favorites")
+    response = cached_get(f"{BASE_URL}/favorites")
     if response.status_code == 200:
         try:
             locations = response.json()
@@ -189,6 +269,7 @@ def get_favorites():
         return False
     return False
 
+@traced("add favorite")
 def add_favorite(location_name, latitude, longitude):
     try:
         lat = float(latitude)
@@ -211,6 +292,7 @@ def add_favorite(location_name, latitude, longitude):
         print(f"\nError adding favorite: {str(e)}")
         return False
 
+@traced("remove favorite")
 def remove_favorite(location_id):
     try:
         response = session.delete(f"{BASE_URL}/favorites/{location_id}")
@@ -221,22 +303,36 @@ def remove_favorite(location_id):
     except:
         return False
 
+def print_current_weather(weather):
+    print("\nCurrent Weather:")
+    print(f"Temperature: {weather['temperature']}°C")
+    print(f"Feels Like: {weather['feels_like']}°C")
+    print(f"Description: {weather['description']}")
+    print(f"Humidity: {weather['humidity']}%")
+    print(f"Wind Speed: {weather['wind_speed']} m/s")
+    if weather.get('source_location_id') is not None:
+        print(f"Observed {weather['source_distance_km']} km away, at location {weather['source_location_id']}")
+    elif weather.get('reused'):
+        print("Observed at a nearby location")
+
+@traced("current weather")
 def get_current_weather(location_id):
     try:
         location_id = int(location_id)
         
-        response = session.get(f"{BASE_URL}/weather/current/{location_id}")
+        response = cached_get(f"{BASE_URL}/weather/current/{location_id}")
         if response.status_code == 200:
             weather = response.json()
             if 'error' not in weather:
-                print("\nCurrent Weather:")
-                print(f"Temperature: {weather['temperature']}°C")
-                print(f"Feels Like: {weather['feels_like']}°C")
-                print(f"Description: {weather['description']}")
-                print(f"Humidity: {weather['humidity']}%")
-                print(f"Wind Speed: {weather['wind_speed']} m/s")
+                print_current_weather(weather)
                 return True
             else:
+                # A fresh observation of a location close by is stored by the
+                # app itself, saving the upstream call
+                reuse_response = session.post(f"{BASE_URL}/weather/current/{location_id}/reuse")
+                if reuse_response.status_code == 200:
+                    print_current_weather(reuse_response.json())
+                    return True
                 # Get fresh weather data from API
                 weather_data = get_weather_api_data(location_id)
                 if weather_data:
@@ -247,15 +343,9 @@ def get_current_weather(location_id):
                     )
                     if store_response.status_code == 200:
                         # Re-fetch the stored weather data
-                        fetch_response = session.get(f"{BASE_URL}/weather/current/{location_id}")
+                        fetch_response = cached_get(f"{BASE_URL}/weather/current/{location_id}")
                         if fetch_response.status_code == 200:
-                            stored_weather = fetch_response.json()
-                            print("\nCurrent Weather:")
-                            print(f"Temperature: {stored_weather['temperature']}°C")
-                            print(f"Feels Like: {stored_weather['feels_like']}°C")
-                            print(f"Description: {stored_weather['description']}")
-                            print(f"Humidity: {stored_weather['humidity']}%")
-                            print(f"Wind Speed: {stored_weather['wind_speed']} m/s")
+                            print_current_weather(fetch_response.json())
                             return True
                         else:
                             print(f"\nFailed to fetch stored weather data: {fetch_response.status_code}")
@@ -267,13 +357,14 @@ def get_current_weather(location_id):
         print(f"\nError getting weather: {str(e)}")
         return False
 
+@traced("weather forecast")
 def get_weather_forecast(location_id):
     try:
         location_id = int(location_id)
         
-        response = session.get(f"{BASE_URL}/weather/forecast/{location_id}")
+        response = cached_get(f"{BASE_URL}/weather/forecast/{location_id}?format=columnar")
         if response.status_code == 200:
-            forecasts = response.json()
+            forecasts = rows_from_columnar(response.json())
             if forecasts and not isinstance(forecasts, dict):
                 print("\nWeather Forecast:")
                 for forecast in forecasts:
@@ -291,9 +382,9 @@ def get_weather_forecast(location_id):
                                           json=forecast_data)
                     if store_response.status_code == 200:
                         # Re-fetch the stored forecast data
-                        fetch_response = session.get(f"{BASE_URL}/weather/forecast/{location_id}")
+                        fetch_response = cached_get(f"{BASE_URL}/weather/forecast/{location_id}?format=columnar")
                         if fetch_response.status_code == 200:
-                            stored_forecasts = fetch_response.json()
+                            stored_forecasts = rows_from_columnar(fetch_response.json())
                             print("\nWeather Forecast:")
                             for forecast in stored_forecasts:
                                 print(f"\nDate: {time.strftime('%Y-%m-%d', time.localtime(forecast['forecast_timestamp']))}")
@@ -311,13 +402,14 @@ def get_weather_forecast(location_id):
         print(f"\nError getting forecast: {str(e)}")
         return False
 
+@traced("weather history")
 def get_weather_history(location_id):
     try:
         location_id = int(location_id)
         
-        response = session.get(f"{BASE_URL}/weather/history/{location_id}")
+        response = cached_get(f"{BASE_URL}/weather/history/{location_id}?format=columnar")
         if response.status_code == 200:
-            history = response.json()
+            history = rows_from_columnar(response.json())
             if history and not isinstance(history, dict):
                 print("\nWeather History (Last 24 Hours):")
                 for record in history:
@@ -335,9 +427,9 @@ def get_weather_history(location_id):
                                           json=history_data)
                     if store_response.status_code == 200:
                         # Re-fetch the stored history data
-                        fetch_response = session.get(f"{BASE_URL}/weather/history/{location_id}")
+                        fetch_response = cached_get(f"{BASE_URL}/weather/history/{location_id}?format=columnar")
                         if fetch_response.status_code == 200:
-                            stored_history = fetch_response.json()
+                            stored_history = rows_from_columnar(fetch_response.json())
                             print("\nWeather History (Last 24 Hours):")
                             for record in stored_history:
                                 print(f"\nTime: {time.strftime('%Y-%m-%d %H:%M', time.localtime(record['timestamp']))}")
@@ -360,9 +452,12 @@ def main():
     password = ""
     
     print("\nWelcome to your Weather-Location Manager.\n")
-    print("Would you like to Login or Create an Account?\n")
+    if API_TOKEN:
+        print("Using the API token from API_TOKEN. What would you like to do?\n")
+    else:
+        print("Would you like to Login or Create an Account?\n")
     
-    while True:
+    while not API_TOKEN:
         print("Menu:")
         print(" 1. Login")
         print(" 2. Create Account")
@@ -1,3 +1,7 @@
+-- Lets retention (flask compact-history) return freed pages to the OS; only
+-- takes effect when the database is created
+PRAGMA auto_vacuum = INCREMENTAL;
+
 CREATE TABLE IF NOT EXISTS users (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     username TEXT UNIQUE NOT NULL,
@@ -5,6 +9,20 @@ CREATE TABLE IF NOT EXISTS users (
     salt TEXT NOT NULL
 );
 
+-- Long-lived API tokens for programmatic clients (tokens.py); only a
+-- SHA-256 of each token is stored
+CREATE TABLE IF NOT EXISTS api_tokens (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    token_hash TEXT UNIQUE NOT NULL,
+    created_at INTEGER NOT NULL,
+    expires_at INTEGER,
+    revoked_at INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS idx_api_tokens_user_id ON api_tokens (user_id);
+
 CREATE TABLE IF NOT EXISTS favorite_locations (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id INTEGER NOT NULL,
@@ -13,6 +31,19 @@ CREATE TABLE IF NOT EXISTS favorite_locations (
     longitude REAL NOT NULL
 );
 
+-- Distinct (description, icon) pairs; observation rows store the id
+CREATE TABLE IF NOT EXISTS weather_conditions (
+    id INTEGER PRIMARY KEY,
+    description TEXT,
+    icon TEXT,
+    UNIQUE (description, icon)
+);
+
+-- UNIQUE treats NULLs as distinct, so pairs with a missing value are kept
+-- unique by comparing them as '' (see conditions.merge_duplicate_conditions)
+CREATE UNIQUE INDEX IF NOT EXISTS idx_weather_conditions_pair
+    ON weather_conditions (IFNULL(description, ''), IFNULL(icon, ''));
+
 CREATE TABLE IF NOT EXISTS current_weather (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     location_id INTEGER NOT NULL,
@@ -23,9 +54,13 @@ CREATE TABLE IF NOT EXISTS current_weather (
     humidity INTEGER,
     wind_speed REAL,
     wind_deg INTEGER,
-    description TEXT,
-    icon TEXT,
-    FOREIGN KEY (location_id) REFERENCES favorite_locations (id)
+    condition_id INTEGER,
+    -- Provenance of an observation reused from a nearby location (see
+    -- geo.fresh_nearby_observation); NULL when fetched for this location
+    source_location_id INTEGER,
+    source_distance_km REAL,
+    FOREIGN KEY (location_id) REFERENCES favorite_locations (id),
+    FOREIGN KEY (condition_id) REFERENCES weather_conditions (id)
 );
 
 CREATE TABLE IF NOT EXISTS weather_forecast (
@@ -39,9 +74,9 @@ CREATE TABLE IF NOT EXISTS weather_forecast (
     humidity INTEGER,
     wind_speed REAL,
     wind_deg INTEGER,
-    description TEXT,
-    icon TEXT,
-    FOREIGN KEY (location_id) REFERENCES favorite_locations (id)
+    condition_id INTEGER,
+    FOREIGN KEY (location_id) REFERENCES favorite_locations (id),
+    FOREIGN KEY (condition_id) REFERENCES weather_conditions (id)
 );
 
 CREATE TABLE IF NOT EXISTS weather_history (
@@ -54,7 +89,115 @@ CREATE TABLE IF NOT EXISTS weather_history (
     humidity INTEGER,
     wind_speed REAL,
     wind_deg INTEGER,
-    description TEXT,
-    icon TEXT,
-    FOREIGN KEY (location_id) REFERENCES favorite_locations (id)
-); 
\ No newline at end of file
+    condition_id INTEGER,
+    FOREIGN KEY (location_id) REFERENCES favorite_locations (id),
+    FOREIGN KEY (condition_id) REFERENCES weather_conditions (id)
+); 
+
+-- Daily aggregates of weather_history rows older than the raw retention window
+CREATE TABLE IF NOT EXISTS weather_history_daily (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    location_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    samples INTEGER NOT NULL,
+    temperature REAL,
+    temperature_min REAL,
+    temperature_max REAL,
+    feels_like REAL,
+    pressure REAL,
+    humidity REAL,
+    wind_speed REAL,
+    wind_speed_max REAL,
+    wind_deg INTEGER,
+    condition_id INTEGER,
+    UNIQUE (location_id, day),
+    FOREIGN KEY (location_id) REFERENCES favorite_locations (id),
+    FOREIGN KEY (condition_id) REFERENCES weather_conditions (id)
+);
+
+-- Deleted favorites whose weather rows are still to be removed by the
+-- batched garbage collector (flask gc-weather), so deleting a favorite never
+-- holds the write lock for the length of its whole history
+CREATE TABLE IF NOT EXISTS orphaned_locations (
+    location_id INTEGER PRIMARY KEY,
+    deleted_at INTEGER NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS favorite_locations_orphan_weather
+AFTER DELETE ON favorite_locations
+BEGIN
+    INSERT OR IGNORE INTO orphaned_locations (location_id, deleted_at)
+    VALUES (old.id, CAST(strftime('%s', 'now') AS INTEGER));
+END;
+
+-- Change feed events (change_feed.py), appended by whichever process stored
+-- the weather and read by every process serving streams; AUTOINCREMENT keeps
+-- ids increasing after old events are trimmed, so they order the feed globally
+CREATE TABLE IF NOT EXISTS weather_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    location_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+
+-- Favorite locations as points (min = max) in an R*Tree, so nearby searches
+-- (geo.py) read a bounding box instead of scanning favorite_locations; the
+-- triggers keep it in sync with every insert, move and delete
+CREATE VIRTUAL TABLE IF NOT EXISTS favorite_locations_rtree
+    USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+
+CREATE TRIGGER IF NOT EXISTS favorite_locations_rtree_insert
+AFTER INSERT ON favorite_locations
+BEGIN
+    INSERT INTO favorite_locations_rtree
+    VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude);
+END;
+
+CREATE TRIGGER IF NOT EXISTS favorite_locations_rtree_update
+AFTER UPDATE OF latitude, longitude ON favorite_locations
+BEGIN
+    UPDATE favorite_locations_rtree
+    SET min_lat = new.latitude, max_lat = new.latitude, min_lon = new.longitude, max_lon = new.longitude
+    WHERE id = new.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS favorite_locations_rtree_delete
+AFTER DELETE ON favorite_locations
+BEGIN
+    DELETE FROM favorite_locations_rtree WHERE id = old.id;
+END;
+
+-- Indexes locations stored before the R*Tree existed (a no-op afterwards)
+INSERT INTO favorite_locations_rtree
+SELECT id, latitude, latitude, longitude, longitude FROM favorite_locations
+WHERE id NOT IN (SELECT id FROM favorite_locations_rtree);
+
+CREATE INDEX IF NOT EXISTS idx_favorite_locations_user
+    ON favorite_locations (user_id);
+
+CREATE INDEX IF NOT EXISTS idx_current_weather_location_time
+    ON current_weather (location_id, timestamp);
+
+CREATE INDEX IF NOT EXISTS idx_weather_forecast_location_time
+    ON weather_forecast (location_id, timestamp, forecast_timestamp);
+
+CREATE INDEX IF NOT EXISTS idx_weather_history_location_time
+    ON weather_history (location_id, timestamp);
+
+-- Observation rows with description and icon decoded, in the column order the
+-- tables had before the conditions were moved out; the API reads these
+CREATE VIEW IF NOT EXISTS current_weather_rows AS
+SELECT w.id, w.location_id, w.timestamp, w.temperature, w.feels_like, w.pressure,
+       w.humidity, w.wind_speed, w.wind_deg, c.description, c.icon,
+       w.source_location_id, w.source_distance_km
+FROM current_weather w LEFT JOIN weather_conditions c ON c.id = w.condition_id;
+
+CREATE VIEW IF NOT EXISTS weather_forecast_rows AS
+SELECT w.id, w.location_id, w.timestamp, w.forecast_timestamp, w.temperature, w.feels_like,
+       w.pressure, w.humidity, w.wind_speed, w.wind_deg, c.description, c.icon
+FROM weather_forecast w LEFT JOIN weather_conditions c ON c.id = w.condition_id;
+
+CREATE VIEW IF NOT EXISTS weather_history_rows AS
+SELECT w.id, w.location_id, w.timestamp, w.temperature, w.feels_like, w.pressure,
+       w.humidity, w.wind_speed, w.wind_deg, c.description, c.icon
+FROM weather_history w LEFT JOIN weather_conditions c ON c.id = w.condition_id;
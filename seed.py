@@ -0,0 +1,150 @@
+import random
+import time
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from auth import generate_salt, hash_password
+from database import get_db, close_db, reshard, shard_count
+from conditions import ConditionEncoder
+
+SEED_PASSWORD = 'benchmark'
+CONDITIONS = [
+    ('clear sky', '01d'), ('few clouds', '02d'), ('scattered clouds', '03d'),
+    ('broken clouds', '04d'), ('overcast clouds', '04n'), ('light rain', '10d'),
+    ('moderate rain', '10n'), ('thunderstorm', '11d'), ('snow', '13d'), ('mist', '50d'),
+]
+
+
+def seed_user_name(index):
+    return f'user{index}'
+
+
+def seed_favorite_ids(user_index, favorites_per_user):
+    """
+    Ids of a seeded user's favorites, valid for a database seeded from empty.
+
+    Args:
+        user_index (int): Zero-based index of the seeded user
+        favorites_per_user (int): The value used when seeding
+
+    Returns:
+        range: The favorite_locations ids belonging to the user
+    """
+    first = user_index * favorites_per_user + 1
+    return range(first, first + favorites_per_user)
+
+
+def _observation(rng, base_temp, hour, condition_ids):
+    temp = round(base_temp + 6 * rng.random() - 3 + 4 * ((hour % 24) - 12) / 12, 2)
+    condition_id = condition_ids[rng.randrange(len(condition_ids))]
+    return (temp, round(temp - rng.random() * 2, 2), rng.randint(990, 1030), rng.randint(30, 95),
+            round(rng.random() * 12, 2), rng.randrange(360), condition_id)
+
+
+def seed_database(db, users=1000, favorites_per_user=3, history_hours=24 * 30,
+                  forecast_days=7, seed=42, now=None):
+    """
+    Fill an empty database with deterministic, realistic-looking data.
+
+    Args:
+        db (sqlite3.Connection): Connection to a database created from schema.sql
+        users (int): Number of users, named user0, user1, ... with password "benchmark"
+        favorites_per_user (int): Favorite locations per user
+        history_hours (int): Hourly history rows per location
+        forecast_days (int): Daily forecast rows per location
+        seed (int): Random seed; the same seed always produces the same data
+        now (int): Timestamp of the newest observation (defaults to the current hour)
+
+    Returns:
+        dict: Counts of the rows inserted and the parameters used
+
+    Note:
+        Inserts run in one transaction with synchronous=OFF; the database is
+        only meant for benchmarks and profiling.
+    """
+    rng = random.Random(seed)
+    now = now or int(time.time()) // 3600 * 3600
+    salt = generate_salt()
+    password_hash = hash_password(SEED_PASSWORD, salt)
+
+    db.execute('PRAGMA synchronous = OFF')
+    encode_condition = ConditionEncoder(db)
+    condition_ids = [encode_condition(description, icon) for description, icon in CONDITIONS]
+    db.executemany(
+        'INSERT INTO users (username, password_hash, salt) VALUES (?, ?, ?)',
+        ((seed_user_name(i), password_hash, salt) for i in range(users))
+    )
+    locations = []
+    for user_id in range(1, users + 1):
+        for _ in range(favorites_per_user):
+            locations.append((user_id, f'Location {len(locations) + 1}',
+                              round(rng.uniform(-60, 70), 4), round(rng.uniform(-180, 180), 4)))
+    db.executemany(
+        'INSERT INTO favorite_locations (user_id, location_name, latitude, longitude) VALUES (?, ?, ?, ?)',
+        locations
+    )
+
+    history_rows = 0
+    for location_id, (_, _, latitude, _) in enumerate(locations, 1):
+        base_temp = 30 - abs(latitude) * 0.5
+        db.execute('''
+            INSERT INTO current_weather
+            (location_id, timestamp, temperature, feels_like, pressure,
+            humidity, wind_speed, wind_deg, condition_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (location_id, now, *_observation(rng, base_temp, 0, condition_ids)))
+        db.executemany('''
+            INSERT INTO weather_forecast
+            (location_id, timestamp, forecast_timestamp, temperature,
+            feels_like, pressure, humidity, wind_speed, wind_deg,
+            condition_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', ((location_id, now, now + day * 86400, *_observation(rng, base_temp, 12, condition_ids))
+              for day in range(1, forecast_days + 1)))
+        db.executemany('''
+            INSERT INTO weather_history
+            (location_id, timestamp, temperature, feels_like,
+            pressure, humidity, wind_speed, wind_deg, condition_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', ((location_id, now - hour * 3600, *_observation(rng, base_temp, hour, condition_ids))
+              for hour in range(history_hours, 0, -1)))
+        history_rows += history_hours
+    db.commit()
+    db.execute('ANALYZE')
+
+    return {
+        "users": users,
+        "favorites_per_user": favorites_per_user,
+        "locations": len(locations),
+        "history_rows": history_rows,
+        "forecast_rows": len(locations) * forecast_days,
+        "seed": seed,
+        "now": now,
+    }
+
+
+def shard_seeded():
+    """
+    Move freshly seeded weather rows into the shard files when SHARDS is set.
+
+    seed_database writes everything to the main database (get_db()); this
+    runs database.reshard on it, closing the request's connections first.
+    """
+    shards = shard_count()
+    if shards:
+        close_db()
+        reshard(current_app.config.get('DATABASE', 'weather.db'), 0, shards)
+
+
+@click.command('seed-db')
+@click.option('--users', default=1000, show_default=True)
+@click.option('--favorites-per-user', default=3, show_default=True)
+@click.option('--history-hours', default=24 * 30, show_default=True)
+@click.option('--seed', default=42, show_default=True)
+@with_appcontext
+def seed_db_command(users, favorites_per_user, history_hours, seed):
+    """Fill an empty database with deterministic benchmark data."""
+    summary = seed_database(get_db(), users, favorites_per_user, history_hours, seed=seed)
+    shard_seeded()
+    click.echo(f"Seeded {summary['users']} users, {summary['locations']} locations and "
+               f"{summary['history_rows']} history rows (password: {SEED_PASSWORD}).")
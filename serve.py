@@ -0,0 +1,90 @@
+import multiprocessing
+import click
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:  # gunicorn does not run on Windows
+    BaseApplication = object
+
+
+class WeatherApplication(BaseApplication):
+    """
+    Runs the Flask app under gunicorn's prefork master.
+
+    The master process binds the listening socket and forks the workers, so a
+    graceful reload replaces workers while the socket keeps accepting connections:
+
+        - SIGHUP: start new workers with the current config, then let old workers
+          finish their in-flight requests (up to graceful_timeout) and exit
+        - SIGUSR2 followed by SIGWINCH/SIGQUIT on the old master: re-exec with new
+          code, which is required when the app is preloaded
+        - SIGTTIN / SIGTTOU: add or remove one worker
+    """
+
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from app import app
+        return app
+
+
+def post_fork(server, worker):
+    """Start the per-process background work in each worker, not the master."""
+    import retention
+    from app import app
+    retention.start_background(app)
+
+
+def default_workers():
+    return multiprocessing.cpu_count() * 2 + 1
+
+
+@click.command('serve')
+@click.option('--bind', default='0.0.0.0:5000', envvar='SERVE_BIND', show_default=True,
+              help='Address to listen on.')
+@click.option('--workers', type=int, default=default_workers, envvar='SERVE_WORKERS',
+              help='Worker processes (default: 2 * cores + 1).')
+@click.option('--threads', type=int, default=16, envvar='SERVE_THREADS', show_default=True,
+              help='Threads per worker; more than one uses the gthread worker, 1 the sync worker.')
+@click.option('--preload/--no-preload', default=True, envvar='SERVE_PRELOAD', show_default=True,
+              help='Import the app in the master before forking.')
+@click.option('--max-requests', type=int, default=1000, envvar='SERVE_MAX_REQUESTS', show_default=True,
+              help='Recycle a worker after this many requests (0 disables).')
+@click.option('--max-requests-jitter', type=int, default=100, envvar='SERVE_MAX_REQUESTS_JITTER',
+              show_default=True, help='Random extra requests so workers do not recycle together.')
+@click.option('--timeout', type=int, default=30, envvar='SERVE_TIMEOUT', show_default=True,
+              help='Seconds before a silent worker is killed and restarted.')
+@click.option('--graceful-timeout', type=int, default=30, envvar='SERVE_GRACEFUL_TIMEOUT',
+              show_default=True, help='Seconds old workers get to finish requests on reload.')
+def serve_command(bind, workers, threads, preload, max_requests, max_requests_jitter,
+                  timeout, graceful_timeout):
+    """Serve the app with a multi-worker gunicorn server."""
+    if BaseApplication is object:
+        raise click.ClickException('gunicorn is required: pip install gunicorn')
+    if threads == 1:
+        click.echo('Warning: with sync workers every /weather/stream or /weather/updates client '
+                   'occupies a whole worker process; use --threads > 1.', err=True)
+
+    WeatherApplication({
+        'bind': bind,
+        'workers': workers,
+        'threads': threads,
+        'worker_class': 'gthread' if threads > 1 else 'sync',
+        'preload_app': preload,
+        'max_requests': max_requests,
+        'max_requests_jitter': max_requests_jitter,
+        'timeout': timeout,
+        'graceful_timeout': graceful_timeout,
+        'accesslog': None,
+        'post_fork': post_fork,
+    }).run()
+
+
+if __name__ == '__main__':
+    serve_command()
@@ -0,0 +1,221 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from metrics import normalize_sql
+
+# Statements that have no query plan worth capturing
+_NO_PLAN = ('BEGIN', 'COMMIT', 'ROLLBACK', 'PRAGMA', 'CREATE', 'DROP', 'VACUUM', 'EXPLAIN')
+
+
+class SQLProfiler:
+    """
+    Per-statement totals, slow-query log and query plans for get_db() connections.
+
+    Each connection gets a trace callback, which records the expanded SQL of the
+    statement about to run, and a progress handler, which counts SQLite VM
+    instructions as a measure of how much work a statement did (full scans show
+    up as large step counts). Timings come from the InstrumentedCursor listener.
+    The EXPLAIN QUERY PLAN of each statement is captured the first time it runs,
+    and statements slower than ``slow_ms`` are logged together with it.
+
+    Totals are kept per process and written as JSON to ``directory/<pid>.json``
+    every ``flush_interval`` seconds and at exit, so ``flask query-report`` can
+    combine the numbers of all workers.
+    """
+
+    def __init__(self, slow_ms=50, progress_steps=1000, directory='sql_profile', flush_interval=5.0):
+        self.slow_seconds = slow_ms / 1000
+        self.progress_steps = progress_steps
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.statements = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._last_flush = time.monotonic()
+
+    def attach(self, db):
+        """Install the trace and progress hooks on a new connection."""
+        local = self._local
+        local.db = db
+        local.steps = 0
+        local.last_sql = None
+        local.explaining = False
+
+        def trace(sql):
+            if not local.explaining:
+                local.last_sql = sql
+
+        def progress():
+            local.steps += self.progress_steps
+            return 0
+
+        db.set_trace_callback(trace)
+        db.set_progress_handler(progress, self.progress_steps)
+
+    def observe(self, sql, phase, seconds):
+        """Statement listener registered in app.extensions['db_listeners']."""
+        local = self._local
+        steps = getattr(local, 'steps', 0)
+        local.steps = 0
+        label = normalize_sql(sql)
+
+        with self._lock:
+            entry = self.statements.get(label)
+            if entry is None:
+                entry = self.statements[label] = {
+                    "calls": 0, "total_seconds": 0.0, "fetch_seconds": 0.0,
+                    "max_seconds": 0.0, "vm_steps": 0, "slow_calls": 0, "plan": None
+                }
+            if phase == 'execute':
+                entry["calls"] += 1
+            else:
+                entry["fetch_seconds"] += seconds
+            entry["total_seconds"] += seconds
+            entry["vm_steps"] += steps
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+            slow = seconds >= self.slow_seconds
+            if slow:
+                entry["slow_calls"] += 1
+            needs_plan = entry["plan"] is None
+
+        if needs_plan:
+            plan = self.explain(getattr(local, 'last_sql', None) or sql)
+            with self._lock:
+                entry["plan"] = plan
+        if slow:
+            current_app.logger.warning(
+                "\nSlow SQL (%s, %.1f ms, ~%d VM steps): %s\nQuery plan: %s",
+                phase, seconds * 1000, steps, label, entry["plan"]
+            )
+
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def explain(self, sql):
+        """
+        Capture the EXPLAIN QUERY PLAN of a statement on the current connection.
+
+        Args:
+            sql (str): The expanded SQL reported by the trace callback
+
+        Returns:
+            list: The plan detail lines, empty if the statement has no plan
+        """
+        local = self._local
+        db = getattr(local, 'db', None)
+        if db is None or sql.lstrip().upper().startswith(_NO_PLAN):
+            return []
+        local.explaining = True
+        try:
+            # the base class execute() bypasses the instrumented cursor
+            rows = sqlite3.Connection.execute(db, f'EXPLAIN QUERY PLAN {sql}').fetchall()
+            return [row[3] for row in rows]
+        except sqlite3.Error:
+            return []
+        finally:
+            local.explaining = False
+
+    def flush(self):
+        """Write this process's totals to ``directory/<pid>.json``."""
+        with self._lock:
+            self._last_flush = time.monotonic()
+            snapshot = json.dumps(self.statements)
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        with open(path + '.tmp', 'w') as f:
+            f.write(snapshot)
+        os.replace(path + '.tmp', path)
+
+
+def init_app(app):
+    """
+    Enable the SQL profiler when SQL_PROFILE is set.
+
+    Config:
+        SQL_PROFILE (bool): Turn the profiler on (off by default)
+        SQL_SLOW_MS (float): Log statements taking at least this long
+        SQL_PROGRESS_STEPS (int): VM instructions between progress callbacks
+        SQL_PROFILE_DIR (str): Where per-process totals are written
+
+    Side-effects:
+        - Stores the profiler in app.extensions['sql_profiler']
+        - Registers a statement listener and a connection hook
+    """
+    app.config.setdefault('SQL_PROFILE', False)
+    app.config.setdefault('SQL_SLOW_MS', 50)
+    app.config.setdefault('SQL_PROGRESS_STEPS', 1000)
+    app.config.setdefault('SQL_PROFILE_DIR', os.path.join(app.instance_path, 'sql_profile'))
+    app.cli.add_command(query_report_command)
+    if not app.config['SQL_PROFILE']:
+        return
+
+    profiler = SQLProfiler(
+        app.config['SQL_SLOW_MS'],
+        app.config['SQL_PROGRESS_STEPS'],
+        app.config['SQL_PROFILE_DIR'],
+    )
+    app.extensions['sql_profiler'] = profiler
+    app.extensions.setdefault('db_listeners', []).append(profiler.observe)
+    app.extensions.setdefault('db_connection_hooks', []).append(profiler.attach)
+    atexit.register(profiler.flush)
+
+
+def load_report(directory):
+    """Merge the per-process JSON files in ``directory`` into one dict of totals."""
+    totals = {}
+    if not os.path.isdir(directory):
+        return totals
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        with open(os.path.join(directory, name)) as f:
+            for sql, entry in json.load(f).items():
+                merged = totals.setdefault(sql, dict(entry, calls=0, total_seconds=0.0,
+                                                     fetch_seconds=0.0, max_seconds=0.0,
+                                                     vm_steps=0, slow_calls=0))
+                for key in ('calls', 'total_seconds', 'fetch_seconds', 'vm_steps', 'slow_calls'):
+                    merged[key] += entry[key]
+                merged['max_seconds'] = max(merged['max_seconds'], entry['max_seconds'])
+                merged['plan'] = merged['plan'] or entry['plan']
+    return totals
+
+
+@click.command('query-report')
+@click.option('--top', default=10, show_default=True, help='Number of statements to show.')
+@click.option('--sort', 'sort_key', default='total_seconds', show_default=True,
+              type=click.Choice(['total_seconds', 'max_seconds', 'calls', 'vm_steps', 'slow_calls']))
+@click.option('--reset', is_flag=True, help='Delete the collected totals after printing.')
+@with_appcontext
+def query_report_command(top, sort_key, reset):
+    """Print the worst SQL statements recorded by the profiler."""
+    directory = current_app.config['SQL_PROFILE_DIR']
+    profiler = current_app.extensions.get('sql_profiler')
+    if profiler is not None:
+        profiler.flush()
+    totals = load_report(directory)
+    if not totals:
+        click.echo(f'No profile data in {directory}. Run the app with SQL_PROFILE enabled first.')
+        return
+
+    worst = sorted(totals.items(), key=lambda item: item[1][sort_key], reverse=True)[:top]
+    for rank, (sql, entry) in enumerate(worst, 1):
+        calls = entry['calls'] or 1
+        click.echo(
+            f"\n#{rank} {entry['total_seconds'] * 1000:.1f} ms total, {entry['calls']} calls, "
+            f"{entry['total_seconds'] * 1000 / calls:.2f} ms avg, {entry['max_seconds'] * 1000:.1f} ms max, "
+            f"{entry['vm_steps'] // calls} VM steps/call, {entry['slow_calls']} slow"
+        )
+        click.echo(f"   {sql}")
+        for line in entry['plan'] or ():
+            flag = '  <-- full scan' if line.startswith('SCAN') else ''
+            click.echo(f"   plan: {line}{flag}")
+
+    if reset:
+        for name in os.listdir(directory):
+            os.unlink(os.path.join(directory, name))
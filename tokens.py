@@ -0,0 +1,269 @@
+"""
+Long-lived, revocable API tokens for programmatic clients, and the cache
+login_required verifies them against.
+
+Only a SHA-256 of each token is stored (api_tokens in schema.sql). A token
+sent as ``Authorization: Bearer <token>`` is looked up once and its owner
+kept in a per-process TokenCache for API_TOKEN_CACHE_TTL seconds, so later
+requests with it reach the route without touching the database.
+
+Revoking a token drops it from this process's cache and touches a revocation
+file next to the database; every process stats that file at most once per
+API_TOKEN_REVOCATION_CHECK seconds and empties its cache when it changed, so
+a revoked token stops working everywhere within that interval.
+"""
+import hashlib
+import os
+import secrets
+import threading
+import time
+import click
+from flask import current_app, request
+from flask.cli import with_appcontext
+from database import get_db
+from metrics import record_cache
+
+TOKEN_PREFIX = 'wat_'
+
+
+def generate_token():
+    """A new token: the prefix (so leaked tokens are easy to search for) and 256 random bits."""
+    return TOKEN_PREFIX + secrets.token_urlsafe(32)
+
+
+def token_hash(token):
+    """
+    The stored form of a token.
+
+    Note:
+        Tokens carry 256 bits of randomness, so an unsalted fast hash is
+        enough: there is nothing to guess that a slow hash would protect.
+    """
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class TokenCache:
+    """
+    Verified tokens of one process, by token hash.
+
+    Args:
+        ttl (float): Seconds a verified token is trusted without a lookup
+        max_size (int): Entries kept; the cache is emptied when it is full
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = {}
+        # Bumped by every removal, so a lookup that raced a revocation does
+        # not put the revoked token back
+        self.generation = 0
+        self._revocation_stamp = None
+        self._next_revocation_check = 0.0
+
+    def get(self, digest, now):
+        """
+        The cached ``(user_id, token_id)`` of a token hash, or None.
+        """
+        entry = self._entries.get(digest)
+        if entry is None or entry[2] <= now:
+            return None
+        return entry[0], entry[1]
+
+    def put(self, digest, user_id, token_id, expires, generation):
+        """
+        Cache a verified token until ``expires`` (a timestamp).
+
+        Args:
+            generation (int): The generation read before the lookup; the
+                entry is not stored if anything was removed since
+        """
+        with self._lock:
+            if generation != self.generation:
+                return
+            if len(self._entries) >= self.max_size:
+                self._entries.clear()
+            self._entries[digest] = (user_id, token_id, expires)
+
+    def discard(self, token_id):
+        """Forget a token (after it was revoked by this process)."""
+        with self._lock:
+            self.generation += 1
+            self._entries = {digest: entry for digest, entry in self._entries.items()
+                             if entry[1] != token_id}
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def check_revocations(self, path, interval, now):
+        """
+        Empty the cache if the revocation file changed since the last check.
+
+        Args:
+            path (str): The revocation file touched by revoke_token
+            interval (float): Seconds between checks (one stat each)
+            now (float): Current time.monotonic()
+        """
+        if now < self._next_revocation_check:
+            return
+        self._next_revocation_check = now + interval
+        try:
+            stat = os.stat(path)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            stamp = None
+        if stamp != self._revocation_stamp:
+            if self._revocation_stamp is not None or stamp is not None:
+                self.clear()
+            self._revocation_stamp = stamp
+
+    def stats(self):
+        return {"cached": len(self._entries), "ttl": self.ttl}
+
+
+def get_cache():
+    return current_app.extensions['api_tokens']
+
+
+def revocation_path():
+    """The file whose changes tell other processes a token was revoked."""
+    return (current_app.config['API_TOKEN_REVOCATION_FILE']
+            or current_app.config.get('DATABASE', 'weather.db') + '.revoked')
+
+
+def bearer_token():
+    """The token of an ``Authorization: Bearer`` header, or None."""
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    token = token.strip()
+    return token if scheme.lower() == 'bearer' and token else None
+
+
+def authenticate(token):
+    """
+    Verify an API token.
+
+    Args:
+        token (str): The token sent by the client
+
+    Returns:
+        tuple or None: ``(user_id, token_id)``, or None if the token is
+        unknown, expired or revoked
+
+    Side-effects:
+        - Reads api_tokens only when the token is not cached
+        - Counts hits and misses of the ``api_tokens`` cache metric
+    """
+    cache = get_cache()
+    cache.check_revocations(revocation_path(), current_app.config['API_TOKEN_REVOCATION_CHECK'],
+                            time.monotonic())
+    digest = token_hash(token)
+    now = time.time()
+    identity = cache.get(digest, now)
+    record_cache('api_tokens', identity is not None)
+    if identity is not None:
+        return identity
+
+    generation = cache.generation
+    row = get_db().execute(
+        'SELECT id, user_id, expires_at FROM api_tokens WHERE token_hash = ? AND revoked_at IS NULL',
+        (digest,)
+    ).fetchone()
+    if row is None or (row['expires_at'] is not None and row['expires_at'] <= now):
+        return None
+    expires = now + cache.ttl
+    if row['expires_at'] is not None:
+        expires = min(expires, row['expires_at'])
+    cache.put(digest, row['user_id'], row['id'], expires, generation)
+    return row['user_id'], row['id']
+
+
+def create_token(db, user_id, name, expires_in_days=None):
+    """
+    Store a new token for a user.
+
+    Args:
+        db (sqlite3.Connection): The main database connection
+        user_id (int): The owner
+        name (str): A label for telling tokens apart
+        expires_in_days (float): Lifetime, or None for a token that lasts
+            until revoked
+
+    Returns:
+        dict: id, name, created_at, expires_at and the token itself, which
+        is not stored and cannot be shown again
+    """
+    token = generate_token()
+    created_at = int(time.time())
+    expires_at = None if expires_in_days is None else created_at + int(expires_in_days * 86400)
+    cursor = db.execute(
+        'INSERT INTO api_tokens (user_id, name, token_hash, created_at, expires_at) VALUES (?, ?, ?, ?, ?)',
+        (user_id, name, token_hash(token), created_at, expires_at)
+    )
+    db.commit()
+    return {"id": cursor.lastrowid, "name": name, "token": token,
+            "created_at": created_at, "expires_at": expires_at}
+
+
+def revoke_token(db, user_id, token_id):
+    """
+    Revoke one of a user's tokens, in this process at once and in the others
+    at their next revocation check.
+
+    Returns:
+        bool: False if the user has no such unrevoked token
+    """
+    revoked = db.execute(
+        'UPDATE api_tokens SET revoked_at = ? WHERE id = ? AND user_id = ? AND revoked_at IS NULL',
+        (int(time.time()), token_id, user_id)
+    ).rowcount
+    db.commit()
+    if not revoked:
+        return False
+    get_cache().discard(token_id)
+    with open(revocation_path(), 'a') as f:
+        f.write(f'{token_id}\n')
+    return True
+
+
+@click.command('create-token')
+@click.argument('username')
+@click.option('--name', default='cli', show_default=True, help='Label shown in GET /tokens.')
+@click.option('--expires-days', type=float, help='Lifetime in days (default: until revoked).')
+@with_appcontext
+def create_token_command(username, name, expires_days):
+    """Create an API token for USERNAME (e.g. for a refresh job) and print it."""
+    db = get_db()
+    user = db.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
+    if user is None:
+        raise click.ClickException(f'No such user: {username}')
+    click.echo(create_token(db, user['id'], name, expires_days)['token'])
+
+
+def init_app(app):
+    """
+    Accept API tokens in login_required.
+
+    Config:
+        API_TOKEN_CACHE_TTL (float): Seconds a verified token is trusted
+            without a database lookup; also bounds how long a token removed
+            from the database by hand keeps working
+        API_TOKEN_CACHE_SIZE (int): Verified tokens kept per process
+        API_TOKEN_REVOCATION_CHECK (float): Seconds between checks of the
+            revocation file, i.e. how late other processes see a revocation
+        API_TOKEN_REVOCATION_FILE (str): The revocation file (default: the
+            database path plus ``.revoked``)
+
+    Side-effects:
+        - Stores the TokenCache in app.extensions['api_tokens']
+        - Registers the create-token command
+    """
+    app.config.setdefault('API_TOKEN_CACHE_TTL', 300.0)
+    app.config.setdefault('API_TOKEN_CACHE_SIZE', 10000)
+    app.config.setdefault('API_TOKEN_REVOCATION_CHECK', 1.0)
+    app.config.setdefault('API_TOKEN_REVOCATION_FILE', None)
+    app.extensions['api_tokens'] = TokenCache(app.config['API_TOKEN_CACHE_TTL'],
+                                              app.config['API_TOKEN_CACHE_SIZE'])
+    app.cli.add_command(create_token_command)
@@ -0,0 +1,265 @@
+"""
+Request tracing in Chrome trace-event format.
+
+run.py starts a trace per user interaction and sends its id to the app in the
+X-Trace-Id header; the app records a span for the request and for each SQL
+statement it runs, and run.py records spans for its app and OpenWeatherMap
+calls. Both append to the same file, which chrome://tracing, Perfetto or
+speedscope open directly.
+
+Usage:
+    python tracing.py trace.json                          list the recorded traces
+    python tracing.py trace.json --trace-id ID -o one.json  extract one interaction
+"""
+import argparse
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from flask import request, g, current_app, has_request_context
+from metrics import normalize_sql
+
+TRACE_HEADER = 'X-Trace-Id'
+_VALID_TRACE_ID = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
+
+
+class Tracer:
+    """
+    Appends complete ("X") trace events to a file.
+
+    The file is a JSON array that is never closed, one event per line, which
+    the trace viewers accept as is. Timestamps are wall-clock microseconds so
+    events from run.py and the app line up on one timeline. Each process
+    (including forked gunicorn workers) reopens the file and names itself with
+    a process_name metadata event on its first write.
+
+    Args:
+        path (str): Trace file; tracing is disabled when None
+        process_name (str): Label shown for this process in the viewer
+    """
+
+    def __init__(self, path, process_name):
+        self.path = path
+        self.process_name = process_name
+        self.enabled = bool(path)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._file = None
+        self._pid = None
+
+    @property
+    def trace_id(self):
+        """The trace started by ``trace()`` on this thread, if any."""
+        return getattr(self._local, 'trace_id', None)
+
+    def _write(self, event):
+        line = json.dumps(event, separators=(',', ':')) + ',\n'
+        with self._lock:
+            pid = os.getpid()
+            if self._pid != pid:
+                self._file = open(self.path, 'a')
+                self._pid = pid
+                if self._file.tell() == 0:
+                    self._file.write('[\n')
+                self._file.write(json.dumps({
+                    'name': 'process_name', 'ph': 'M', 'pid': pid,
+                    'args': {'name': f'{self.process_name} ({pid})'}
+                }) + ',\n')
+            self._file.write(line)
+            self._file.flush()
+
+    def emit(self, name, category, start, duration, trace_id=None, **args):
+        """
+        Record one span.
+
+        Args:
+            name (str): Span name
+            category (str): "request", "sql", "app" or "upstream"
+            start (float): Start time from time.time()
+            duration (float): Duration in seconds
+            trace_id (str): Trace the span belongs to (defaults to the current one)
+            **args: Extra details shown for the span
+        """
+        if not self.enabled:
+            return
+        args['trace_id'] = trace_id or self.trace_id
+        self._write({
+            'name': name, 'cat': category, 'ph': 'X',
+            'ts': int(start * 1e6), 'dur': max(1, int(duration * 1e6)),
+            'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args
+        })
+
+    @contextmanager
+    def span(self, name, category, **args):
+        """Record the enclosed block as a span of the current trace."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.emit(name, category, start, time.time() - start, **args)
+
+    @contextmanager
+    def trace(self, name, headers=None):
+        """
+        Start a new trace for the enclosed block.
+
+        Args:
+            name (str): Name of the interaction
+            headers (dict): Header mapping (e.g. a requests Session's headers)
+                that carries the trace id to the app while the block runs
+
+        Yields:
+            str: The new trace id
+        """
+        trace_id = new_trace_id()
+        self._local.trace_id = trace_id
+        if headers is not None:
+            headers[TRACE_HEADER] = trace_id
+        try:
+            with self.span(name, 'interaction'):
+                yield trace_id
+        finally:
+            self._local.trace_id = None
+            if headers is not None:
+                headers.pop(TRACE_HEADER, None)
+
+    def response_hook(self, response, *args, **kwargs):
+        """requests response hook recording a span per HTTP call."""
+        duration = response.elapsed.total_seconds()
+        prepared = response.request
+        self.emit(f'{prepared.method} {prepared.path_url.split("?")[0]}', 'app',
+                  time.time() - duration, duration,
+                  trace_id=prepared.headers.get(TRACE_HEADER), status=response.status_code)
+        return response
+
+
+def init_app(app):
+    """
+    Trace requests that carry an X-Trace-Id header.
+
+    Config:
+        TRACE_FILE (str): Trace file to append to; tracing is off when unset
+        TRACE_ALL_REQUESTS (bool): Also trace requests without the header,
+            under a newly generated id
+
+    Side-effects:
+        - Stores a Tracer in app.extensions['tracer']
+        - Adds a statement listener to app.extensions['db_listeners']
+        - Registers before_request / after_request / teardown_request hooks
+    """
+    app.config.setdefault('TRACE_FILE', None)
+    app.config.setdefault('TRACE_ALL_REQUESTS', False)
+    if not app.config['TRACE_FILE']:
+        return
+
+    tracer = Tracer(app.config['TRACE_FILE'], 'app')
+    app.extensions['tracer'] = tracer
+    app.extensions.setdefault('db_listeners', []).append(observe_statement)
+    app.before_request(start_span)
+    app.after_request(echo_trace_id)
+    app.teardown_request(finish_span)
+
+
+def start_span():
+    trace_id = request.headers.get(TRACE_HEADER, '')
+    if not _VALID_TRACE_ID.match(trace_id):
+        if not current_app.config['TRACE_ALL_REQUESTS']:
+            return
+        trace_id = new_trace_id()
+    g.trace_id = trace_id
+    g.trace_start = time.time()
+
+
+def echo_trace_id(response):
+    if 'trace_id' in g:
+        response.headers[TRACE_HEADER] = g.trace_id
+        g.trace_status = response.status_code
+    return response
+
+
+def finish_span(e=None):
+    start = g.pop('trace_start', None)
+    if start is None:
+        return
+    rule = request.url_rule
+    current_app.extensions['tracer'].emit(
+        f'{request.method} {rule.rule if rule else request.path}', 'request',
+        start, time.time() - start, trace_id=g.pop('trace_id'),
+        path=request.full_path.rstrip('?'), status=g.pop('trace_status', None)
+    )
+
+
+def observe_statement(sql, phase, seconds):
+    if not has_request_context() or 'trace_start' not in g:
+        return
+    current_app.extensions['tracer'].emit(
+        f'sql {phase}', 'sql', time.time() - seconds, seconds,
+        trace_id=g.trace_id, statement=normalize_sql(sql)
+    )
+
+
+def load_events(path):
+    """Read a trace file written by Tracer, ignoring a truncated last line."""
+    events = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip().rstrip(',')
+            if line in ('', '[', ']'):
+                continue
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                continue
+    return events
+
+
+def extract_trace(events, trace_id):
+    """Return the spans of one trace plus the metadata naming their processes."""
+    spans = [e for e in events if e.get('args', {}).get('trace_id') == trace_id and e['ph'] == 'X']
+    pids = {e['pid'] for e in spans}
+    return [e for e in events if e['ph'] == 'M' and e['pid'] in pids] + spans
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('path')
+    parser.add_argument('--trace-id')
+    parser.add_argument('-o', '--output')
+    args = parser.parse_args()
+
+    events = load_events(args.path)
+    if not args.trace_id:
+        traces = {}
+        for event in events:
+            trace_id = event.get('args', {}).get('trace_id')
+            if event['ph'] != 'X' or not trace_id:
+                continue
+            entry = traces.setdefault(trace_id, {'name': None, 'start': event['ts'], 'end': 0, 'spans': 0})
+            entry['spans'] += 1
+            entry['start'] = min(entry['start'], event['ts'])
+            entry['end'] = max(entry['end'], event['ts'] + event['dur'])
+            if event['cat'] == 'interaction':
+                entry['name'] = event['name']
+        for trace_id, entry in sorted(traces.items(), key=lambda item: item[1]['start']):
+            print(f"{trace_id}  {(entry['end'] - entry['start']) / 1000:>9.2f} ms  "
+                  f"{entry['spans']:>4} spans  {entry['name'] or ''}")
+        return
+
+    selected = extract_trace(events, args.trace_id)
+    output = json.dumps({'traceEvents': selected}, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1073 @@
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from app import app
+from database import init_db, get_db, shard_index, shard_path
+from json_provider import encode_rows
+from admission import AdmissionController
+from sql_profiler import SQLProfiler, load_report
+from metrics import normalize_sql
+import tracing
+import memory
+import app_logging
+import retention
+import partitions
+import column_blocks
+import database
+import geo
+import change_feed
+import tokens
+import passwords
+from conditions import ConditionEncoder, migrate_conditions
+from seed import seed_database, seed_favorite_ids, seed_user_name, SEED_PASSWORD
+
+
+class AppTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up a fresh database and a logged in test client."""
+        self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        app.config['TESTING'] = True
+        app.config['DATABASE'] = self.db_path
+        with app.app_context():
+            init_db()
+
+        self.client = app.test_client()
+        self.client.post('/register', json={'username': 'testuser', 'password': 'testpass123'})
+        self.client.post('/login', json={'username': 'testuser', 'password': 'testpass123'})
+        self.client.post('/favorites', json={
+            'location_name': 'Paris',
+            'latitude': 48.8575,
+            'longitude': 2.3514
+        })
+        self.history_data = {
+            'hourly': [{
+                'dt': 1684926000 + hour * 3600,
+                'temp': 18.5 + hour,
+                'feels_like': 19.0,
+                'pressure': 1012,
+                'humidity': 75,
+                'wind_speed': 3.1,
+                'wind_deg': 270,
+                'weather': [{'description': 'light rain', 'icon': '10n'}]
+            } for hour in range(3)]
+        }
+
+    def tearDown(self):
+        """Remove the temporary database."""
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+
+    def test_favorites_not_modified(self):
+        """Test that a matching If-None-Match returns 304 without a body."""
+        response = self.client.get('/favorites')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+
+        cached = self.client.get('/favorites', headers={'If-None-Match': etag})
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.data, b'')
+
+    def test_favorites_etag_changes_after_add(self):
+        """Test that adding a favorite invalidates the previous ETag."""
+        etag = self.client.get('/favorites').headers['ETag']
+        self.client.post('/favorites', json={
+            'location_name': 'Boston',
+            'latitude': 42.3601,
+            'longitude': -71.0589
+        })
+
+        response = self.client.get('/favorites', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.get_json()), 2)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_history_etag_changes_after_store(self):
+        """Test conditional GET on weather history before and after new rows."""
+        self.client.post('/weather/history/1', json=self.history_data)
+        response = self.client.get('/weather/history/1')
+        self.assertEqual(len(response.get_json()), 3)
+        etag = response.headers['ETag']
+        self.assertEqual(
+            self.client.get('/weather/history/1', headers={'If-None-Match': etag}).status_code,
+            304
+        )
+
+        self.history_data['hourly'] = self.history_data['hourly'][:1]
+        self.history_data['hourly'][0]['dt'] += 86400
+        self.client.post('/weather/history/1', json=self.history_data)
+        response = self.client.get('/weather/history/1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.get_json()), 4)
+
+    def test_row_encoder_matches_default_json(self):
+        """Test that rows serialize to the same JSON as the dict-based default."""
+        self.client.post('/weather/history/1', json=self.history_data)
+        with app.app_context():
+            rows = get_db().execute('SELECT * FROM weather_history_rows').fetchall()
+            expected = [dict(row) for row in rows]
+            self.assertEqual(json.loads(encode_rows(rows)), expected)
+            self.assertEqual(json.loads(encode_rows(rows, sort_keys=False)), expected)
+            self.assertEqual(json.loads(app.json.dumps(rows[0])), expected[0])
+
+    def test_large_response_is_gzip_compressed(self):
+        """Test that bodies over the size threshold are compressed on request."""
+        self.client.post('/weather/history/1', json=self.history_data)
+        app.config['COMPRESS_MIN_SIZE'] = 100
+        try:
+            response = self.client.get('/weather/history/1', headers={'Accept-Encoding': 'gzip'})
+            plain = self.client.get('/weather/history/1')
+        finally:
+            app.config['COMPRESS_MIN_SIZE'] = 1024
+
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(response.data)), plain.get_json())
+        self.assertNotIn('Content-Encoding', plain.headers)
+
+    def test_history_columnar_format(self):
+        """Test that format=columnar returns one array per field."""
+        self.client.post('/weather/history/1', json=self.history_data)
+        rows = self.client.get('/weather/history/1').get_json()
+        response = self.client.get('/weather/history/1?format=columnar')
+        payload = response.get_json()
+
+        self.assertEqual(payload['format'], 'columnar')
+        self.assertEqual(len(payload['fields']), len(payload['columns']))
+        rebuilt = [dict(zip(payload['fields'], values)) for values in zip(*payload['columns'])]
+        self.assertEqual(rebuilt, rows)
+        self.assertNotEqual(
+            response.headers['ETag'],
+            self.client.get('/weather/history/1').headers['ETag']
+        )
+        self.assertEqual(self.client.get('/weather/history/1?format=xml').status_code, 400)
+
+    def test_write_over_limit_is_shed_with_retry_after(self):
+        """Test that a write route at capacity returns 503 with Retry-After."""
+        controller = app.extensions['admission']
+        route = 'POST /weather/history/<int:location_id>'
+        controller.route_limits[route] = 0
+        queue_size = controller.queue_size
+        controller.queue_size = 0
+        try:
+            response = self.client.post('/weather/history/1', json=self.history_data)
+        finally:
+            del controller.route_limits[route]
+            controller.queue_size = queue_size
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        stats = self.client.get('/health').get_json()['admission']
+        self.assertGreaterEqual(stats['routes'][route]['shed'], 1)
+        self.assertEqual(self.client.get('/weather/history/1').status_code, 200)
+
+    def test_waiting_read_blocks_writes(self):
+        """Test that writes are not admitted while a read of the same route is queued."""
+        controller = AdmissionController(read_limit=1, write_limit=4, queue_size=4, timeout=2.0)
+        self.assertTrue(controller.acquire('GET /a', write=False))
+        reader = threading.Thread(target=controller.acquire, args=('GET /a', False))
+        reader.start()
+        while controller.stats()['queue_depth'] == 0:
+            pass
+
+        controller.timeout = 0.05
+        self.assertFalse(controller.acquire('POST /a', write=True))
+        self.assertTrue(controller.acquire('POST /b', write=True))
+        controller.release('GET /a')
+        reader.join()
+        self.assertTrue(controller.acquire('POST /a', write=True))
+        self.assertEqual(controller.stats()['routes']['POST /a']['shed'], 1)
+
+    def test_metrics_endpoint(self):
+        """Test that /metrics reports routes, statements and cache hits."""
+        etag = self.client.get('/favorites').headers['ETag']
+        self.client.get('/favorites', headers={'If-None-Match': etag})
+
+        response = self.client.get('/metrics')
+        body = response.get_data(as_text=True)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('weather_http_requests_total{method="GET",route="/favorites",status="304"}', body)
+        self.assertIn('weather_http_request_duration_seconds_bucket{method="GET",route="/favorites"', body)
+        self.assertIn('statement="SELECT * FROM favorite_locations WHERE user_id = ?"', body)
+        self.assertIn('weather_db_connect_duration_seconds_count', body)
+        self.assertIn('weather_cache_hit_ratio{cache="etag"}', body)
+        self.assertEqual(normalize_sql('SELECT * FROM t\n WHERE id IN (?, ?,?) AND x IN (?)'),
+                         'SELECT * FROM t WHERE id IN (...) AND x IN (...)')
+
+    def test_sql_profiler_records_plans_and_report(self):
+        """Test that the profiler records statement totals, plans and prints a report."""
+        profile_dir = tempfile.mkdtemp()
+        profiler = SQLProfiler(slow_ms=0, directory=profile_dir)
+        app.extensions['sql_profiler'] = profiler
+        app.extensions['db_listeners'].append(profiler.observe)
+        app.extensions.setdefault('db_connection_hooks', []).append(profiler.attach)
+        app.config['SQL_PROFILE_DIR'] = profile_dir
+        try:
+            self.client.get('/favorites')
+            result = app.test_cli_runner().invoke(args=['query-report', '--top', '3', '--reset'])
+        finally:
+            del app.extensions['sql_profiler']
+            app.extensions['db_listeners'].remove(profiler.observe)
+            app.extensions['db_connection_hooks'].remove(profiler.attach)
+
+        entry = profiler.statements['SELECT * FROM favorite_locations WHERE user_id = ?']
+        self.assertEqual(entry['calls'], 1)
+        self.assertEqual(entry['slow_calls'], 2)
+        self.assertIn('idx_favorite_locations_user', ' '.join(entry['plan']))
+        self.assertIn('calls', result.output)
+        self.assertIn('plan:', result.output)
+        self.assertEqual(load_report(profile_dir), {})
+
+    def test_seed_database_is_deterministic(self):
+        """Test that seeded users own the favorite ids the load test expects."""
+        with app.app_context():
+            init_db()
+            db = get_db()
+            db.execute('DELETE FROM favorite_locations')
+            db.execute('DELETE FROM users')
+            db.execute("DELETE FROM sqlite_sequence")
+            db.commit()
+            summary = seed_database(db, users=3, favorites_per_user=2, history_hours=5, seed=7, now=1700000000)
+            first = [tuple(row) for row in db.execute('SELECT * FROM weather_history ORDER BY id')]
+
+        self.assertEqual(summary['history_rows'], 30)
+        client = app.test_client()
+        client.post('/login', json={'username': seed_user_name(1), 'password': SEED_PASSWORD})
+        favorites = client.get('/favorites').get_json()
+        self.assertEqual([f['id'] for f in favorites], list(seed_favorite_ids(1, 2)))
+
+        with app.app_context():
+            db = get_db()
+            for table in ('weather_history', 'weather_forecast', 'current_weather',
+                          'favorite_locations', 'users', 'sqlite_sequence'):
+                db.execute(f'DELETE FROM {table}')
+            db.commit()
+            seed_database(db, users=3, favorites_per_user=2, history_hours=5, seed=7, now=1700000000)
+            second = [tuple(row) for row in db.execute('SELECT * FROM weather_history ORDER BY id')]
+        self.assertEqual(first, second)
+
+    def test_profile_route_writes_collapsed_stacks(self):
+        """Test that profile-route profiles a seeded database and restores the configured one."""
+        output = os.path.join(tempfile.mkdtemp(), 'history.folded')
+        result = app.test_cli_runner().invoke(args=[
+            'profile-route', '/weather/history/1', '-n', '50', '--warmup', '2',
+            '--users', '2', '--history-hours', '24', '--output', output
+        ])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('/weather/history/1 -> 200', result.output)
+        self.assertIn('total %', result.output)
+        self.assertEqual(app.config['DATABASE'], self.db_path)
+        with open(output) as f:
+            lines = f.read().splitlines()
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            self.assertGreater(int(count), 0)
+            self.assertIn(':', stack.split(';')[-1])
+
+        del app.config['DATABASE']
+        self.addCleanup(app.config.__setitem__, 'DATABASE', self.db_path)
+        result = app.test_cli_runner().invoke(args=[
+            'profile-route', '/health', '-n', '5', '--users', '1', '--history-hours', '1', '--output', output
+        ])
+        shutil.rmtree(os.path.dirname(output))
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertNotIn('DATABASE', app.config)
+
+    def test_tracing_records_request_and_sql_spans(self):
+        """Test that a request carrying X-Trace-Id yields request and SQL spans with that id."""
+        from flask import Flask
+        trace_path = os.path.join(tempfile.mkdtemp(), 'trace.json')
+        traced_app = Flask(__name__)
+        traced_app.config.update(DATABASE=self.db_path, TRACE_FILE=trace_path)
+        tracing.init_app(traced_app)
+
+        @traced_app.route('/count')
+        def count():
+            return {'users': get_db().execute('SELECT COUNT(*) FROM users').fetchone()[0]}
+
+        client = traced_app.test_client()
+        response = client.get('/count', headers={'X-Trace-Id': 'abc123'})
+        client.get('/count')
+
+        self.assertEqual(response.headers['X-Trace-Id'], 'abc123')
+        events = tracing.load_events(trace_path)
+        os.unlink(trace_path)
+        os.rmdir(os.path.dirname(trace_path))
+        spans = [e for e in events if e['ph'] == 'X']
+        self.assertEqual({e['args']['trace_id'] for e in spans}, {'abc123'})
+        self.assertEqual([e['cat'] for e in spans], ['sql', 'sql', 'request'])
+        self.assertEqual(spans[0]['args']['statement'], 'SELECT COUNT(*) FROM users')
+        self.assertEqual(spans[2]['args']['status'], 200)
+        request_span = spans[2]
+        self.assertLessEqual(request_span['ts'], spans[0]['ts'])
+        self.assertEqual(len(tracing.extract_trace(events, 'abc123')), 4)
+
+    def test_memory_profiler_reports_routes_and_growth(self):
+        """Test that /debug/memory reports per-route peaks, retained sites and RSS."""
+        from flask import Flask
+        profiled_app = Flask(__name__)
+        profiled_app.config.update(MEMORY_PROFILE=True, MEMORY_SNAPSHOT_EVERY=1)
+        retained = []
+
+        @profiled_app.route('/grow')
+        def grow():
+            transient = [dict(id=i) for i in range(2000)]
+            retained.append(bytearray(200000))
+            return {'rows': len(transient)}
+
+        memory.init_app(profiled_app)
+        try:
+            client = profiled_app.test_client()
+            for _ in range(3):
+                client.get('/grow')
+            report = client.get('/debug/memory?since=start').get_json()
+        finally:
+            import tracemalloc
+            tracemalloc.stop()
+
+        route = report['routes']['GET /grow']
+        self.assertEqual(route['requests'], 3)
+        self.assertGreater(route['peak_bytes_max'], 200000 + 2000 * 64)
+        self.assertEqual(route['snapshots'], 3)
+        self.assertIn('test_app.py', route['retained_sites'][0]['site'])
+        self.assertGreaterEqual(route['retained_sites'][0]['size_diff_mean'], 200000)
+        self.assertGreaterEqual(sum(site['size_diff'] for site in report['growth']), 600000)
+        self.assertGreater(report['rss_bytes'], 0)
+        self.assertEqual(client.get('/debug/memory?since=never').status_code, 400)
+
+    def test_structured_logging_and_payload_sampling(self):
+        """Test that queued JSON logs carry request context and payloads are only logged when sampled."""
+        import io
+        stream = io.StringIO()
+        try:
+            app_logging.init_app(app, stream)
+            self.client.post('/weather/history/1', json=self.history_data)
+            app.config['LOG_PAYLOAD_SAMPLE_RATE'] = 1.0
+            self.client.post('/weather/history/1', json=self.history_data)
+            app_logging.init_app(app, io.StringIO())
+        finally:
+            app.config['LOG_PAYLOAD_SAMPLE_RATE'] = 0.0
+            app_logging.init_app(app)
+
+        entries = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertIn({'message': 'Session loaded for user ID: 1', 'method': 'POST',
+                       'path': '/weather/history/1', 'user_id': 1},
+                      [{key: entry.get(key) for key in ('message', 'method', 'path', 'user_id')}
+                       for entry in entries])
+        payloads = [entry for entry in entries if entry.get('payload_sampled')]
+        self.assertEqual(len(payloads), 1)
+        self.assertIn("'temp': 18.5", payloads[0]['message'])
+
+    def test_compact_history_rolls_up_and_serves_old_ranges(self):
+        """Test that old history becomes daily rollups, in whole-day batches, and range reads use them."""
+        day = 1684886400
+        insert = '''
+            INSERT INTO weather_history
+            (location_id, timestamp, temperature, feels_like, pressure,
+            humidity, wind_speed, wind_deg, condition_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        '''
+        with app.app_context():
+            db = get_db()
+            encode_condition = ConditionEncoder(db)
+            mist, clear = encode_condition('mist', '50d'), encode_condition('clear sky', '01d')
+            rows = [(1, day + hour * 3600, 10.0 + hour % 24, 9.0, 1000, 50, 2.0, 90, mist)
+                    for hour in range(72)]
+            rows.append((1, day + 40 * 86400 - 3600, 20.0, 19.0, 1000, 50, 2.0, 90, clear))
+            db.executemany(insert, rows)
+            db.commit()
+            stats = retention.compact_history(db, now=day + 40 * 86400, raw_days=30, batch_size=30)
+            rollups = db.execute('''
+                SELECT day, samples, temperature_min, temperature_max, description
+                FROM weather_history_daily JOIN weather_conditions c ON c.id = condition_id
+            ''').fetchall()
+            db.execute(insert, (1, day + 3600, 40.0, 9.0, 1000, 50, 2.0, 90, mist))
+            db.commit()
+            retention.compact_history(db, now=day + 40 * 86400, raw_days=30)
+            merged = db.execute('SELECT samples, temperature_max FROM weather_history_daily WHERE day = ?',
+                                (day,)).fetchone()
+
+        self.assertEqual(stats['history_rows_rolled_up'], 72)
+        self.assertEqual(stats['rollup_days_written'], 3)
+        self.assertEqual([tuple(r) for r in rollups],
+                         [(day + n * 86400, 24, 10.0, 33.0, 'mist') for n in range(3)])
+        self.assertEqual(tuple(merged), (25, 40.0))
+
+        response = self.client.get(f'/weather/history/1?start={day}&end={day + 41 * 86400}')
+        data = response.get_json()
+        self.assertEqual([row['resolution'] for row in data], ['hourly', 'daily', 'daily', 'daily'])
+        self.assertEqual(data[-1]['timestamp'], day)
+        self.assertEqual(self.client.get('/weather/history/1?end=soon').status_code, 400)
+
+    def test_collect_orphans_after_favorite_deletion(self):
+        """Test that deleting a favorite queues its weather rows for batched collection."""
+        self.client.post('/weather/history/1', json=self.history_data)
+        self.client.post('/weather/current/1', json={'current': self.history_data['hourly'][0]})
+        self.assertEqual(self.client.delete('/favorites/1').status_code, 200)
+
+        with app.app_context():
+            db = get_db()
+            self.assertEqual(db.execute('SELECT COUNT(*) FROM weather_history').fetchone()[0], 3)
+            db.execute('INSERT INTO weather_forecast (location_id, timestamp, forecast_timestamp) VALUES (99, 1, 2)')
+            db.commit()
+            stats = retention.collect_orphans(db, batch_size=2)
+            self.assertEqual(db.execute('SELECT COUNT(*) FROM weather_forecast').fetchone()[0], 1)
+            scanned = retention.collect_orphans(db, scan=True)
+            remaining = [db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                         for table in retention.WEATHER_TABLES + ('orphaned_locations',)]
+
+        self.assertEqual(stats['locations'], 1)
+        self.assertEqual(stats['weather_history'], 3)
+        self.assertEqual(stats['current_weather'], 1)
+        self.assertEqual(stats['rows_deleted'], 4)
+        self.assertEqual((scanned['locations'], scanned['weather_forecast']), (1, 1))
+        self.assertEqual(remaining, [0, 0, 0, 0, 0])
+
+
+    def test_conditions_are_dictionary_encoded(self):
+        """Test that descriptions and icons are stored once, served unchanged, and old tables migrate."""
+        self.history_data['hourly'][1]['weather'] = [{'description': 'mist', 'icon': '50d'}]
+        self.client.post('/weather/history/1', json=self.history_data)
+        self.client.post('/weather/current/1', json={
+            'current': {'dt': 1684926000, 'temp': 18.5, 'feels_like': 19.0, 'pressure': 1012, 'humidity': 75,
+                        'wind_speed': 3.1, 'wind_deg': 270,
+                        'weather': [{'description': 'light rain', 'icon': '10n'}]}
+        })
+        history = self.client.get('/weather/history/1').get_json()
+        current = self.client.get('/weather/current/1').get_json()
+
+        self.assertEqual([(row['description'], row['icon']) for row in history],
+                         [('light rain', '10n'), ('mist', '50d'), ('light rain', '10n')])
+        self.assertEqual((current['description'], current['icon']), ('light rain', '10n'))
+        with app.app_context():
+            db = get_db()
+            self.assertEqual(db.execute('SELECT COUNT(*) FROM weather_conditions').fetchone()[0], 2)
+            db.execute('DROP VIEW weather_history_rows')
+            db.execute('DROP TABLE weather_history')
+            db.execute('''
+                CREATE TABLE weather_history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, location_id INTEGER NOT NULL,
+                    timestamp INTEGER NOT NULL, temperature REAL, description TEXT, icon TEXT
+                )
+            ''')
+            db.executemany('INSERT INTO weather_history (location_id, timestamp, temperature, description, icon) '
+                           'VALUES (1, ?, 20.0, ?, ?)', [(1, 'snow', '13d'), (2, 'mist', '50d'), (3, None, None)])
+            db.commit()
+            converted = migrate_conditions(db)
+            rows = db.execute('''
+                SELECT description, icon FROM weather_history
+                LEFT JOIN weather_conditions c ON c.id = condition_id ORDER BY timestamp
+            ''').fetchall()
+            columns = [row[1] for row in db.execute('PRAGMA table_info(weather_history)')]
+
+        self.assertEqual(converted, {'weather_history': 2})
+        self.assertEqual([tuple(row) for row in rows], [('snow', '13d'), ('mist', '50d'), (None, None)])
+        self.assertNotIn('description', columns)
+
+        # init-db converts a table that predates condition_id, so the views work again
+        with app.app_context():
+            db = get_db()
+            db.execute('DROP TABLE weather_history')
+            db.execute('DROP VIEW current_weather_rows')
+            db.execute('DROP TABLE current_weather')
+            db.execute('''
+                CREATE TABLE current_weather (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, location_id INTEGER NOT NULL,
+                    timestamp INTEGER NOT NULL, temperature REAL, feels_like REAL, pressure INTEGER,
+                    humidity INTEGER, wind_speed REAL, wind_deg INTEGER, description TEXT, icon TEXT
+                )
+            ''')
+            db.execute("INSERT INTO current_weather (location_id, timestamp, temperature, description, icon) "
+                       "VALUES (1, 1684926000, 21.0, 'haze', '50n')")
+            db.commit()
+            self.assertEqual(init_db(), {'current_weather': 1})
+        current = self.client.get('/weather/current/1').get_json()
+        self.assertEqual((current['temperature'], current['description']), (21.0, 'haze'))
+
+
+    def test_history_partitions_archive_route_and_detach(self):
+        """Test that compaction moves old months into sealed partition files that range reads attach."""
+        archive_dir = tempfile.mkdtemp()
+        detached_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_dir)
+        self.addCleanup(shutil.rmtree, detached_dir)
+        app.config['HISTORY_ARCHIVE_DIR'] = archive_dir
+        self.addCleanup(app.config.__setitem__, 'HISTORY_ARCHIVE_DIR', None)
+        may, june, now = 1682899200, 1685577600, 1689811200
+        insert = '''
+            INSERT INTO weather_history (location_id, timestamp, temperature, condition_id)
+            VALUES (1, ?, ?, ?)
+        '''
+        with app.app_context():
+            db = get_db()
+            mist = ConditionEncoder(db)('mist', '50d')
+            db.executemany(insert, [(may + hour * 3600, 10.0, mist) for hour in range(41 * 24)])
+            db.commit()
+            stats = retention.compact_history(db, now=now, batch_size=500, archive=partitions.get_archive())
+            hot_oldest = db.execute('SELECT MIN(timestamp) FROM weather_history').fetchone()[0]
+            db.execute(insert, (may + 3600, 30.0, mist))
+            db.commit()
+            late = retention.compact_history(db, now=now, archive=partitions.get_archive())
+            listed = [(partitions.month_label(month), sealed)
+                      for month, _, sealed in partitions.get_archive().partitions()]
+
+        self.assertEqual(stats['rows_archived'], 41 * 24)
+        self.assertEqual(stats['partitions_sealed'], ['2023-05'])
+        self.assertIsNone(hot_oldest)
+        self.assertEqual((late['rows_archived'], late['rows_not_archived']), (0, 1))
+        self.assertEqual(listed, [('2023-05', True), ('2023-06', False)])
+
+        def resolutions(start, end):
+            rows = self.client.get(f'/weather/history/1?start={start}&end={end}').get_json()
+            return {row['resolution'] for row in rows}, rows
+
+        found, rows = resolutions(may + 10 * 86400, may + 12 * 86400)
+        self.assertEqual(found, {'hourly'})
+        self.assertEqual(len(rows), 48)
+        self.assertEqual(rows[0]['description'], 'mist')
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['detach-history', '2023-06', '--to', detached_dir])
+        self.assertIn('still open', result.output)
+        result = runner.invoke(args=['detach-history', '2023-05', '--to', detached_dir])
+        self.assertEqual(result.exit_code, 0, result.output)
+        found, rows = resolutions(may + 10 * 86400, may + 12 * 86400)
+        self.assertEqual((found, len(rows)), ({'daily'}, 2))
+
+        result = runner.invoke(args=['attach-history', os.path.join(detached_dir, 'weather_history_2023_05.db')])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(resolutions(may, june + 86400)[0], {'hourly'})
+
+        with app.app_context():
+            db = get_db()
+            db.execute('INSERT INTO orphaned_locations (location_id, deleted_at) VALUES (1, 0)')
+            db.commit()
+            collected = retention.collect_orphans(db, archive_for=lambda shard: partitions.get_archive(shard=shard))
+        # The open June partition loses the rows; sealed May keeps them
+        self.assertEqual(collected['archived_rows_deleted'], 10 * 24)
+        self.assertEqual(resolutions(may, june + 86400)[0], {'hourly'})
+        self.assertEqual(resolutions(june, june + 5 * 86400)[1], [])
+
+
+    def test_cold_blocks_round_trip_and_pack(self):
+        """Test that column blocks decode to the exact values and sealed months are stored as blocks."""
+        columns = [
+            [1700000000 + hour * 3600 for hour in range(48)],
+            [18.5, 19.25, None, -3.0],
+            [1.23456789, 2.5, 3.1e10],
+            [1012, None, 1013.5, 'n/a'],
+            [],
+        ]
+        for values in columns:
+            for regular in (False, True):
+                decoded = column_blocks.decode_column(column_blocks.encode_column(values, regular))
+                self.assertEqual(decoded, values)
+                self.assertEqual([type(value) for value in decoded], [type(value) for value in values])
+                self.assertEqual(column_blocks.decode_column(column_blocks.encode_column(values, regular), 2),
+                                 values[:2])
+        self.assertEqual(column_blocks.column_codec(column_blocks.encode_column(columns[0], True)), 'dod')
+        self.assertEqual(column_blocks.column_codec(column_blocks.encode_column(columns[1])), 'scaled')
+
+        path = os.path.join(tempfile.mkdtemp(), 'weather_history_2023_05.db')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        partition = sqlite3.connect(path)
+        partition.executescript(partitions.PARTITION_SCHEMA)
+        partition.executemany('INSERT INTO weather_history VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [
+            (location * 10000 + hour + 1, location, 1682899200 + hour * 3600, 10 + hour / 4, None,
+             1000 + hour % 3, 50, 2.5, 90, 1)
+            for location in (1, 2) for hour in range(24 * 31)
+        ])
+        partition.commit()
+        self.assertEqual(partitions.pack_blocks(partition), 2 * 24 * 31)
+        self.assertEqual(partition.execute('SELECT COUNT(*) FROM weather_history').fetchone()[0], 0)
+        partition.close()
+
+        with app.app_context():
+            db = get_db()
+            db.execute('ATTACH DATABASE ? AS history_2023_05', (partitions.read_only_uri(path),))
+            oldest = partitions.load_blocks(db, ['history_2023_05'], 2, 1682899200 + 3600, 1682899200 + 4 * 3600)
+            loaded = db.execute('SELECT * FROM temp.cold_history').fetchall()
+
+        self.assertEqual(oldest, 1682899200)
+        self.assertEqual([tuple(row) for row in loaded],
+                         [(20000 + hour + 1, 2, 1682899200 + hour * 3600, 10 + hour / 4, None, 1000 + hour % 3,
+                           50, 2.5, 90, 1) for hour in range(1, 4)])
+
+
+    def test_sharded_weather_storage_and_reshard(self):
+        """Test that weather rows are routed to shard files, read back, collected and resharded."""
+        def remove_shards():
+            for index in range(3):
+                for path in (shard_path(self.db_path, index), shard_path(self.db_path, index) + '.resharding'):
+                    if os.path.exists(path):
+                        os.unlink(path)
+        self.addCleanup(remove_shards)
+        self.addCleanup(app.config.__setitem__, 'SHARDS', 0)
+        app.config['SHARDS'] = 3
+        with app.app_context():
+            init_db()
+        for name in ('Boston', 'Tokyo', 'Lima'):
+            self.client.post('/favorites', json={'location_name': name, 'latitude': 1.0, 'longitude': 2.0})
+        for location_id in range(1, 5):
+            self.client.post(f'/weather/history/{location_id}', json=self.history_data)
+        for location_id, hourly in enumerate(self.history_data['hourly'], 1):
+            self.client.post(f'/weather/current/{location_id}', json={'current': hourly})
+
+        def history_counts():
+            counts = {}
+            for index in range(3):
+                shard = sqlite3.connect(shard_path(self.db_path, index))
+                counts.update(shard.execute(
+                    'SELECT location_id, COUNT(*) FROM weather_history GROUP BY location_id').fetchall())
+                shard.close()
+            return counts
+
+        main = sqlite3.connect(self.db_path)
+        self.addCleanup(main.close)
+        self.assertEqual(main.execute('SELECT COUNT(*) FROM weather_history').fetchone()[0], 0)
+        for index in range(3):
+            shard = sqlite3.connect(shard_path(self.db_path, index))
+            locations = {row[0] for row in shard.execute('SELECT location_id FROM weather_history')}
+            shard.close()
+            self.assertEqual(locations, {i for i in range(1, 5) if shard_index(i, 3) == index})
+        self.assertEqual(history_counts(), {1: 3, 2: 3, 3: 3, 4: 3})
+
+        rows = self.client.get('/weather/history/2').get_json()
+        self.assertEqual((len(rows), rows[0]['description']), (3, 'light rain'))
+        current = self.client.get('/weather/current').get_json()
+        self.assertEqual([(row['location_id'], row['timestamp']) for row in current],
+                         [(i, 1684926000 + (i - 1) * 3600) for i in range(1, 4)])
+        self.addCleanup(setattr, database, 'MAX_QUERY_LOCATIONS', database.MAX_QUERY_LOCATIONS)
+        database.MAX_QUERY_LOCATIONS = 1
+        self.assertEqual(self.client.get('/weather/current').get_json(), current)
+
+        self.client.delete('/favorites/2')
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['gc-weather'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(history_counts(), {1: 3, 3: 3, 4: 3})
+
+        result = runner.invoke(args=['reshard', '0'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        app.config['SHARDS'] = 0
+        self.assertEqual(main.execute('SELECT COUNT(*) FROM weather_history').fetchone()[0], 9)
+        self.assertEqual(len(self.client.get('/weather/history/3').get_json()), 3)
+
+        result = runner.invoke(args=['reshard', '2', '--from', '0'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        app.config['SHARDS'] = 2
+        self.assertEqual(main.execute('SELECT COUNT(*) FROM weather_history').fetchone()[0], 0)
+        self.assertEqual(len(self.client.get('/weather/history/3').get_json()), 3)
+        self.assertEqual([row['location_id'] for row in self.client.get('/weather/current').get_json()], [1, 3])
+
+
+    def test_nearby_locations_use_spatial_index(self):
+        """Test that nearby search returns the nearest indexed favorites and follows deletions."""
+        for name, latitude, longitude in [('Louvre', 48.8606, 2.3376), ('Versailles', 48.8049, 2.1204),
+                                          ('Lyon', 45.764, 4.8357), ('Suva', -18.1416, 178.4419),
+                                          ('Apia', -13.8333, -171.7667)]:
+            self.client.post('/favorites', json={'location_name': name, 'latitude': latitude, 'longitude': longitude})
+        other = app.test_client()
+        other.post('/register', json={'username': 'other', 'password': 'otherpass123'})
+        other.post('/login', json={'username': 'other', 'password': 'otherpass123'})
+        other.post('/favorites', json={'location_name': 'Home', 'latitude': 48.857, 'longitude': 2.352})
+
+        response = self.client.get('/locations/nearby?lat=48.8575&lon=2.3514&radius_km=30')
+        self.assertEqual(response.status_code, 200)
+        found = response.get_json()
+        self.assertEqual([row['location_name'] for row in found], ['Paris', 'Louvre', 'Versailles'])
+        self.assertEqual(found[0]['distance_km'], 0)
+        self.assertAlmostEqual(found[1]['distance_km'], 1.1, delta=0.1)
+        limited = self.client.get('/locations/nearby?lat=48.8575&lon=2.3514&radius_km=500&limit=2').get_json()
+        self.assertEqual([row['location_name'] for row in limited], ['Paris', 'Louvre'])
+        others = other.get('/locations/nearby?lat=48.8575&lon=2.3514&radius_km=30').get_json()
+        self.assertEqual([row['location_name'] for row in others], ['Home'])
+        across = self.client.get('/locations/nearby?lat=-17&lon=-179.9&radius_km=500').get_json()
+        self.assertEqual([row['location_name'] for row in across], ['Suva'])
+
+        self.client.delete('/favorites/2')
+        with app.app_context():
+            db = get_db()
+            db.execute('UPDATE favorite_locations SET latitude = 0, longitude = 0 WHERE id = 3')
+            db.commit()
+            indexed = db.execute('SELECT id FROM favorite_locations_rtree WHERE max_lat > 40').fetchall()
+        self.assertEqual([row['id'] for row in indexed], [1, 4, 7])
+        self.assertEqual(self.client.get('/locations/nearby?lat=48.8575&lon=2.3514&radius_km=2').status_code, 200)
+        self.assertEqual(self.client.get('/locations/nearby?lat=91&lon=0&radius_km=2').status_code, 400)
+        self.assertEqual(self.client.get('/locations/nearby?lat=48&lon=2').status_code, 400)
+        self.assertEqual(geo.bounding_boxes(89.9, 0, 50)[0][2:], (-180.0, 180.0))
+        self.assertEqual(len(geo.bounding_boxes(0, -179.9, 50)), 2)
+
+
+    def test_current_weather_reused_from_nearby_location(self):
+        """Test that a fresh observation close by is stored for a new location with its provenance."""
+        now = int(time.time())
+        for name, latitude, longitude in [('Paris Louvre', 48.8601, 2.3514), ('Lyon', 45.764, 4.8357)]:
+            self.client.post('/favorites', json={'location_name': name, 'latitude': latitude, 'longitude': longitude})
+        current = dict(self.history_data['hourly'][0], dt=now - 60)
+        self.client.post('/weather/current/1', json={'current': current})
+
+        response = self.client.post('/weather/current/2/reuse')
+        self.assertEqual(response.status_code, 200)
+        reused = response.get_json()
+        self.assertEqual((reused['location_id'], reused['source_location_id']), (2, 1))
+        self.assertAlmostEqual(reused['source_distance_km'], 0.29, delta=0.01)
+        self.assertEqual((reused['timestamp'], reused['description']), (now - 60, 'light rain'))
+        self.assertEqual(self.client.get('/weather/current/2').get_json()['source_location_id'], 1)
+        first_hand = self.client.get('/weather/current/1').get_json()
+        self.assertIsNone(first_hand['source_location_id'])
+
+        self.assertEqual(self.client.post('/weather/current/3/reuse').status_code, 404)
+        app.config['REUSE_MAX_AGE'] = 30
+        self.addCleanup(app.config.__setitem__, 'REUSE_MAX_AGE', 600)
+        with app.app_context():
+            get_db().execute('DELETE FROM current_weather WHERE location_id = 2')
+            get_db().commit()
+        self.assertEqual(self.client.post('/weather/current/2/reuse').status_code, 404)
+
+
+    def test_change_feed_stream_and_long_poll(self):
+        """Test that committed writes are pushed to SSE and long-poll clients of the location only."""
+        self.client.post('/favorites', json={'location_name': 'Boston', 'latitude': 42.3601, 'longitude': -71.0589})
+        start = self.client.get('/weather/updates?timeout=0').get_json()
+        self.assertEqual(start['events'], [])
+
+        poller = app.test_client()
+        poller.post('/login', json={'username': 'testuser', 'password': 'testpass123'})
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            poller.get(f"/weather/updates?locations=1&since={start['last_id']}&timeout=5").get_json()))
+        thread.start()
+        time.sleep(0.2)
+        self.client.post('/weather/history/2', json=self.history_data)
+        self.client.post('/weather/current/1', json={'current': self.history_data['hourly'][0]})
+        thread.join()
+        events = results[0]['events']
+        self.assertEqual([(event['kind'], event['location_id']) for event in events], [('current', 1)])
+        self.assertEqual((events[0]['data']['temperature'], events[0]['data']['description']), (18.5, 'light rain'))
+        self.assertEqual(results[0]['last_id'], events[0]['id'])
+
+        app.config.update(STREAM_MAX_SECONDS=0.3, STREAM_HEARTBEAT=0.1)
+        self.addCleanup(app.config.update, STREAM_MAX_SECONDS=25.0, STREAM_HEARTBEAT=15.0)
+        response = self.client.get('/weather/stream', headers={'Last-Event-ID': str(start['last_id'])})
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.client.post('/weather/forecast/2', json={'current': {'dt': 1684926000}, 'daily': []})
+        body = response.get_data(as_text=True)
+        response.close()
+        self.assertEqual(body.count('event: '), 3)
+        self.assertIn('event: history\n', body)
+        self.assertIn(f"id: {events[0]['id']}\nevent: current\n", body)
+        self.assertIn('event: forecast\ndata: {"location_id":2,"timestamp":1684926000,"rows":0}', body)
+        self.assertIn(': keepalive', body)
+        self.assertEqual(self.client.get('/weather/stream?locations=99').status_code, 404)
+        self.assertEqual(self.client.get('/health').get_json()['stream']['subscribers'], 0)
+
+        # Two feeds on one database stand for two worker processes
+        connect = lambda: sqlite3.connect(f'file:{self.db_path}?mode=rw', uri=True)
+        db = connect()
+        self.addCleanup(db.close)
+        db.execute('DELETE FROM weather_events')
+        db.commit()
+        feed = change_feed.ChangeFeed(connect, buffer_size=2, history_size=3, poll_interval=0.05)
+        other = change_feed.ChangeFeed(connect, history_size=3, poll_interval=0.05)
+        subscription = feed.subscribe(db, [1])
+        watcher = other.subscribe(db, [1, 2])
+        published = [other.publish(db, 1, 'current', {'temperature': temperature}) for temperature in range(4)]
+        published.append(other.publish(db, 2, 'current', {'temperature': 9}))
+        for deadline in range(100):
+            if feed.stats()['last_id'] == published[-1].seq:
+                break
+            time.sleep(0.01)
+        received, dropped = subscription.get(0)
+        self.assertEqual(([event.data['temperature'] for event in received], dropped), ([2, 3], 2))
+        self.assertEqual([event.seq for event in received], [event.seq for event in published[2:4]])
+        # Every event is either delivered or counted as missed
+        self.assertEqual(sum(len(events) + missed for events, missed in (watcher.get(1), watcher.get(0.2))), 5)
+        # Ids are the same in every process, so a reconnect may land on either
+        self.assertEqual(feed.subscribe(db, [1], since=0).dropped, 1)
+        resumed = other.subscribe(db, [1], since=published[2].seq)
+        self.assertEqual(([event.seq for event in resumed.events], resumed.dropped), ([published[3].seq], 0))
+        self.assertEqual(resumed.cursor, published[-1].seq)
+
+        # Feed clients are capped per process instead of holding admission slots
+        self.assertNotIn('GET /weather/updates', self.client.get('/health').get_json()['admission']['routes'])
+        full = change_feed.ChangeFeed(connect, max_clients=1)
+        held = full.subscribe(db, [1])
+        original = app.extensions['change_feed']
+        app.extensions['change_feed'] = full
+        self.addCleanup(app.extensions.__setitem__, 'change_feed', original)
+        response = self.client.get('/weather/updates?timeout=0')
+        self.assertEqual((response.status_code, response.headers['Retry-After']), (503, '5'))
+        self.assertEqual(self.client.get('/weather/stream').status_code, 503)
+        full.unsubscribe(held)
+        self.assertEqual(self.client.get('/weather/updates?timeout=0').status_code, 200)
+
+
+    def test_favorites_batch_import_and_keyset_pages(self):
+        """Test that a batch inserts its valid items in one go and favorites can be paged and projected."""
+        locations = [{'location_name': f'Place {i}', 'latitude': i / 10, 'longitude': -i / 10} for i in range(7)]
+        locations[2] = {'location_name': 'Nowhere', 'latitude': 91, 'longitude': 0}
+        locations[4] = {'location_name': ' ', 'latitude': 1, 'longitude': 1}
+        response = self.client.post('/favorites/batch', json={'locations': locations})
+        self.assertEqual(response.status_code, 200)
+        batch = response.get_json()
+        self.assertEqual((batch['created'], batch['invalid']), (5, 2))
+        self.assertEqual([result.get('id') for result in batch['results']], [2, 3, None, 4, None, 5, 6])
+        self.assertIn('latitude', batch['results'][2]['error'])
+        self.assertEqual(self.client.post('/favorites/batch', json={'locations': []}).status_code, 400)
+        self.assertEqual(self.client.post('/favorites/batch', json=[{'location_name': 'x'}]).status_code, 400)
+
+        pages, url = [], '/favorites?limit=4&fields=location_name'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            pages.append(response.get_json())
+            url = response.headers.get('Link', '').partition('<')[2].partition('>')[0]
+        self.assertEqual([[row['id'] for row in page] for page in pages], [[1, 2, 3, 4], [5, 6]])
+        self.assertEqual(set(pages[0][1]), {'id', 'location_name'})
+        self.assertEqual(pages[0][1]['location_name'], 'Place 0')
+        self.assertEqual(len(self.client.get('/favorites').get_json()), 6)
+        self.assertEqual(self.client.get('/favorites?after=6&limit=5').get_json(), [])
+        self.assertEqual(self.client.get('/favorites?fields=password').status_code, 400)
+
+        etag = self.client.get('/favorites?after=4&limit=2').headers['ETag']
+        self.assertNotEqual(etag, self.client.get('/favorites?limit=2').headers['ETag'])
+        self.assertEqual(self.client.get('/favorites?after=4&limit=2', headers={'If-None-Match': etag}).status_code, 304)
+        self.client.delete('/favorites/6')
+        self.assertEqual(self.client.get('/favorites?after=4&limit=2', headers={'If-None-Match': etag}).status_code, 200)
+
+
+    def test_api_tokens_cached_and_revoked(self):
+        """Test that a bearer token authenticates from the cache and stops working once revoked."""
+        response = self.client.post('/tokens', json={'name': 'refresh job'})
+        self.assertEqual(response.status_code, 201)
+        created = response.get_json()
+        self.assertTrue(created['token'].startswith(tokens.TOKEN_PREFIX))
+        self.assertEqual(self.client.get('/tokens').get_json()[0]['name'], 'refresh job')
+        self.assertNotIn('token', self.client.get('/tokens').get_json()[0])
+        self.addCleanup(lambda: os.path.exists(self.db_path + '.revoked') and os.unlink(self.db_path + '.revoked'))
+
+        machine = app.test_client()
+        headers = {'Authorization': f"Bearer {created['token']}"}
+        self.assertEqual(machine.get('/favorites').status_code, 401)
+        self.assertEqual(machine.get('/favorites', headers=headers).get_json()[0]['location_name'], 'Paris')
+        self.client.post('/favorites', json={'location_name': 'Lyon', 'latitude': 45.764, 'longitude': 4.8357})
+        self.assertEqual(machine.delete('/favorites/2').status_code, 401)
+        self.assertEqual(machine.delete('/favorites/2', headers=headers).status_code, 200)
+        self.assertEqual([row['id'] for row in self.client.get('/favorites').get_json()], [1])
+        # Cached: served even with the token row gone from the database
+        with app.app_context():
+            db = get_db()
+            db.execute('UPDATE api_tokens SET token_hash = ? WHERE id = ?', ('moved', created['id']))
+            db.commit()
+        self.assertEqual(machine.get('/favorites', headers=headers).status_code, 200)
+        with app.app_context():
+            db = get_db()
+            db.execute('UPDATE api_tokens SET token_hash = ? WHERE id = ?',
+                       (tokens.token_hash(created['token']), created['id']))
+            db.commit()
+        # Tokens cannot mint tokens, and a bad token is rejected
+        self.assertEqual(machine.post('/tokens', json={'name': 'x'}, headers=headers).status_code, 403)
+        self.assertEqual(machine.get('/favorites', headers={'Authorization': 'Bearer wat_nope'}).status_code, 401)
+
+        # Another worker's cache forgets everything when the revocation file changes
+        other = tokens.TokenCache(300, 10)
+        other.check_revocations(self.db_path + '.revoked', 0, 0)
+        other.put('digest', 1, created['id'], time.time() + 300, other.generation)
+        self.assertEqual(self.client.delete(f"/tokens/{created['id']}").status_code, 200)
+        self.assertEqual(machine.get('/favorites', headers=headers).status_code, 401)
+        self.assertEqual(other.get('digest', time.time()), (1, created['id']))
+        other.check_revocations(self.db_path + '.revoked', 0, 1)
+        self.assertIsNone(other.get('digest', time.time()))
+        self.assertEqual(self.client.delete(f"/tokens/{created['id']}").status_code, 404)
+
+        expired = self.client.post('/tokens', json={'name': 'old', 'expires_in_days': 1}).get_json()
+        with app.app_context():
+            db = get_db()
+            db.execute('UPDATE api_tokens SET expires_at = 1 WHERE id = ?', (expired['id'],))
+            db.commit()
+        self.assertEqual(machine.get('/favorites', headers={'Authorization': f"Bearer {expired['token']}"}).status_code, 401)
+        self.assertEqual(self.client.post('/tokens', json={'name': 'x', 'expires_in_days': -1}).status_code, 400)
+
+
+    def test_password_hashers_upgrade_and_pool(self):
+        """Test that legacy hashes are upgraded on login and a full hashing pool sheds with 503."""
+        hashed = passwords.ScryptHasher(n=2 ** 10).encode('secret', 'salt')
+        self.assertTrue(hashed.startswith('scrypt$1024$8$1$'))
+        self.assertTrue(passwords.verify(hashed, 'salt', 'secret'))
+        self.assertFalse(passwords.verify(hashed, 'salt', 'Secret'))
+        with app.app_context():
+            user = get_db().execute('SELECT * FROM users WHERE username = ?', ('testuser',)).fetchone()
+        self.assertTrue(user['password_hash'].startswith('pbkdf2_sha256$600000$'))
+
+        # A hash from before the key-derivation hashers still logs in, and is replaced
+        with app.app_context():
+            db = get_db()
+            db.execute('UPDATE users SET password_hash = ?, salt = ? WHERE id = ?',
+                       (hashlib.sha256(b'testpass123legacysalt').hexdigest(), 'legacysalt', user['id']))
+            db.commit()
+        self.assertEqual(self.client.post('/login', json={'username': 'testuser', 'password': 'wrong'}).status_code, 401)
+        self.assertEqual(self.client.post('/login', json={'username': 'testuser', 'password': 'testpass123'}).status_code, 200)
+        with app.app_context():
+            upgraded = get_db().execute('SELECT * FROM users WHERE id = ?', (user['id'],)).fetchone()
+        self.assertTrue(upgraded['password_hash'].startswith('pbkdf2_sha256$600000$'))
+        self.assertNotEqual(upgraded['salt'], 'legacysalt')
+
+        # Changing the configured hasher upgrades on the next login too
+        app.config.update(PASSWORD_HASHER='scrypt', PASSWORD_HASHER_PARAMS={'n': 2 ** 10})
+        self.addCleanup(app.config.update, PASSWORD_HASHER='pbkdf2_sha256', PASSWORD_HASHER_PARAMS={})
+        self.assertEqual(self.client.post('/login', json={'username': 'testuser', 'password': 'testpass123'}).status_code, 200)
+        with app.app_context():
+            stored = get_db().execute('SELECT password_hash FROM users WHERE id = ?', (user['id'],)).fetchone()[0]
+        self.assertTrue(stored.startswith('scrypt$1024$8$1$'))
+
+        # A full pool postpones the upgrade instead of failing a verified login
+        offload = passwords.offload
+        def busy_rehash(func, *args):
+            if func.__name__ == 'hash_password':
+                raise passwords.HashPoolBusy()
+            return offload(func, *args)
+        passwords.offload = busy_rehash
+        self.addCleanup(setattr, passwords, 'offload', offload)
+        app.config['PASSWORD_HASHER_PARAMS'] = {'n': 2 ** 11}
+        self.assertEqual(self.client.post('/login', json={'username': 'testuser', 'password': 'testpass123'}).status_code, 200)
+        passwords.offload = offload
+        with app.app_context():
+            db = get_db()
+            self.assertEqual(db.execute('SELECT password_hash FROM users WHERE id = ?', (user['id'],)).fetchone()[0],
+                             stored)
+            # An unrecognised hash is a failed login, not a server error
+            db.execute('UPDATE users SET password_hash = ? WHERE id = ?', ('argon9$1$x', user['id']))
+            db.commit()
+        self.assertEqual(self.client.post('/login', json={'username': 'testuser', 'password': 'testpass123'}).status_code, 401)
+
+        pool = app.extensions['password_hashing']
+        busy = passwords.HashPool(1, 0, 5.0)
+        app.extensions['password_hashing'] = busy
+        self.addCleanup(app.extensions.__setitem__, 'password_hashing', pool)
+        release = threading.Event()
+        blocker = threading.Thread(target=busy.run, args=(release.wait,))
+        blocker.start()
+        while busy.stats()['pending'] == 0:
+            time.sleep(0.01)
+        response = self.client.post('/login', json={'username': 'testuser', 'password': 'testpass123'})
+        release.set()
+        blocker.join()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(busy.stats()['rejected'], 1)
+
+        # An unknown username costs a verification too
+        response = self.client.post('/login', json={'username': 'nobody', 'password': 'testpass123'})
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(busy.stats()['completed'], 2)
+
+        # Host-wide slots are lock files shared by every process
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir)
+        slots = passwords.HostSlots(lock_dir, 1)
+        self.assertEqual(slots.run(lambda: 'hashed', time.monotonic() + 1), 'hashed')
+        with open(slots.paths[0], 'a') as held:
+            fcntl.flock(held, fcntl.LOCK_EX)
+            with self.assertRaises(passwords.HashPoolBusy):
+                passwords.HostSlots(lock_dir, 1).run(lambda: 'hashed', time.monotonic() + 0.05)
+
+        output = app.test_cli_runner().invoke(args=['calibrate-passwords', '--target-ms', '20']).output
+        self.assertIn('WEATHER_PASSWORD_HASHER=pbkdf2_sha256', output)
+        self.assertIn('WEATHER_PASSWORD_HASHER_PARAMS=\'{"iterations": ', output)
+
+
+    def test_compact_history_averages_wind_direction_as_angles(self):
+        """Test that rollups take the circular mean of wind directions, also when merging late rows."""
+        day = 1684886400
+        insert = '''
+            INSERT INTO weather_history
+            (location_id, timestamp, temperature, feels_like, pressure,
+            humidity, wind_speed, wind_deg, condition_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        '''
+        with app.app_context():
+            db = get_db()
+            encode_condition = ConditionEncoder(db)
+            mist, clear = encode_condition('mist', '50d'), encode_condition('clear sky', '01d')
+            db.executemany(insert, [(1, day + hour * 3600, 10.0, 9.0, 1000, 50, 2.0, 350 if hour % 2 else 10, mist)
+                                    for hour in range(4)])
+            db.commit()
+            retention.compact_history(db, now=day + 40 * 86400, raw_days=30)
+            first = db.execute('SELECT wind_deg, condition_id FROM weather_history_daily').fetchone()
+            db.executemany(insert, [(1, day + hour * 3600, 10.0, 9.0, 1000, 50, 2.0, 90, clear)
+                                    for hour in range(4, 12)])
+            db.commit()
+            retention.compact_history(db, now=day + 40 * 86400, raw_days=30)
+            merged = db.execute('SELECT samples, wind_deg, condition_id FROM weather_history_daily').fetchone()
+
+        self.assertEqual(tuple(first), (0, mist))
+        # 4 samples from the north and 8 from the east
+        self.assertEqual(tuple(merged), (12, 63, clear))
+
+    def test_retention_thread_starts_once_per_process(self):
+        """Test that the background retention thread is started lazily and only once per process."""
+        started = []
+        original = retention.threading.Thread
+        retention.threading.Thread = lambda **kwargs: type('T', (), {'start': lambda self: started.append(1)})()
+        app.config['RETENTION_INTERVAL'] = 60
+        try:
+            retention.start_background(app)
+            retention.start_background(app)
+        finally:
+            retention.threading.Thread = original
+            app.config['RETENTION_INTERVAL'] = 0
+            app.extensions.pop('retention_pid', None)
+        self.assertEqual(started, [1])
+
+
+    def test_reused_weather_hides_other_users_source(self):
+        """Test that weather reused from another user's location does not reveal that location."""
+        other = app.test_client()
+        other.post('/register', json={'username': 'other', 'password': 'otherpass123'})
+        other.post('/login', json={'username': 'other', 'password': 'otherpass123'})
+        other.post('/favorites', json={'location_name': 'Louvre', 'latitude': 48.8601, 'longitude': 2.3514})
+        other.post('/weather/current/2', json={'current': dict(self.history_data['hourly'][0], dt=int(time.time()))})
+
+        reused = self.client.post('/weather/current/1/reuse').get_json()
+        self.assertEqual((reused['reused'], reused['temperature']), (True, 18.5))
+        self.assertIsNone(reused['source_location_id'])
+        self.assertIsNone(reused['source_distance_km'])
+        for row in [self.client.get('/weather/current/1').get_json()] + self.client.get('/weather/current').get_json():
+            self.assertEqual((row['reused'], row['source_location_id']), (True, None))
+        self.assertNotIn('"source_location_id":2', self.client.get('/weather/current').get_data(as_text=True))
+        self.assertFalse(other.get('/weather/current/2').get_json()['reused'])
+
+
+    def test_conditions_with_a_missing_value_are_stored_once(self):
+        """Test that pairs with a NULL are encoded once and older duplicates are merged by init_db."""
+        with app.app_context():
+            db = get_db()
+            codes = {ConditionEncoder(db)(None, '01d') for _ in range(3)}
+            self.assertEqual(len(codes), 1)
+            self.assertEqual(ConditionEncoder(db)('clear sky', None), ConditionEncoder(db)('clear sky', None))
+            self.assertEqual(db.execute('SELECT COUNT(*) FROM weather_conditions').fetchone()[0], 2)
+
+            # Duplicates stored before the pair index existed
+            db.execute('DROP INDEX idx_weather_conditions_pair')
+            duplicate = db.execute("INSERT INTO weather_conditions (description, icon) VALUES (NULL, '01d')").lastrowid
+            db.execute('INSERT INTO current_weather (location_id, timestamp, condition_id) VALUES (1, 1, ?)',
+                       (duplicate,))
+            db.commit()
+            init_db()
+            self.assertEqual(db.execute('SELECT COUNT(*) FROM weather_conditions').fetchone()[0], 2)
+            self.assertEqual(db.execute('SELECT condition_id FROM current_weather').fetchone()[0], codes.pop())
+            self.assertEqual(db.execute('SELECT icon FROM current_weather_rows').fetchone()[0], '01d')
+
+
+if __name__ == '__main__':
+    unittest.main()
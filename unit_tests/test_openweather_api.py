@@ -5,10 +5,11 @@ import os
 load_dotenv()
 
 API_KEY = os.getenv("OPENWEATHER_API_KEY")
+BASE_URL = os.getenv("OPENWEATHER_BASE_URL", "https://api.openweathermap.org").rstrip("/")
 LAT = 42.3601  
 LON = -71.0589   #Latitude, Longtitude for Boston hehe
 
-url = "https://api.openweathermap.org/data/3.0/onecall"
+url = f"{BASE_URL}/data/3.0/onecall"
 params = {
     "lat": LAT,
     "lon": LON,
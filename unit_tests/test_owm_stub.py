@@ -0,0 +1,55 @@
+import unittest
+from owm_stub import create_stub_app, parse_latency
+
+
+class OwmStubTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up a stub with a fixed clock."""
+        self.stub = create_stub_app(seed=7, now=lambda: 1700000000)
+        self.client = self.stub.test_client()
+        self.params = {'lat': 42.3601, 'lon': -71.0589, 'appid': 'key', 'units': 'metric'}
+
+    def test_onecall_is_deterministic_and_honours_exclude(self):
+        """Test that identical requests return identical data and excluded parts are omitted."""
+        params = dict(self.params, exclude='minutely,hourly,daily,alerts')
+        first = self.client.get('/data/3.0/onecall', query_string=params).get_json()
+        second = self.client.get('/data/3.0/onecall', query_string=params).get_json()
+
+        self.assertEqual(first, second)
+        self.assertEqual(set(first), {'lat', 'lon', 'timezone', 'timezone_offset', 'current'})
+        self.assertEqual(first['current']['dt'], 1700000000)
+        self.assertIn('description', first['current']['weather'][0])
+
+    def test_timemachine_matches_hourly_forecast(self):
+        """Test that history for an hour agrees with the hourly data for that hour."""
+        hourly = self.client.get('/data/3.0/onecall', query_string=self.params).get_json()['hourly']
+        dt = hourly[3]['dt']
+        history = self.client.get('/data/3.0/onecall/timemachine',
+                                  query_string=dict(self.params, dt=dt)).get_json()
+
+        self.assertEqual(history['data'][0], hourly[3])
+
+    def test_rate_limit_injection_and_stats(self):
+        """Test that injected 429s carry Retry-After and are counted."""
+        stub = create_stub_app(rate_limit_rate=1.0)
+        client = stub.test_client()
+        response = client.get('/data/3.0/onecall', query_string=self.params)
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(client.get('/__stats').get_json(), {'/data/3.0/onecall 429': 1})
+        self.assertEqual(client.get('/data/3.0/onecall', query_string={'lat': 1, 'lon': 2}).status_code, 401)
+
+    def test_parse_latency(self):
+        """Test the latency distribution parser."""
+        import random
+        rng = random.Random(1)
+        self.assertEqual(parse_latency('fixed:50')(rng), 0.05)
+        self.assertTrue(0.02 <= parse_latency('uniform:20:80')(rng) <= 0.08)
+        self.assertGreater(parse_latency('lognormal:40:0.5')(rng), 0)
+        with self.assertRaises(ValueError):
+            parse_latency('gamma:1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,9 @@ import unittest
 from unittest.mock import patch, MagicMock
 from run import (register_user, login_user, get_favorites, 
                 add_favorite, remove_favorite, get_weather_api_data,
-                get_forecast_api_data, get_history_api_data, BASE_URL)
+                get_forecast_api_data, get_history_api_data, cached_get,
+                _response_cache, rows_from_columnar, get_current_weather,
+                get_favorite_location, BASE_URL)
 
 
 
@@ -279,5 +281,78 @@ class RunTestCase(unittest.TestCase):
         self.assertTrue('hourly' in result)
         self.assertEqual(len(result['hourly']), 1)
 
+    @patch('requests.sessions.Session.get')
+    def test_cached_get_reuses_response_on_304(self, mock_get):
+        """Test that a 304 revalidation returns the previously stored response."""
+        url = f"{BASE_URL}/weather/current/1"
+        first_response = MagicMock()
+        first_response.status_code = 200
+        first_response.headers = {'ETag': 'W/"current-1-1-7-7"'}
+        first_response.json.return_value = {'temperature': 20.5}
+        not_modified_response = MagicMock()
+        not_modified_response.status_code = 304
+        mock_get.side_effect = [first_response, not_modified_response]
+
+        try:
+            cached_get(url)
+            result = cached_get(url)
+        finally:
+            _response_cache.clear()
+
+        self.assertIs(result, first_response)
+        self.assertEqual(result.json()['temperature'], 20.5)
+        mock_get.assert_called_with(url, headers={'If-None-Match': 'W/"current-1-1-7-7"'})
+
+    def test_rows_from_columnar(self):
+        """Test conversion of a columnar payload back to row dicts."""
+        payload = {
+            'format': 'columnar',
+            'fields': ['timestamp', 'temperature'],
+            'columns': [[1684926000, 1684929600], [18.5, 19.5]]
+        }
+
+        result = rows_from_columnar(payload)
+
+        self.assertEqual(result, [
+            {'timestamp': 1684926000, 'temperature': 18.5},
+            {'timestamp': 1684929600, 'temperature': 19.5}
+        ])
+        self.assertEqual(rows_from_columnar({'error': 'x'}), {'error': 'x'})
+
+    @patch('requests.sessions.Session.get')
+    def test_get_favorite_location_requests_one_row_page(self, mock_get):
+        """Test that one location's coordinates are fetched as a one-row favorites page."""
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.headers = {}
+        mock_get.return_value = mock_response
+
+        get_favorite_location(5)
+
+        mock_get.assert_called_once_with(f"{BASE_URL}/favorites?after=4&limit=1&fields=id,latitude,longitude")
+
+    @patch('requests.get')
+    @patch('requests.sessions.Session.post')
+    @patch('requests.sessions.Session.get')
+    def test_get_current_weather_reuses_nearby_observation(self, mock_get, mock_post, mock_upstream_get):
+        """Test that stored weather reused from a nearby location skips the upstream call."""
+        missing_response = MagicMock()
+        missing_response.status_code = 200
+        missing_response.headers = {}
+        missing_response.json.return_value = {'error': 'No weather data found'}
+        mock_get.return_value = missing_response
+        reuse_response = MagicMock()
+        reuse_response.status_code = 200
+        reuse_response.json.return_value = {
+            'temperature': 18.5, 'feels_like': 18.0, 'description': 'mist', 'humidity': 80,
+            'wind_speed': 2.0, 'source_location_id': 7, 'source_distance_km': 0.29
+        }
+        mock_post.return_value = reuse_response
+
+        self.assertTrue(get_current_weather(1))
+
+        mock_post.assert_called_once_with(f"{BASE_URL}/weather/current/1/reuse")
+        mock_upstream_get.assert_not_called()
+
 if __name__ == '__main__':
     unittest.main()